@@ -3,6 +3,7 @@ import logging
 from pathlib import Path
 import socket
 from contextlib import asynccontextmanager
+import asyncio
 import torch
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -61,9 +62,105 @@ HEADSWAP_MODEL_PATHS = {
     "blender": os.path.join(headswap_path, "pretrained_models/Blender-401-00012900.pth"),
     "parsing": os.path.join(headswap_path, "pretrained_models/parsing.pth"),
     "epoch": os.path.join(headswap_path, "pretrained_models/epoch_20.pth"),
-    "bfm": os.path.join(headswap_path, "pretrained_models/BFM")
+    "bfm": os.path.join(headswap_path, "pretrained_models/BFM"),
+    "sr": os.path.join(headswap_path, "pretrained_models/sr_cf.onnx")
 }
 
+# Source image cache: repeat swaps for the same selfie reuse its detection/alignment
+SOURCE_CACHE_MAX_ITEMS = int(os.environ.get("SOURCE_CACHE_MAX_ITEMS", 64))
+SOURCE_CACHE_TTL_SECONDS = float(os.environ.get("SOURCE_CACHE_TTL_SECONDS", 30 * 60))
+
+# Precomputed gallery template artifacts (see services/template_index.py)
+TEMPLATE_INDEX_DIR = os.environ.get("TEMPLATE_INDEX_DIR", str(get_base_path() / 'template_index'))
+# Loaded templates kept per worker: memory-mapped ones cost page cache only, while each one copied
+# onto a GPU holds its HeadSwap tensors (~4 MB) in device memory
+TEMPLATE_INDEX_CACHE_ITEMS = int(os.environ.get("TEMPLATE_INDEX_CACHE_ITEMS", 512))
+TEMPLATE_INDEX_DEVICE_CACHE_ITEMS = int(os.environ.get("TEMPLATE_INDEX_DEVICE_CACHE_ITEMS", 32))
+
+# Worker pools keeping model inference and blocking network I/O off the event loop
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 2))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", 8))
+INFERENCE_RETRY_AFTER_SECONDS = int(os.environ.get("INFERENCE_RETRY_AFTER_SECONDS", 5))
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 8))
+IO_QUEUE_SIZE = int(os.environ.get("IO_QUEUE_SIZE", 64))
+
+# ONNX Runtime session settings shared by every ONNX model (see services/onnx_sessions.py).
+# By default each session gets an equal share of the cores per inference worker instead of all of them.
+ORT_INTRA_OP_THREADS = int(os.environ.get("ORT_INTRA_OP_THREADS", max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS)))
+ORT_INTER_OP_THREADS = int(os.environ.get("ORT_INTER_OP_THREADS", 1))
+ORT_GRAPH_OPTIMIZATION = os.environ.get("ORT_GRAPH_OPTIMIZATION", "all")  # disable | basic | extended | all
+ORT_OPTIMIZED_MODEL_DIR = os.environ.get("ORT_OPTIMIZED_MODEL_DIR", str(get_base_path() / 'ort_cache'))
+ORT_ENABLE_CPU_MEM_ARENA = os.environ.get("ORT_ENABLE_CPU_MEM_ARENA", "1") == "1"
+ORT_ENABLE_MEM_PATTERN = os.environ.get("ORT_ENABLE_MEM_PATTERN", "1") == "1"
+
+# Micro-batching of concurrent swap requests; BATCH_MAX_SIZE <= 1 disables it
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 4))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 20))
+BATCH_QUEUE_SIZE = int(os.environ.get("BATCH_QUEUE_SIZE", 32))
+
+# Cap on target faces swapped by InSwapper when a request sets no max_faces (0 = every face)
+SWAP_MAX_FACES = int(os.environ.get("SWAP_MAX_FACES", "0"))
+
+# InSwapper face detection (see services/detection.py): long side of the downscaled detector input
+DETECT_MAX_SIDE = int(os.environ.get("DETECT_MAX_SIDE", 640))
+# InsightFace models loaded by FaceAnalysis; the swap needs only detection (bbox + kps) and recognition
+FACE_ANALYSIS_MODULES = [m.strip() for m in os.environ.get("FACE_ANALYSIS_MODULES", "detection,recognition").split(",")
+                         if m.strip()]
+
+# Video / GIF swapping (see services/video.py)
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES", 150))
+VIDEO_MOTION_THRESHOLD = float(os.environ.get("VIDEO_MOTION_THRESHOLD", 3.0))  # mean abs grey-level change
+VIDEO_MAX_REUSE_FRAMES = int(os.environ.get("VIDEO_MAX_REUSE_FRAMES", 5))
+VIDEO_LANDMARK_SMOOTHING = float(os.environ.get("VIDEO_LANDMARK_SMOOTHING", 0.5))
+VIDEO_MAX_UPLOAD_BYTES = int(os.environ.get("VIDEO_MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+# How long an MJPEG stream keeps retrying a frame while the inference pool is full before it gives up
+VIDEO_STREAM_BUSY_TIMEOUT_SECONDS = float(os.environ.get("VIDEO_STREAM_BUSY_TIMEOUT_SECONDS", 30))
+
+# Token -> user cache in front of the Firestore lookup done by get_current_user
+AUTH_TOKEN_CACHE_MAX_ITEMS = int(os.environ.get("AUTH_TOKEN_CACHE_MAX_ITEMS", 1024))
+AUTH_TOKEN_CACHE_TTL_SECONDS = float(os.environ.get("AUTH_TOKEN_CACHE_TTL_SECONDS", 10 * 60))
+AUTH_USE_ASYNC_FIRESTORE = os.environ.get("AUTH_USE_ASYNC_FIRESTORE", "1") == "1"
+
+# Multi-process serving (see services/workers.py, main.py --workers)
+WORKER_STATS_DIR = os.environ.get("WORKER_STATS_DIR")  # defaults to a temp dir per parent process
+WORKER_STATS_INTERVAL_SECONDS = float(os.environ.get("WORKER_STATS_INTERVAL_SECONDS", 5))
+WORKER_PRELOAD_HEADSWAP = os.environ.get("WORKER_PRELOAD_HEADSWAP", "1") == "1"
+
+# How long a request waits for a model that is still loading before answering 503
+MODEL_WAIT_TIMEOUT_SECONDS = float(os.environ.get("MODEL_WAIT_TIMEOUT_SECONDS", 30))
+
+# Append-only login log (see services/login_log.py)
+LOGIN_LOG_DIR = os.environ.get("LOGIN_LOG_DIR", "login_logs")
+LOGIN_LOG_MAX_BYTES = int(os.environ.get("LOGIN_LOG_MAX_BYTES", 5 * 1024 * 1024))
+LOGIN_LOG_BACKUPS = int(os.environ.get("LOGIN_LOG_BACKUPS", 5))
+LOGIN_LOG_QUEUE_SIZE = int(os.environ.get("LOGIN_LOG_QUEUE_SIZE", 10000))
+
+# Background publishing of QR results (see services/publisher.py)
+PUBLISH_DIR = os.environ.get("PUBLISH_DIR", str(get_base_path() / 'publish_queue'))
+PUBLISH_MAX_ATTEMPTS = int(os.environ.get("PUBLISH_MAX_ATTEMPTS", 8))
+PUBLISH_BACKOFF_SECONDS = float(os.environ.get("PUBLISH_BACKOFF_SECONDS", 2))
+PUBLISH_MAX_BACKOFF_SECONDS = float(os.environ.get("PUBLISH_MAX_BACKOFF_SECONDS", 5 * 60))
+# Finished and failed jobs stay on disk this long so their links and status keep working
+PUBLISH_RETENTION_SECONDS = float(os.environ.get("PUBLISH_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+PUBLISH_PRUNE_INTERVAL_SECONDS = float(os.environ.get("PUBLISH_PRUNE_INTERVAL_SECONDS", 60 * 60))
+# Public address of this server. Without it QR codes can only encode the CDN link, which the client
+# fetches from the result's status_url once the background upload has finished.
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL")
+
+# Gallery catalogue served by /api/images (see services/catalogue.py)
+CATALOGUE_TTL_SECONDS = float(os.environ.get("CATALOGUE_TTL_SECONDS", 5 * 60))
+CATALOGUE_STALE_SECONDS = float(os.environ.get("CATALOGUE_STALE_SECONDS", 24 * 60 * 60))  # served while refreshing
+CATALOGUE_FETCH_WORKERS = int(os.environ.get("CATALOGUE_FETCH_WORKERS", 8))
+CATALOGUE_PAGE_SIZE = int(os.environ.get("CATALOGUE_PAGE_SIZE", 500))  # Cloudinary's maximum
+
+# Local cache of gallery template images (see services/template_cache.py)
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", str(get_base_path() / 'template_cache'))
+TEMPLATE_CACHE_MAX_BYTES = int(os.environ.get("TEMPLATE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+TEMPLATE_CACHE_MEMORY_ITEMS = int(os.environ.get("TEMPLATE_CACHE_MEMORY_ITEMS", 32))
+TEMPLATE_CACHE_PREFILL = os.environ.get("TEMPLATE_CACHE_PREFILL", "1") == "1"
+TEMPLATE_CACHE_PREFILL_WORKERS = int(os.environ.get("TEMPLATE_CACHE_PREFILL_WORKERS", 4))
+TEMPLATE_URL_HOSTS = os.environ.get("TEMPLATE_URL_HOSTS", "res.cloudinary.com").split(",")
+
 # Cloudinary Configuration
 cloudinary.config(
     cloud_name="dj3ewvbqm",
@@ -79,70 +176,154 @@ firebase_admin.initialize_app(cred)
 db = firestore.client()
 logger.info("Firebase Firestore initialized successfully.")
 
+# Async Firestore client so request handlers can query without blocking the event loop
+async_db = None
+if AUTH_USE_ASYNC_FIRESTORE:
+    try:
+        from google.cloud.firestore import AsyncClient
+        async_db = AsyncClient(project=cred.project_id, credentials=cred.get_credential())
+        logger.info("Async Firestore client initialized successfully.")
+    except Exception as e:
+        logger.warning("Async Firestore client unavailable, falling back to the sync client: %s", e)
+
 # Model Initialization Variables
 face_swapper = None
 face_analyzer = None
 headswap_model = None
 
+def load_inswapper():
+    """Build the InSwapper model and the InsightFace analyzer it relies on."""
+    from insightface.model_zoo.inswapper import INSwapper
+    from services.onnx_sessions import create_session, get_providers, build_face_analyzer
+    providers = get_providers()
+    logger.debug("Using execution providers: %s", providers)
+    logger.info("Checking model file at: %s", inswapper_model_path)
+    if not os.path.exists(inswapper_model_path):
+        logger.error("InSwapper model file not found: %s", inswapper_model_path)
+        raise FileNotFoundError(f"InSwapper model file not found: {inswapper_model_path}")
+    swapper = INSwapper(model_file=inswapper_model_path, session=create_session(inswapper_model_path, providers))
+    logger.info("Initializing face analyzer...")
+    analyzer = build_face_analyzer(FACE_ANALYSIS_MODULES, providers)
+    logger.info("Face analyzer modules: %s", sorted(analyzer.models))
+    analyzer.prepare(ctx_id=0, det_size=(DETECT_MAX_SIDE, DETECT_MAX_SIDE))
+    return swapper, analyzer
+
+def load_headswap(defer_sessions=False):
+    from HeadSwap.inference import Infer
+    from services.onnx_sessions import create_session
+    from services import workers
+    from services.metrics import span
+    if workers.preloaded_headswap is not None:
+        # Torch weights were loaded by the pre-fork parent and are shared copy-on-write
+        model = workers.preloaded_headswap
+        model.init_sessions(create_session)
+        model.span = span
+        return model
+    return Infer(
+        HEADSWAP_MODEL_PATHS["checkpoint"],
+        HEADSWAP_MODEL_PATHS["blender"],
+        HEADSWAP_MODEL_PATHS["parsing"],
+        HEADSWAP_MODEL_PATHS["epoch"],
+        HEADSWAP_MODEL_PATHS["bfm"],
+        sr_path=HEADSWAP_MODEL_PATHS["sr"],
+        session_factory=create_session,
+        defer_sessions=defer_sessions,
+        span=span
+    )
+
 @asynccontextmanager
 async def lifespan(app):
     global face_swapper, face_analyzer, headswap_model
+    from services.executor import BoundedExecutor
     logger.setLevel(logging.INFO)
     logger.info("Application startup initiated.")
+    app.state.inference_executor = BoundedExecutor("inference", INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+    app.state.io_executor = BoundedExecutor("io", IO_WORKERS, IO_QUEUE_SIZE)
     
-    try:
-        logger.info("Starting initialization of InSwapper face swapper model...")
-        import insightface
-        import onnxruntime as ort
-        providers = ['CPUExecutionProvider']
-        if hasattr(ort, 'get_available_providers') and 'CUDAExecutionProvider' in ort.get_available_providers():
-            providers.insert(0, 'CUDAExecutionProvider')
-        logger.debug("Using execution providers: %s", providers)
-        logger.info("Checking model file at: %s", inswapper_model_path)
-        if not os.path.exists(inswapper_model_path):
-            logger.error("InSwapper model file not found: %s", inswapper_model_path)
-            raise FileNotFoundError(f"InSwapper model file not found: {inswapper_model_path}")
-        face_swapper = insightface.model_zoo.get_model(inswapper_model_path, providers=providers)
-        logger.info("Initializing face analyzer...")
-        face_analyzer = insightface.app.FaceAnalysis()
-        face_analyzer.prepare(ctx_id=0, det_size=(640, 640))
+    from functools import partial
+    from services.model_registry import ModelRegistry
+    from services.onnx_sessions import log_session_report
+    app.state.face_swapper = None
+    app.state.face_analyzer = None
+    app.state.headswap_model = None
+    app.state.batchers = {}
+
+    def start_batcher(model):
+        if BATCH_MAX_SIZE > 1:
+            from services.batching import MicroBatcher
+            from services.executor import run_inference
+            from services.faceswap import run_swap_batch
+            batcher = MicroBatcher(model, partial(run_swap_batch, app.state, model), partial(run_inference, app),
+                                   BATCH_MAX_SIZE, BATCH_WINDOW_MS, BATCH_QUEUE_SIZE)
+            batcher.start()
+            app.state.batchers[model] = batcher
+
+    def inswapper_ready(models):
+        global face_swapper, face_analyzer
+        face_swapper, face_analyzer = models
         app.state.face_swapper = face_swapper
         app.state.face_analyzer = face_analyzer
-        logger.info("InSwapper model and face analyzer loaded successfully.")
-    except Exception as e:
-        logger.exception("InSwapper model initialization failed: %s", str(e))
-        logger.warning("InSwapper functionality will be disabled.")
-        app.state.face_swapper = None
-        app.state.face_analyzer = None
+        start_batcher("inswapper")
 
-    try:
-        logger.info("Starting initialization of HeadSwap model...")
-        from HeadSwap.inference import Infer
-        headswap_model = Infer(
-            HEADSWAP_MODEL_PATHS["checkpoint"],
-            HEADSWAP_MODEL_PATHS["blender"],
-            HEADSWAP_MODEL_PATHS["parsing"],
-            HEADSWAP_MODEL_PATHS["epoch"],
-            HEADSWAP_MODEL_PATHS["bfm"]
-        )
+    def headswap_ready(model):
+        global headswap_model
+        headswap_model = model
         app.state.headswap_model = headswap_model
-        logger.info("HeadSwap model initialized successfully.")
-    except Exception as e:
-        logger.exception("HeadSwap model initialization failed: %s", str(e))
-        logger.warning("HeadSwap functionality will be disabled.")
-        app.state.headswap_model = None
+        start_batcher("headswap")
 
-    if app.state.face_swapper is None and app.state.headswap_model is None:
-        logger.error("Failed to initialize any model. Application cannot function.")
-        raise RuntimeError("All model initializations failed")
-    else:
-        logger.info("Model initialization completed. InSwapper: %s, HeadSwap: %s",
-                    "available" if app.state.face_swapper else "not available",
-                    "available" if app.state.headswap_model else "not available")
+    # Models load concurrently in the background; routes wait for them through require_model
+    app.state.models = ModelRegistry({
+        "inswapper": (load_inswapper, inswapper_ready),
+        "headswap": (load_headswap, headswap_ready),
+    })
+    app.state.models.start()
+
+    async def report_when_loaded():
+        await app.state.models.all_done.wait()
+        log_session_report()
+    report_task = asyncio.create_task(report_when_loaded())
+
+    from services import workers
+    stats_task = asyncio.create_task(workers.publish_stats(app)) if workers.worker_id is not None else None
+    # In --workers mode, one-off startup jobs on shared directories run in the first worker only
+    primary = workers.worker_id in (None, 0)
+
+    from services.publisher import Publisher
+    app.state.publisher = Publisher()
+    app.state.publisher.start(prune=primary)
+    if not PUBLIC_BASE_URL:
+        logger.warning("PUBLIC_BASE_URL is not set: QR codes are issued through status_url once uploads finish")
+
+    from services.catalogue import catalogue
+    catalogue.refresh_async()  # warm the gallery listing so the first /api/images does not wait
+    if TEMPLATE_CACHE_PREFILL and primary:
+        import threading
+        from services.template_cache import prefill_from_catalogue
+        threading.Thread(target=prefill_from_catalogue, name="template-prefill", daemon=True).start()
+
+    from services import device_keys
+    try:
+        device_keys.start_watch()
+    except Exception as e:
+        logger.warning("Device key listener unavailable, lookups will read Firestore directly: %s", e)
+    if primary:
+        device_keys.migrate_in_background()
 
     yield
 
+    report_task.cancel()
+    if stats_task is not None:
+        stats_task.cancel()
+    device_keys.stop_watch()
+    from services.login_log import login_log
+    login_log.close()
+    app.state.publisher.stop()
+    for batcher in app.state.batchers.values():
+        await batcher.stop()
+
     logger.info("Application shutdown initiated. Clearing resources...")
+    app.state.inference_executor.shutdown()
+    app.state.io_executor.shutdown()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     logger.info("Resources cleared. Application shutdown complete.")
@@ -1,15 +1,44 @@
 from fastapi import HTTPException, Query, status
-from config import configure_logging, db
+from starlette.concurrency import run_in_threadpool
+from config import configure_logging, db, async_db, AUTH_TOKEN_CACHE_MAX_ITEMS, AUTH_TOKEN_CACHE_TTL_SECONDS
+from services.cache import TTLCache
+from services import workers
 
 logger = configure_logging(__name__)
 
 # In-memory user storage (optional, for compatibility)
 users_db = {}
 
-def get_current_user(token: str = Query(...)):
-    # Check Firestore for token
+# token -> user email; entries are dropped when /login or /autologin rotate the token
+token_cache = TTLCache(AUTH_TOKEN_CACHE_MAX_ITEMS, AUTH_TOKEN_CACHE_TTL_SECONDS)
+
+def _find_user_by_token(token):
     users_ref = db.collection('users').where('token', '==', token).limit(1).stream()
     for user in users_ref:
         return user.id  # Email as document ID
-    logger.warning("Invalid or expired token provided: %s", token)
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
\ No newline at end of file
+    return None
+
+async def _find_user_by_token_async(token):
+    if async_db is None:
+        return await run_in_threadpool(_find_user_by_token, token)
+    async for user in async_db.collection('users').where('token', '==', token).limit(1).stream():
+        return user.id
+    return None
+
+def invalidate_token(token):
+    if token:
+        token_cache.pop(token)
+        workers.publish_revoked_token(token)
+
+async def get_current_user(token: str = Query(...)):
+    workers.apply_revoked_tokens(token_cache)
+    email = token_cache.get(token)
+    if email is not None:
+        return email
+    # Check Firestore for token
+    email = await _find_user_by_token_async(token)
+    if email is None:
+        logger.warning("Invalid or expired token provided: %s", token)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
+    token_cache.put(token, email)
+    return email
@@ -1,11 +1,20 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import logging
 import argparse
 import os
+import time
+import uuid
 from config import lifespan  # Import lifespan from config.py
+from dependencies import token_cache
+from services.catalogue import catalogue
+from services.template_cache import template_cache
+from services import workers
+from services.cache import source_cache
+from services.metrics import metrics, trace_id
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,15 +27,66 @@ app.include_router(images_router, prefix="/api")
 from routes.faceswap import router as faceswap_router
 app.include_router(faceswap_router, prefix="/api")
 
+from routes.video import router as video_router
+app.include_router(video_router, prefix="/api")
+
+from routes.results import router as results_router
+app.include_router(results_router, prefix="/api")
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Source-Id", "X-Trace-Id"],
 )
 logger.info("CORS middleware configured successfully")
 
+in_flight = 0
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Tag every request with an X-Trace-Id and record its duration per route."""
+    global in_flight
+    request_trace_id = request.headers.get("X-Trace-Id") or uuid.uuid4().hex
+    trace_id.set(request_trace_id)
+    in_flight += 1
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        in_flight -= 1
+    route = request.scope.get("route")
+    metrics.histogram("faceswap_request_seconds", "HTTP request duration",
+                      path=getattr(route, "path", "unmatched"), method=request.method).observe(time.perf_counter() - start)
+    response.headers["X-Trace-Id"] = request_trace_id
+    return response
+
+def _pool_gauge(field):
+    return lambda: {(("pool", name),): getattr(app.state, f"{name}_executor").stats()[field]
+                    for name in ("inference", "io")}
+
+def _cache_gauge(field):
+    caches = {"source": source_cache, "auth_token": token_cache, "template_image": template_cache._decoded}
+    return lambda: {(("cache", name),): cache.stats()[field] for name, cache in caches.items()}
+
+metrics.register_gauge("faceswap_requests_in_flight", "HTTP requests being handled", lambda: in_flight)
+metrics.register_gauge("faceswap_pool_running", "Jobs running on a worker pool", _pool_gauge("running"))
+metrics.register_gauge("faceswap_pool_queued", "Jobs waiting for a worker pool", _pool_gauge("queued"))
+metrics.register_gauge("faceswap_pool_rejected_total", "Jobs rejected by a full pool", _pool_gauge("rejected"),
+                       metric_type="counter")
+metrics.register_gauge("faceswap_batch_queued", "Requests waiting in a micro-batch queue",
+                       lambda: {(("model", model),): batcher.stats()["queued"]
+                                for model, batcher in app.state.batchers.items()})
+metrics.register_gauge("faceswap_publish_jobs", "QR publish jobs by status",
+                       lambda: {(("status", status),): count for status, count in app.state.publisher.stats().items()})
+metrics.register_gauge("faceswap_cache_hits_total", "Cache hits", _cache_gauge("hits"), metric_type="counter")
+metrics.register_gauge("faceswap_cache_misses_total", "Cache misses", _cache_gauge("misses"), metric_type="counter")
+metrics.register_gauge("faceswap_model_ready", "1 once a model has loaded",
+                       lambda: {(("model", name),): int(state["state"] == "ready")
+                                for name, state in app.state.models.stats().items()})
+
 # Mount static files (relative to main.py's location)
 static_dir = os.path.join(os.path.dirname(__file__), "..", "pages")
 static_dir = os.path.abspath(static_dir)  # Ensure absolute path
@@ -45,14 +105,48 @@ async def heartbeat():
     logger.info("Heartbeat endpoint requested.")
     return {
         "status": "ok",
+        "worker": workers.worker_id,
         "inswapper_available": app.state.face_swapper is not None,
-        "headswap_available": app.state.headswap_model is not None
+        "headswap_available": app.state.headswap_model is not None,
+        "models": app.state.models.stats(),
+        "inference_pool": app.state.inference_executor.stats(),
+        "io_pool": app.state.io_executor.stats(),
+        "batching": {model: batcher.stats() for model, batcher in app.state.batchers.items()},
+        "auth_token_cache": token_cache.stats(),
+        "publish_queue": app.state.publisher.stats(),
+        "catalogue": catalogue.stats(),
+        "template_cache": template_cache.stats()
     }
 
+@app.get("/api/workers")
+async def worker_list():
+    """Per-process stats: every worker in --workers mode, else just this process."""
+    if workers.worker_id is None:
+        return {"workers": [workers.worker_stats(app)]}
+    return {"workers": workers.read_worker_stats()}
+
+@app.get("/api/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/ready")
+async def ready():
+    """Readiness probe: 200 once every model has loaded and at least one is usable, 500 if all failed."""
+    models = app.state.models
+    if models.all_failed():
+        return JSONResponse({"ready": False, "failed": True, "models": models.stats()}, status_code=500)
+    return JSONResponse({"ready": models.is_ready(), "failed": False, "models": models.stats()},
+                        status_code=200 if models.is_ready() else 503)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the FastAPI server")
     parser.add_argument("--port", type=int, default=8000, help="Port to run the server on")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes; more than one forks workers that share the model weights")
     args = parser.parse_args()
 
     logger.info(f"Starting FastAPI application on port {args.port}")
-    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="info")
\ No newline at end of file
+    if args.workers > 1:
+        workers.serve(app, "0.0.0.0", args.port, args.workers, log_level="info")
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="info")
\ No newline at end of file
@@ -1,4 +1,6 @@
 from .auth import router as auth_router
 from .faceswap import router as faceswap_router
 from .health import router as health_router
-from .images import router as images_router  # Add this line
\ No newline at end of file
+from .images import router as images_router  # Add this line
+from .results import router as results_router
+from .video import router as video_router
\ No newline at end of file
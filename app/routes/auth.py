@@ -5,9 +5,10 @@ from firebase_admin import firestore
 import secrets
 from passlib.context import CryptContext
 from config import db
+from dependencies import invalidate_token
+from services.device_keys import save_device_key, lookup_email
+from services.login_log import login_log
 import logging
-import os
-import json
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -64,16 +65,11 @@ async def register(user: UserRegister):
     # Store user data in Firestore
     user_ref = db.collection('users').document(user.email)
     user_ref.set(user_data)
-    keys_ref = db.collection('keys').document('saved_keys')
-    keys_ref.set({user.email: {"deviceKey": device_key, "name": user.name}}, merge=True)
+    save_device_key(user.email, user.name, device_key)
 
     logger.info(f"User registered: {user.email}")
     return {"message": "User registered successfully", "token": token, "deviceKey": device_key}
 
-# Directory to save login files
-LOGIN_FILES_DIR = "login_logs"
-os.makedirs(LOGIN_FILES_DIR, exist_ok=True)
-
 # User login endpoint
 @router.post("/login")
 async def login(payload: UserLogin):
@@ -110,18 +106,13 @@ async def login(payload: UserLogin):
 
     # Validate device key if provided
     if device_key:
-        keys_ref = db.collection("keys").document("saved_keys")
-        keys_doc = keys_ref.get()
-        if not keys_doc.exists:
-            raise HTTPException(status_code=500, detail="Keys configuration error")
-        keys_data = keys_doc.to_dict()
-        stored_device_key = keys_data.get(email, {}).get("deviceKey")
-        if device_key != stored_device_key:
+        if lookup_email(device_key) != email:
             raise HTTPException(status_code=401, detail="Device key mismatch")
 
     # Generate token
     token = secrets.token_hex(16)
     user_ref.update({"token": token})
+    invalidate_token(user_data.get("token"))
 
     # Prepare login data
     login_entry = {
@@ -131,31 +122,8 @@ async def login(payload: UserLogin):
         "name": user_data.get("name", "")
     }
 
-    # Save login data to a single JSON file per email
-    filename = f"login.json"
-    file_path = os.path.join(LOGIN_FILES_DIR, filename)
-
-    try:
-        # Read existing data or initialize an empty list
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                existing_data = json.load(f)
-            if not isinstance(existing_data, list):
-                existing_data = [existing_data]  # Convert old single-entry format to list
-        else:
-            existing_data = []
-
-        # Append new login entry
-        existing_data.append(login_entry)
-
-        # Write updated data back to file
-        with open(file_path, 'w') as f:
-            json.dump(existing_data, f, indent=2)
-        logger.info(f"Login info appended to {file_path}")
-    except Exception as e:
-        logger.error(f"Failed to save login info to file: {str(e)}")
-        # Optionally raise an exception if file saving is critical
-        # raise HTTPException(status_code=500, detail="Failed to save login info")
+    # Append to the login log; the write happens on the log's background thread
+    login_log.record(login_entry)
 
     logger.info(f"User logged in: {email}")
     return {"message": "Login successful", "token": token, "email": email, "name": user_data.get("name", "")}
@@ -165,19 +133,8 @@ async def login(payload: UserLogin):
 async def autologin(payload: AutoLoginRequest):
     device_key = payload.device_key
 
-    # Retrieve saved keys from Firestore
-    keys_ref = db.collection("keys").document("saved_keys")
-    keys_doc = keys_ref.get()
-    if not keys_doc.exists:
-        raise HTTPException(status_code=401, detail="No saved keys found")
-
-    keys_data = keys_doc.to_dict()
-    matched_email = None
-    for email, data in keys_data.items():
-        if data.get("deviceKey") == device_key:
-            matched_email = email
-            break
-
+    # Resolve the owner through the device_keys index
+    matched_email = lookup_email(device_key)
     if not matched_email:
         raise HTTPException(status_code=401, detail="Device key not recognized")
 
@@ -197,5 +154,6 @@ async def autologin(payload: AutoLoginRequest):
     # Generate and update token
     token = secrets.token_hex(16)
     user_ref.update({"token": token})
+    invalidate_token(user_data.get("token"))
     logger.info(f"Auto-login successful for: {matched_email}")
     return {"message": "Auto login successful", "token": token, "email": matched_email, "name": user_data.get("name", "")}
\ No newline at end of file
@@ -1,183 +1,268 @@
 from fastapi import APIRouter, File, UploadFile, HTTPException, Query, Depends, Request
 from fastapi.responses import JSONResponse, StreamingResponse
-from config import configure_logging, db
-from firebase_admin import firestore  # Already imported for SERVER_TIMESTAMP
+from config import configure_logging, PUBLIC_BASE_URL, SWAP_MAX_FACES
 from dependencies import get_current_user
-from services.faceswap import process_face_swap, process_head_swap, convert_to_landscape
-from services.cloudinary import upload_to_cloudinary
+from services.faceswap import run_swap
+from services.cache import cache_source, lookup_source
+from services.template_index import load_template, template_id_from_url
+from services.template_cache import template_cache
+from services.executor import run_inference, run_io
+from services.model_registry import require_model
+from services.metrics import span, trace_id
 import io
 import cv2
 import numpy as np
 import qrcode
 import base64
-import cloudinary
 
 router = APIRouter()
 logger = configure_logging(__name__)
 
+async def resolve_source(request, source, source_id):
+    """Return ``(source_id, cache_entry)`` from an uploaded file or a previously issued source_id."""
+    if source is not None:
+        source_bytes = await source.read()
+        logger.info(f"Received source image ({len(source_bytes)} bytes).")
+        try:
+            return await run_inference(request.app, cache_source, source_bytes)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if source_id:
+        source_entry = lookup_source(source_id)
+        if source_entry is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired source_id, upload the source image again")
+        logger.info("Reusing cached source image %s", source_id[:12])
+        return source_id, source_entry
+    raise HTTPException(status_code=400, detail="Either a source image or a source_id is required")
+
+async def resolve_target(request, target, template_id, template_url=None):
+    """Return ``(target_img, template)``; ``template`` holds precomputed artifacts for indexed gallery images."""
+    if template_url and not template_id:
+        # Gallery URLs map onto index ids, so an indexed template is used even when only its URL is sent
+        template_id = template_id_from_url(template_url)
+    if template_id:
+        device = getattr(request.app.state.headswap_model, "device", "cpu")
+        try:
+            template = await run_inference(request.app, load_template, template_id, device=device,
+                                           location=template_url)
+        except ValueError as e:
+            if not template_url:
+                raise HTTPException(status_code=400, detail=str(e))
+            logger.warning("Ignoring template id %r, using its URL instead: %s", template_id, e)
+            template = None
+        if template is not None:
+            logger.info("Using indexed template %s", template_id)
+            return template["image"], template
+        if not template_url:
+            raise HTTPException(status_code=404, detail=f"Template {template_id} is not indexed")
+    if template_url:
+        try:
+            target_img = await run_io(request.app, template_cache.get_image, template_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except OSError as e:
+            logger.error("Failed to fetch template %s: %s", template_url, e)
+            raise HTTPException(status_code=502, detail="Failed to fetch template image")
+        logger.info("Using cached template image %s", template_url)
+        return target_img, None
+    if target is not None:
+        target_bytes = await target.read()
+        logger.info(f"Received target image ({len(target_bytes)} bytes).")
+        target_img = await run_inference(request.app, decode_image, target_bytes)
+        if target_img is None:
+            raise HTTPException(status_code=400, detail="Failed to decode images")
+        return target_img, None
+    raise HTTPException(status_code=400, detail="Either a target image, a template_id or a template_url is required")
+
+def decode_image(image_bytes):
+    with span("decode"):
+        return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+def encode_image(img, ext):
+    with span("encode"):
+        success, encoded_image = cv2.imencode(ext, img)
+    if not success:
+        raise HTTPException(status_code=500, detail="Failed to encode result image")
+    return encoded_image.tobytes()
+
+def make_qr_base64(url):
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(url)
+    qr.make(fit=True)
+    qr_img = qr.make_image(fill="black", back_color="white")
+    buf = io.BytesIO()
+    qr_img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+def parse_face_select(max_faces, face_order, face_indices):
+    """Face selection for InSwapper targets; ``None`` swaps every detected face.
+
+    ``face_indices`` is a comma separated list of positions in ``face_order``
+    ("size": largest first, "index": left to right). Without ``max_faces`` the
+    ``SWAP_MAX_FACES`` default applies.
+    """
+    indices = None
+    if face_indices:
+        try:
+            indices = [int(i) for i in face_indices.split(",") if i.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="face_indices must be comma separated integers")
+    max_faces = max_faces or SWAP_MAX_FACES or None
+    if indices is None and max_faces is None:
+        return None
+    return {"max_faces": max_faces, "order": face_order, "indices": indices}
+
+async def dispatch_swap(app, model, source_entry, target_img, template, mode, face_select=None):
+    """Run a swap through the model's micro-batcher when enabled, else straight on the inference pool."""
+    batcher = app.state.batchers.get(model)
+    if batcher is None:
+        return await run_inference(app, run_swap, app.state, model, source_entry, target_img, template, mode,
+                                   face_select)
+    return await batcher.submit((source_entry, target_img, template, mode, face_select))
+
+def result_base_url(request):
+    return (PUBLIC_BASE_URL or str(request.base_url)).rstrip("/")
+
+def publish_result(publisher, img_bytes, folder, base_url, record=None):
+    """Queue a result for background upload and return its local URL and QR code right away.
+
+    The QR code is only issued here when ``PUBLIC_BASE_URL`` makes the local
+    URL reachable from a phone; otherwise it is ``None`` and the client gets a
+    QR code for the CDN link from ``/api/results/{job_id}/status`` once the
+    upload is done.
+    """
+    job_id = publisher.submit(img_bytes, folder, record)
+    local_url = f"{base_url}/api/results/{job_id}"
+    return job_id, local_url, make_qr_base64(local_url) if PUBLIC_BASE_URL else None
+
+def qr_data_uri(qr_base64):
+    return f"data:image/png;base64,{qr_base64}" if qr_base64 else None
+
 @router.post("/swap-face")
 async def swap_face(
     request: Request,
-    source: UploadFile = File(...),
-    target: UploadFile = File(...),
+    source: UploadFile = File(None),
+    target: UploadFile = File(None),
     mode: str = Query("portrait", enum=["portrait", "landscape"]),
     model: str = Query("inswapper", enum=["inswapper", "headswap"]),
     return_type: str = Query("direct", enum=["direct", "qr"]),
+    source_id: str = Query(None),
+    template_id: str = Query(None),
+    template_url: str = Query(None),
+    max_faces: int = Query(None, ge=1),
+    face_order: str = Query("size", enum=["size", "index"]),
+    face_indices: str = Query(None),
     current_user: str = Depends(get_current_user)
 ):
     logger.info(f"swap-face endpoint called with model: {model}, mode: {mode}, return_type: {return_type}")
-    source_bytes = await source.read()
-    target_bytes = await target.read()
-    logger.info(f"Received source image ({len(source_bytes)} bytes) and target image ({len(target_bytes)} bytes).")
     
     try:
-        if model == "inswapper":
-            face_swapper = request.app.state.face_swapper
-            face_analyzer = request.app.state.face_analyzer
-            if face_swapper is None or face_analyzer is None:
-                logger.error("InSwapper model or analyzer not available.")
-                raise HTTPException(status_code=501, detail="InSwapper model not available")
-            source_img = cv2.imdecode(np.frombuffer(source_bytes, np.uint8), cv2.IMREAD_COLOR)
-            target_img = cv2.imdecode(np.frombuffer(target_bytes, np.uint8), cv2.IMREAD_COLOR)
-            if source_img is None or target_img is None:
-                raise HTTPException(status_code=400, detail="Failed to decode images")
-            result_img = process_face_swap(source_img, target_img, face_swapper, face_analyzer)
-        elif model == "headswap":
-            headswap_model = request.app.state.headswap_model
-            if headswap_model is None:
-                logger.error("HeadSwap model not available.")
-                raise HTTPException(status_code=501, detail="HeadSwap model not available")
-            result_img = process_head_swap(source_bytes, target_bytes, headswap_model)
-        else:
+        if model not in ("inswapper", "headswap"):
             raise HTTPException(status_code=400, detail="Invalid model selection")
-        
-        if mode == "landscape":
-            result_img = convert_to_landscape(result_img)
+        await require_model(request.app, model, "InSwapper" if model == "inswapper" else "HeadSwap")
+        source_id, source_entry = await resolve_source(request, source, source_id)
+        target_img, template = await resolve_target(request, target, template_id, template_url)
+        face_select = parse_face_select(max_faces, face_order, face_indices) if model == "inswapper" else None
+        result_img = await dispatch_swap(request.app, model, source_entry, target_img, template, mode, face_select)
         
         if return_type == "direct":
-            success, encoded_image = cv2.imencode(".png", result_img)
-            if not success:
-                raise HTTPException(status_code=500, detail="Failed to encode result image")
-            return StreamingResponse(io.BytesIO(encoded_image.tobytes()), media_type="image/png")
+            img_bytes = await run_inference(request.app, encode_image, result_img, ".png")
+            return StreamingResponse(io.BytesIO(img_bytes), media_type="image/png",
+                                     headers={"X-Source-Id": source_id})
         
         elif return_type == "qr":
-            _, img_encoded = cv2.imencode('.jpg', result_img)
-            img_bytes = img_encoded.tobytes()
+            img_bytes = await run_inference(request.app, encode_image, result_img, ".jpg")
             folder = f"face_swap_results/{model}"
-            upload_result = upload_to_cloudinary(img_bytes, folder)
-            secure_url = upload_result.get("secure_url", "").replace("/upload/", "/upload/fl_attachment/")
-            
-            result_ref = db.collection('face_swaps').document()
-            result_ref.set({
-                "user": current_user,
-                "model": model,
-                "mode": mode,
-                "image_url": secure_url,
-                "created_at": firestore.SERVER_TIMESTAMP  # Corrected: no parentheses
-            })
-            logger.info("Face swap result stored in Firestore for user: %s", current_user)
-            
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(secure_url)
-            qr.make(fit=True)
-            qr_img = qr.make_image(fill="black", back_color="white")
-            buf = io.BytesIO()
-            qr_img.save(buf, format="PNG")
-            qr_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
+            record = {"user": current_user, "model": model, "mode": mode}
+            job_id, result_url, qr_base64 = await run_io(request.app, publish_result, request.app.state.publisher,
+                                                         img_bytes, folder, result_base_url(request), record)
             
             return JSONResponse({
-                "swapped_image_url": secure_url,
-                "qr_code": f"data:image/png;base64,{qr_base64}",
-                "model_used": model
+                "swapped_image_url": result_url,
+                "qr_code": qr_data_uri(qr_base64),
+                "model_used": model,
+                "source_id": source_id,
+                "job_id": job_id,
+                "status_url": f"/api/results/{job_id}/status"
             })
     except HTTPException as he:
         raise he
     except Exception as e:
-        logger.exception("Unexpected error in face/head swap process: %s", str(e))
+        logger.exception("Unexpected error in face/head swap process (trace %s): %s", trace_id.get(), str(e))
         raise HTTPException(status_code=500, detail="Internal server error")
 
-# Rest of the file remains unchanged (swap-face-qr, headswap, headswap-qr endpoints)
 @router.post("/swap-face-qr/")
 async def swap_face_qr(
     request: Request,
-    source: UploadFile = File(...),
-    target: UploadFile = File(...),
-    mode: str = Query("portrait", enum=["portrait", "landscape"])
+    source: UploadFile = File(None),
+    target: UploadFile = File(None),
+    mode: str = Query("portrait", enum=["portrait", "landscape"]),
+    source_id: str = Query(None),
+    template_id: str = Query(None),
+    template_url: str = Query(None),
+    max_faces: int = Query(None, ge=1),
+    face_order: str = Query("size", enum=["size", "index"]),
+    face_indices: str = Query(None),
+    token: str = Query(None)
 ):
     logger.info(f"swap-face-qr endpoint called with mode: {mode}")
-    source_bytes = await source.read()
-    target_bytes = await target.read()
-    logger.info(f"Received source image ({len(source_bytes)} bytes) and target image ({len(target_bytes)} bytes).")
     
-    face_swapper = request.app.state.face_swapper
-    face_analyzer = request.app.state.face_analyzer
-    if face_swapper is None or face_analyzer is None:
-        logger.error("InSwapper model or analyzer not available.")
-        raise HTTPException(status_code=501, detail="InSwapper model not available")
-    
-    try:
-        source_img = cv2.imdecode(np.frombuffer(source_bytes, np.uint8), cv2.IMREAD_COLOR)
-        target_img = cv2.imdecode(np.frombuffer(target_bytes, np.uint8), cv2.IMREAD_COLOR)
-        if source_img is None or target_img is None:
-            logger.error("Failed to decode source or target image.")
-            raise HTTPException(status_code=400, detail="Failed to decode images")
+    await require_model(request.app, "inswapper", "InSwapper")
 
-        result_img = process_face_swap(source_img, target_img, face_swapper, face_analyzer)
-
-        _, img_encoded = cv2.imencode('.jpg', result_img)
-        img_bytes = img_encoded.tobytes()
-
-        folder = "face_swap_results/inswapper"
-        upload_result = cloudinary.uploader.upload(
-            file=io.BytesIO(img_bytes),
-            folder=folder,
-            resource_type="image"
-        )
-        secure_url = upload_result.get("secure_url", "").replace("/upload/", "/upload/fl_attachment/")
+    try:
+        if source is None and source_id:
+            # A source_id stands in for someone's uploaded photo, so reusing one needs a signed-in user
+            if not token:
+                raise HTTPException(status_code=401, detail="Reusing a source_id requires a token")
+            await get_current_user(token)
+        source_id, source_entry = await resolve_source(request, source, source_id)
+        target_img, template = await resolve_target(request, target, template_id, template_url)
+        face_select = parse_face_select(max_faces, face_order, face_indices)
+        result_img = await dispatch_swap(request.app, "inswapper", source_entry, target_img, template, "portrait",
+                                         face_select)
 
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(secure_url)
-        qr.make(fit=True)
-        qr_img = qr.make_image(fill="black", back_color="white")
-        buf = io.BytesIO()
-        qr_img.save(buf, format="PNG")
-        qr_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
+        img_bytes = await run_inference(request.app, encode_image, result_img, ".jpg")
+        job_id, result_url, qr_base64 = await run_io(request.app, publish_result, request.app.state.publisher,
+                                                     img_bytes, "face_swap_results/inswapper", result_base_url(request))
 
-        logger.info("Face swap completed. Returning URL and QR code.")
+        logger.info("Face swap completed. Returning URL and QR code, upload queued as %s.", job_id)
         return {
-            "swapped_image_url": secure_url,
-            "qr_code": f"data:image/png;base64,{qr_base64}",
-            "model_used": "inswapper"
+            "swapped_image_url": result_url,
+            "qr_code": qr_data_uri(qr_base64),
+            "model_used": "inswapper",
+            "source_id": source_id,
+            "job_id": job_id,
+            "status_url": f"/api/results/{job_id}/status"
         }
     except HTTPException as he:
         raise he
     except Exception as e:
-        logger.exception(f"Error in swap-face-qr: {str(e)}")
+        logger.exception(f"Error in swap-face-qr (trace {trace_id.get()}): {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/headswap")
 async def headswap(
     request: Request,
-    source: UploadFile = File(...),
-    target: UploadFile = File(...),
+    source: UploadFile = File(None),
+    target: UploadFile = File(None),
+    source_id: str = Query(None),
+    template_id: str = Query(None),
+    template_url: str = Query(None),
     current_user: str = Depends(get_current_user)
 ):
-    headswap_model = request.app.state.headswap_model
-    if headswap_model is None:
-        logger.error("HeadSwap model not available.")
-        raise HTTPException(status_code=501, detail="HeadSwap model not available")
-    return await swap_face(request, source, target, mode="portrait", model="headswap", return_type="direct", current_user=current_user)
+    await require_model(request.app, "headswap", "HeadSwap")
+    return await swap_face(request, source, target, mode="portrait", model="headswap", return_type="direct", source_id=source_id, template_id=template_id, template_url=template_url, max_faces=None, face_order="size", face_indices=None, current_user=current_user)
 
 @router.post("/headswap-qr")
 async def headswap_qr(
     request: Request,
-    source: UploadFile = File(...),
-    target: UploadFile = File(...),
+    source: UploadFile = File(None),
+    target: UploadFile = File(None),
     mode: str = Query("portrait", enum=["portrait", "landscape"]),
+    source_id: str = Query(None),
+    template_id: str = Query(None),
+    template_url: str = Query(None),
     current_user: str = Depends(get_current_user)
 ):
-    headswap_model = request.app.state.headswap_model
-    if headswap_model is None:
-        logger.error("HeadSwap model not available.")
-        raise HTTPException(status_code=501, detail="HeadSwap model not available")
-    return await swap_face(request, source, target, mode=mode, model="headswap", return_type="qr", current_user=current_user)
\ No newline at end of file
+    await require_model(request.app, "headswap", "HeadSwap")
+    return await swap_face(request, source, target, mode=mode, model="headswap", return_type="qr", source_id=source_id, template_id=template_id, template_url=template_url, max_faces=None, face_order="size", face_indices=None, current_user=current_user)
\ No newline at end of file
@@ -1,41 +1,24 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, Response
+from fastapi.responses import JSONResponse
 from config import configure_logging
-import cloudinary.api
+from services.catalogue import catalogue
 
 router = APIRouter()
 logger = configure_logging(__name__)
 
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
 @router.get("/images")
-def get_cloudinary_image_structure():
-    logger.info("Fetching Cloudinary image structure.")
-    genders = ["men", "women"]
-    categories = ["classic", "superhero", "civilization", "fantasy"]
-    structure = {}
-    user_tempelets_count = 0
-    for gender in genders:
-        structure[gender] = {}
-        for category in categories:
-            prefixes = [
-                f"media_uploads/{gender}/{category}",
-                f"user_tempelets/{gender}/{category}"
-            ]
-            urls = []
-            for prefix in prefixes:
-                try:
-                    logger.info("Fetching resources for prefix: %s", prefix)
-                    resources = cloudinary.api.resources(
-                        type="upload",
-                        prefix=prefix,
-                        resource_type="image",
-                        max_results=100
-                    )
-                    urls_list = [res["secure_url"] for res in resources.get("resources", [])]
-                    logger.info("Fetched %d images for prefix %s", len(urls_list), prefix)
-                    urls.extend(urls_list)
-                    if prefix.startswith("user_tempelets/"):
-                        user_tempelets_count += len(urls_list)
-                except Exception as e:
-                    logger.exception("Error fetching images for %s: %s", prefix, e)
-            structure[gender][category] = urls
-    logger.info("Image structure fetched successfully. Total user_tempelets count: %d", user_tempelets_count)
-    return {"structure": structure, "user_tempelets_count": user_tempelets_count}
\ No newline at end of file
+def get_cloudinary_image_structure(if_none_match: str = Header(None)):
+    snapshot = catalogue.get()
+    # no-cache: clients may keep the body but must revalidate it with If-None-Match
+    headers = {"ETag": snapshot["etag"], "Cache-Control": "no-cache"}
+    if _etag_matches(if_none_match, snapshot["etag"]):
+        return Response(status_code=304, headers=headers)
+    logger.info("Serving image structure. Total user_tempelets count: %d", snapshot["user_tempelets_count"])
+    return JSONResponse({"structure": snapshot["structure"], "user_tempelets_count": snapshot["user_tempelets_count"]},
+                        headers=headers)
@@ -0,0 +1,36 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, RedirectResponse
+from config import configure_logging
+from routes.faceswap import make_qr_base64, qr_data_uri
+from services.executor import run_io
+
+router = APIRouter()
+logger = configure_logging(__name__)
+
+def _get_job(request, job_id):
+    job = request.app.state.publisher.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown result")
+    return job
+
+@router.get("/results/{job_id}")
+async def get_result(request: Request, job_id: str):
+    """Serve a QR result: from local disk while publishing, then redirect to the CDN link."""
+    job = _get_job(request, job_id)
+    if job["status"] == "done":
+        return RedirectResponse(job["url"])
+    return FileResponse(request.app.state.publisher.image_path(job_id), media_type="image/jpeg")
+
+@router.get("/results/{job_id}/status")
+async def get_result_status(request: Request, job_id: str):
+    job = _get_job(request, job_id)
+    done = job["status"] == "done"
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        "cdn_url": job["url"] if done else None,
+        # Clients without a reachable local link (no PUBLIC_BASE_URL) show this QR code for the CDN link
+        "qr_code": qr_data_uri(await run_io(request.app, make_qr_base64, job["url"])) if done else None,
+        "attempts": job["attempts"],
+        "error": job["error"]
+    }
@@ -0,0 +1,122 @@
+from fastapi import APIRouter, File, UploadFile, HTTPException, Query, Depends, Request
+from fastapi.responses import StreamingResponse
+from config import configure_logging, VIDEO_MAX_UPLOAD_BYTES, VIDEO_STREAM_BUSY_TIMEOUT_SECONDS
+from dependencies import get_current_user
+from routes.faceswap import resolve_source
+from services.executor import run_inference, run_io
+from services.faceswap import get_source_faces, get_headswap_source
+from services.model_registry import require_model
+from services.video import iter_frames, swap_frames, mjpeg_chunks, mjpeg_error_part, write_mp4, clip_fps, save_upload
+import asyncio
+import os
+import time
+
+router = APIRouter()
+logger = configure_logging(__name__)
+
+_END = object()
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Error removing temporary file {path}: {str(e)}")
+
+def _swap_to_mp4(clip_path, out_path, state, model, source_entry):
+    frames = swap_frames(iter_frames(clip_path), state, model, source_entry)
+    count = write_mp4(frames, out_path, clip_fps(clip_path))
+    if count == 0:
+        raise HTTPException(status_code=400, detail="Failed to decode clip")
+
+def _prepare_source(state, model, source_entry):
+    """Detect the source face (or align the source head) up front; the result is cached on the entry."""
+    if model == "inswapper":
+        get_source_faces(source_entry, state.face_analyzer)
+    else:
+        get_headswap_source(source_entry, state.headswap_model)
+
+async def _next_chunk(app, chunks):
+    """Next MJPEG part; while the inference pool is full the frame is retried instead of ending the stream."""
+    deadline = time.monotonic() + VIDEO_STREAM_BUSY_TIMEOUT_SECONDS
+    while True:
+        try:
+            return await run_inference(app, next, chunks, _END)
+        except HTTPException as e:
+            if e.status_code != 503 or time.monotonic() >= deadline:
+                raise
+        await asyncio.sleep(0.1)
+
+@router.post("/swap-video")
+async def swap_video(
+    request: Request,
+    clip: UploadFile = File(...),
+    source: UploadFile = File(None),
+    source_id: str = Query(None),
+    model: str = Query("inswapper", enum=["inswapper", "headswap"]),
+    output: str = Query("mjpeg", enum=["mjpeg", "mp4"]),
+    current_user: str = Depends(get_current_user)
+):
+    logger.info(f"swap-video endpoint called with model: {model}, output: {output}")
+    state = request.app.state
+    await require_model(request.app, model, "InSwapper" if model == "inswapper" else "HeadSwap")
+
+    source_id, source_entry = await resolve_source(request, source, source_id)
+    try:
+        await run_inference(request.app, _prepare_source, state, model, source_entry)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    clip_bytes = await clip.read(VIDEO_MAX_UPLOAD_BYTES + 1)
+    if len(clip_bytes) > VIDEO_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Clip is larger than {VIDEO_MAX_UPLOAD_BYTES} bytes")
+    logger.info(f"Received clip ({len(clip_bytes)} bytes).")
+    suffix = os.path.splitext(clip.filename or "")[1] or ".mp4"
+    clip_path = await run_io(request.app, save_upload, clip_bytes, suffix)
+
+    if output == "mp4":
+        out_path = clip_path + ".out.mp4"
+        try:
+            await run_inference(request.app, _swap_to_mp4, clip_path, out_path, state, model, source_entry)
+            video_file = open(out_path, "rb")
+        finally:
+            _remove(clip_path)
+            _remove(out_path)  # the open handle keeps the data readable until the response is done
+
+        def mp4_chunks(chunk_size=256 * 1024):
+            with video_file:
+                yield from iter(lambda: video_file.read(chunk_size), b"")
+
+        return StreamingResponse(mp4_chunks(), media_type="video/mp4", headers={"X-Source-Id": source_id})
+
+    # MJPEG: every frame is produced by its own job on the inference pool, so other
+    # requests interleave with long clips instead of waiting for the whole clip.
+    chunks = mjpeg_chunks(swap_frames(iter_frames(clip_path), state, model, source_entry))
+    try:
+        first = await run_inference(request.app, next, chunks, _END)
+    except Exception:
+        _remove(clip_path)
+        raise
+    if first is _END:
+        _remove(clip_path)
+        raise HTTPException(status_code=400, detail="Failed to decode clip")
+
+    async def stream():
+        try:
+            chunk = first
+            while chunk is not _END:
+                yield chunk
+                chunk = await _next_chunk(request.app, chunks)
+        except HTTPException as e:
+            logger.warning("Video stream stopped early: %s", e.detail)
+            yield mjpeg_error_part(str(e.detail))
+        except Exception as e:
+            logger.exception("Video stream failed: %s", e)
+            yield mjpeg_error_part("Internal server error")
+        finally:
+            try:
+                chunks.close()
+            except ValueError:
+                pass  # the client went away while a frame job is still running; it finishes on its own
+            _remove(clip_path)
+
+    return StreamingResponse(stream(), media_type="multipart/x-mixed-replace; boundary=frame",
+                             headers={"X-Source-Id": source_id})
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+
+from fastapi import HTTPException
+from config import configure_logging, INFERENCE_RETRY_AFTER_SECONDS
+from services.metrics import metrics
+
+logger = configure_logging(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+
+class MicroBatcher:
+    """Collects concurrent requests into small batches for one model.
+
+    Items wait at most ``window_ms`` (or until ``max_batch`` items are queued)
+    before ``run_batch`` is called once with all of them. ``run_batch`` is a
+    blocking callable taking a list of items and returning one result per item;
+    a result that is an ``Exception`` is raised to that item's caller only.
+    ``execute`` is the coroutine used to run it off the event loop.
+    """
+
+    def __init__(self, name, run_batch, execute, max_batch, window_ms, max_queue):
+        self.name = name
+        self.run_batch = run_batch
+        self.execute = execute
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._task = None
+        self._inflight = set()
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+        self._recent = deque(maxlen=2048)  # (completed_at, latency) of recent items
+
+    def start(self):
+        self._task = asyncio.create_task(self._collect())
+        logger.info("Micro-batching for %s started (max batch %d, window %.0f ms)",
+                    self.name, self.max_batch, self.window * 1000)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._inflight, return_exceptions=True)
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future, time.monotonic()))
+        except asyncio.QueueFull:
+            logger.warning("%s batch queue full, rejecting request", self.name)
+            raise HTTPException(status_code=503, detail="Server busy, please retry shortly",
+                                headers={"Retry-After": str(INFERENCE_RETRY_AFTER_SECONDS)})
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without waiting so the next batch can form while this one runs
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch):
+        items = [item for item, _, _ in batch]
+        dispatched_at = time.monotonic()
+        for _, _, queued_at in batch:
+            metrics.observe("batch_wait", dispatched_at - queued_at)
+        metrics.histogram("faceswap_batch_size", "Items per micro-batch", buckets=BATCH_SIZE_BUCKETS,
+                          model=self.name).observe(len(batch))
+        try:
+            results = await self.execute(self.run_batch, items)
+        except Exception as e:
+            results = [e] * len(batch)
+        now = time.monotonic()
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future, queued_at), result in zip(batch, results):
+            self._recent.append((now, now - queued_at))
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                self.failed += 1
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        recent = list(self._recent)
+        latencies = sorted(latency for _, latency in recent)
+        stats = {"max_batch": self.max_batch, "window_ms": self.window * 1000, "queued": self._queue.qsize(),
+                 "batches": self.batches, "items": self.items, "failed": self.failed,
+                 "mean_batch_size": self.items / self.batches if self.batches else 0.0}
+        if latencies:
+            span = recent[-1][0] - recent[0][0]
+            stats["throughput_per_s"] = len(recent) / span if span > 0 else None
+            stats["latency_p50_ms"] = latencies[len(latencies) // 2] * 1000
+            stats["latency_p99_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        return stats
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from config import configure_logging, SOURCE_CACHE_MAX_ITEMS, SOURCE_CACHE_TTL_SECONDS
+from services.metrics import span
+
+logger = configure_logging(__name__)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ``ttl`` seconds."""
+
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return None if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        return {"size": size, "max_items": self.max_items, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses}
+
+
+# Decoded source images plus whatever each model derived from them (InSwapper
+# faces/embedding, HeadSwap aligned source tensor), keyed by content hash.
+source_cache = TTLCache(SOURCE_CACHE_MAX_ITEMS, SOURCE_CACHE_TTL_SECONDS)
+
+
+def cache_source(image_bytes):
+    """Return ``(source_id, entry)`` for uploaded source bytes, decoding them only once."""
+    source_id = hashlib.sha256(image_bytes).hexdigest()
+    entry = source_cache.get(source_id)
+    if entry is None:
+        with span("decode"):
+            image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Failed to decode source image")
+        entry = {"image": image}
+        source_cache.put(source_id, entry)
+        logger.info("Cached new source image %s", source_id[:12])
+    return source_id, entry
+
+
+def lookup_source(source_id):
+    return source_cache.get(source_id)
@@ -0,0 +1,133 @@
+"""Cached gallery catalogue behind /api/images.
+
+All Cloudinary prefixes are listed concurrently, following ``next_cursor``
+until each listing is complete. The resulting structure is cached: within
+``CATALOGUE_TTL_SECONDS`` it is served as is, for a further
+``CATALOGUE_STALE_SECONDS`` it is served stale while one background refresh
+runs, and only after that does a request wait for Cloudinary. Each snapshot
+carries an ETag so clients can revalidate with ``If-None-Match``.
+"""
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cloudinary.api
+from config import (configure_logging, CATALOGUE_TTL_SECONDS, CATALOGUE_STALE_SECONDS, CATALOGUE_FETCH_WORKERS,
+                    CATALOGUE_PAGE_SIZE)
+
+logger = configure_logging(__name__)
+
+GENDERS = ["men", "women"]
+CATEGORIES = ["classic", "superhero", "civilization", "fantasy"]
+PREFIX_ROOTS = ["media_uploads", "user_tempelets"]
+
+
+def fetch_prefix(prefix, page_size=CATALOGUE_PAGE_SIZE):
+    """Every image URL under ``prefix``, across all result pages."""
+    urls = []
+    cursor = None
+    while True:
+        params = dict(type="upload", prefix=prefix, resource_type="image", max_results=page_size)
+        if cursor:
+            params["next_cursor"] = cursor
+        resources = cloudinary.api.resources(**params)
+        urls.extend(res["secure_url"] for res in resources.get("resources", []))
+        cursor = resources.get("next_cursor")
+        if not cursor:
+            return urls
+
+
+def all_urls(structure):
+    return [url for categories in structure.values() for urls in categories.values() for url in urls]
+
+
+class Catalogue:
+    def __init__(self, ttl=CATALOGUE_TTL_SECONDS, stale=CATALOGUE_STALE_SECONDS, workers=CATALOGUE_FETCH_WORKERS):
+        self.ttl = ttl
+        self.stale = stale
+        self.workers = workers
+        self._snapshot = None
+        self._prefix_urls = {}  # last good listing per prefix, reused when one prefix fails
+        self._fetch_lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._refreshing = False
+        self.fetches = 0
+
+    def get(self):
+        """Current snapshot ``{"structure", "user_tempelets_count", "etag", "fetched_at"}``."""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            age = time.time() - snapshot["fetched_at"]
+            if age < self.ttl:
+                return snapshot
+            if age < self.ttl + self.stale:
+                self.refresh_async()
+                return snapshot
+        with self._fetch_lock:
+            # Another request may have refreshed while this one waited for the lock
+            if self._snapshot is not snapshot and self._snapshot is not None:
+                return self._snapshot
+            return self._refresh()
+
+    def refresh_async(self):
+        with self._flag_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name="catalogue-refresh", daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._fetch_lock:
+                self._refresh()
+        except Exception as e:
+            logger.exception("Catalogue refresh failed: %s", e)
+        finally:
+            self._refreshing = False
+
+    def _fetch(self, prefix):
+        try:
+            urls = fetch_prefix(prefix)
+            logger.info("Fetched %d images for prefix %s", len(urls), prefix)
+            return urls
+        except Exception as e:
+            logger.exception("Error fetching images for %s: %s", prefix, e)
+            return self._prefix_urls.get(prefix, [])
+
+    def _refresh(self):
+        started = time.perf_counter()
+        prefixes = [f"{root}/{gender}/{category}"
+                    for gender in GENDERS for category in CATEGORIES for root in PREFIX_ROOTS]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="catalogue") as pool:
+            listings = dict(zip(prefixes, pool.map(self._fetch, prefixes)))
+        self._prefix_urls = listings
+
+        structure = {gender: {category: [] for category in CATEGORIES} for gender in GENDERS}
+        user_tempelets_count = 0
+        for prefix, urls in listings.items():
+            root, gender, category = prefix.split("/")
+            structure[gender][category].extend(urls)
+            if root == "user_tempelets":
+                user_tempelets_count += len(urls)
+        body = json.dumps(structure, sort_keys=True).encode()
+        self._snapshot = {
+            "structure": structure,
+            "user_tempelets_count": user_tempelets_count,
+            "etag": '"' + hashlib.sha1(body).hexdigest() + '"',
+            "fetched_at": time.time()
+        }
+        self.fetches += 1
+        logger.info("Catalogue refreshed in %.2fs: %d images, %d user templates",
+                    time.perf_counter() - started, len(all_urls(structure)), user_tempelets_count)
+        return self._snapshot
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {"fetches": self.fetches, "refreshing": self._refreshing,
+                "age_s": time.time() - snapshot["fetched_at"] if snapshot else None,
+                "etag": snapshot["etag"] if snapshot else None}
+
+
+catalogue = Catalogue()
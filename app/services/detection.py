@@ -0,0 +1,68 @@
+"""Resolution-aware face detection front end for InSwapper.
+
+``FaceAnalysis.get`` letterboxes every frame into the fixed 640x640 detector
+input, so a 16:9 frame wastes almost half the network on padding, and then
+runs every loaded head (2D/3D landmarks, gender/age, recognition) on each
+face although the swap only reads bbox, kps and, for the source, the
+embedding. ``detect_faces`` downscales the frame so its long side is
+``DETECT_MAX_SIDE``, pads it only up to the next multiple of 32, runs the
+SCRFD network on that and maps boxes and keypoints back to full resolution.
+Detectors exported with a fixed input size keep that size.
+
+Targets need nothing beyond that. ``detect_source_faces`` additionally runs
+recognition, on the full-resolution frame and for the best face only, since
+that is the one InSwapper takes its identity from. The analyzer itself is
+built with only the ``FACE_ANALYSIS_MODULES`` models (see config.py).
+"""
+import math
+
+import cv2
+import numpy as np
+
+from config import configure_logging, DETECT_MAX_SIDE
+
+logger = configure_logging(__name__)
+
+
+def det_input_size(det_model, height, width, max_side=DETECT_MAX_SIDE):
+    """``(width, height)`` of the detector input for a ``height`` x ``width`` frame."""
+    input_shape = det_model.session.get_inputs()[0].shape
+    if isinstance(input_shape[2], int) and isinstance(input_shape[3], int):
+        return input_shape[3], input_shape[2]
+    scale = max_side / max(height, width)
+    return (max(32, math.ceil(width * scale / 32) * 32),
+            max(32, math.ceil(height * scale / 32) * 32))
+
+
+def detect_faces(face_analyzer, img, max_side=DETECT_MAX_SIDE):
+    """Faces in ``img`` with full-resolution bbox, kps and det_score, sorted by score."""
+    from insightface.app.common import Face
+    det_model = face_analyzer.det_model
+    height, width = img.shape[:2]
+    det_width, det_height = det_input_size(det_model, height, width, max_side)
+    scale = min(det_width / width, det_height / height)
+    new_width, new_height = min(det_width, round(width * scale)), min(det_height, round(height * scale))
+    det_img = np.zeros((det_height, det_width, 3), dtype=np.uint8)
+    det_img[:new_height, :new_width] = cv2.resize(
+        img, (new_width, new_height), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+
+    scores_list, bboxes_list, kpss_list = det_model.forward(det_img, det_model.det_thresh)
+    scores = np.vstack(scores_list)
+    order = scores.ravel().argsort()[::-1]
+    # Same post-processing as SCRFD.detect, with coordinates scaled back to the input frame
+    pre_det = np.hstack((np.vstack(bboxes_list) / scale, scores)).astype(np.float32, copy=False)[order]
+    keep = det_model.nms(pre_det)
+    det = pre_det[keep]
+    kpss = (np.vstack(kpss_list) / scale)[order][keep] if det_model.use_kps else None
+    logger.debug("Detected %d faces at %dx%d for a %dx%d frame", len(det), det_width, det_height, width, height)
+    return [Face(bbox=det[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=det[i, 4])
+            for i in range(det.shape[0])]
+
+
+def detect_source_faces(face_analyzer, img, max_side=DETECT_MAX_SIDE):
+    """``[best face]`` of a source image with its recognition embedding, or ``[]``."""
+    faces = detect_faces(face_analyzer, img, max_side)
+    if not faces:
+        return []
+    face_analyzer.models["recognition"].get(img, faces[0])
+    return faces[:1]
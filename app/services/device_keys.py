@@ -0,0 +1,151 @@
+"""Device key -> user lookup backed by one Firestore document per key.
+
+Keys live in ``device_keys/{deviceKey}`` documents holding the owner's email
+and name, so a lookup is a single document read. A warm in-memory reverse
+index is kept in sync by a Firestore snapshot listener. Data written by older
+versions to the single ``keys/saved_keys`` document is migrated with
+``python -m services.device_keys --migrate`` (from the ``app`` directory), in
+the background at startup, or by the first lookup that misses before that
+migration has succeeded.
+"""
+import argparse
+import threading
+
+from firebase_admin import firestore
+from config import configure_logging, db
+
+logger = configure_logging(__name__)
+
+DEVICE_KEYS_COLLECTION = "device_keys"
+
+_index = {}
+_lock = threading.Lock()
+_watch = None
+_legacy_checked = False
+_migrate_lock = threading.Lock()
+
+
+def _on_snapshot(col_snapshot, changes, read_time):
+    with _lock:
+        for change in changes:
+            if change.type.name == "REMOVED":
+                _index.pop(change.document.id, None)
+            else:
+                _index[change.document.id] = change.document.to_dict().get("email")
+    logger.debug("Device key index updated, %d keys", len(_index))
+
+
+def start_watch():
+    """Warm the reverse index and keep it current through a snapshot listener."""
+    global _watch
+    if _watch is None:
+        _watch = db.collection(DEVICE_KEYS_COLLECTION).on_snapshot(_on_snapshot)
+        logger.info("Device key listener started.")
+
+
+def stop_watch():
+    global _watch
+    if _watch is not None:
+        _watch.unsubscribe()
+        _watch = None
+
+
+def save_device_key(email, name, device_key):
+    db.collection(DEVICE_KEYS_COLLECTION).document(device_key).set({
+        "email": email,
+        "name": name,
+        "created_at": firestore.SERVER_TIMESTAMP
+    })
+    with _lock:
+        _index[device_key] = email
+
+
+def lookup_email(device_key):
+    """Email of the user owning ``device_key``, or ``None``."""
+    if not device_key:
+        return None
+    with _lock:
+        email = _index.get(device_key)
+    if email:
+        return email
+
+    doc = db.collection(DEVICE_KEYS_COLLECTION).document(device_key).get()
+    if doc.exists:
+        email = doc.to_dict().get("email")
+    elif not _legacy_checked:
+        # Keys registered before the per-key collection existed: migrate them once, then retry
+        try:
+            migrated = migrate_legacy_once()
+        except Exception as e:
+            logger.error("Legacy device key migration failed, will retry on the next miss: %s", e)
+            migrated = 0
+        if migrated:
+            doc = db.collection(DEVICE_KEYS_COLLECTION).document(device_key).get()
+            email = doc.to_dict().get("email") if doc.exists else None
+    if email:
+        with _lock:
+            _index[device_key] = email
+    return email
+
+
+def migrate_legacy_once():
+    """Run ``migrate_saved_keys`` unless it already succeeded in this process.
+
+    Concurrent callers wait for a migration in progress instead of starting
+    their own; a failed migration is retried by the next caller.
+    """
+    global _legacy_checked
+    with _migrate_lock:
+        if _legacy_checked:
+            return 0
+        migrated = migrate_saved_keys()
+        _legacy_checked = True
+        return migrated
+
+
+def migrate_in_background():
+    """Migrate legacy keys on a worker thread so no login request has to do it."""
+    def run():
+        try:
+            migrate_legacy_once()
+        except Exception as e:
+            logger.error("Legacy device key migration failed, lookups will retry it: %s", e)
+    threading.Thread(target=run, name="device-key-migration", daemon=True).start()
+
+
+def migrate_saved_keys():
+    """Copy entries of the legacy ``keys/saved_keys`` document into per-key documents."""
+    keys_doc = db.collection("keys").document("saved_keys").get()
+    if not keys_doc.exists:
+        return 0
+    migrated = 0
+    batch = db.batch()
+    for email, data in keys_doc.to_dict().items():
+        device_key = (data or {}).get("deviceKey")
+        if not device_key:
+            continue
+        ref = db.collection(DEVICE_KEYS_COLLECTION).document(device_key)
+        batch.set(ref, {"email": email, "name": data.get("name", ""), "created_at": firestore.SERVER_TIMESTAMP},
+                  merge=True)
+        migrated += 1
+        if migrated % 400 == 0:  # Firestore caps a batch at 500 writes
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    logger.info("Migrated %d device keys from keys/saved_keys", migrated)
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Device key index maintenance")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Copy keys/saved_keys entries into the device_keys collection")
+    args = parser.parse_args()
+    if args.migrate:
+        migrate_saved_keys()
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from config import configure_logging, INFERENCE_RETRY_AFTER_SECONDS
+
+logger = configure_logging(__name__)
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class BoundedExecutor:
+    """Thread pool that rejects work instead of queueing it without limit.
+
+    At most ``max_workers`` jobs run at once and ``max_queue`` more may wait;
+    anything beyond that raises ``QueueFullError`` so the caller can shed load.
+    """
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(f"{self.name} queue is full")
+            self.pending += 1
+        try:
+            future = self._pool.submit(self._call, functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+        # The slot is released when the job really finishes, even if the awaiting request is cancelled
+        future.add_done_callback(lambda _: self._release())
+        return await asyncio.wrap_future(future)
+
+    def _call(self, job):
+        with self._lock:
+            self.running += 1
+        try:
+            return job()
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def _release(self):
+        with self._lock:
+            self.pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.max_workers, "max_queue": self.max_queue, "running": self.running,
+                    "queued": self.pending - self.running, "rejected": self.rejected}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_inference(app, fn, *args, **kwargs):
+    """Run CPU/GPU-heavy work off the event loop; answers 503 when the inference queue is full."""
+    try:
+        return await app.state.inference_executor.run(fn, *args, **kwargs)
+    except QueueFullError:
+        logger.warning("Inference queue full, rejecting request")
+        raise HTTPException(status_code=503, detail="Server busy, please retry shortly",
+                            headers={"Retry-After": str(INFERENCE_RETRY_AFTER_SECONDS)})
+
+
+async def run_io(app, fn, *args, **kwargs):
+    """Run blocking network I/O (Cloudinary, Firestore) on its own pool."""
+    try:
+        return await app.state.io_executor.run(fn, *args, **kwargs)
+    except QueueFullError:
+        logger.warning("I/O queue full, rejecting request")
+        raise HTTPException(status_code=503, detail="Server busy, please retry shortly",
+                            headers={"Retry-After": str(INFERENCE_RETRY_AFTER_SECONDS)})
@@ -1,62 +1,203 @@
 import cv2
 import numpy as np
-import tempfile
-import os
 import torch
 from fastapi import HTTPException
 import onnxruntime as ort
 from config import configure_logging
+from services.detection import detect_faces, detect_source_faces
+from services.metrics import span
 
 logger = configure_logging(__name__)
 
 
 
-def process_face_swap(source_img: np.ndarray, target_img: np.ndarray, face_swapper, face_analyzer) -> np.ndarray:
+def get_source_faces(source_entry, face_analyzer):
+    """Faces detected in a cached source image; detection only runs on first use."""
+    source_faces = source_entry.get("faces")
+    if source_faces is None:
+        with span("detection"):
+            source_faces = detect_source_faces(face_analyzer, source_entry["image"])
+        if not source_faces:
+            logger.error("No faces detected in source image")
+            raise ValueError("No faces detected in source image")
+        source_entry["faces"] = source_faces
+    return source_faces
+
+def get_headswap_source(source_entry, headswap_model):
+    """Aligned and preprocessed HeadSwap source tensor for a cached source image."""
+    src_inp = source_entry.get("headswap_src")
+    if src_inp is None:
+        try:
+            src_inp = headswap_model.prepare_source(source_entry["image"], crop_align=True)
+        except ValueError as e:
+            logger.error("No head detected in source image: %s", e)
+            raise HTTPException(status_code=400, detail="No head detected in source image")
+        source_entry["headswap_src"] = src_inp
+    return src_inp
+
+def _inswapper_inputs(face_swapper, img, target_face, source_face):
+    """Aligned crop, its affine and the network inputs InSwapper.get would build for one face."""
+    from insightface.utils import face_align
+    aimg, M = face_align.norm_crop2(img, target_face.kps, face_swapper.input_size[0])
+    blob = cv2.dnn.blobFromImage(aimg, 1.0 / face_swapper.input_std, face_swapper.input_size,
+                                 (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean),
+                                 swapRB=True)
+    latent = source_face.normed_embedding.reshape((1, -1))
+    latent = np.dot(latent, face_swapper.emap)
+    latent /= np.linalg.norm(latent)
+    return aimg, M, blob, latent
+
+def _inswapper_run(face_swapper, blobs, latents):
+    """Run the InSwapper session once over all crops (one by one if its batch dimension is fixed)."""
+    batch_dim = face_swapper.session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim == 1:
+        preds = [face_swapper.session.run(face_swapper.output_names,
+                                          {face_swapper.input_names[0]: blob,
+                                           face_swapper.input_names[1]: latent})[0]
+                 for blob, latent in zip(blobs, latents)]
+        pred = np.concatenate(preds)
+    else:
+        pred = face_swapper.session.run(face_swapper.output_names,
+                                        {face_swapper.input_names[0]: np.concatenate(blobs),
+                                         face_swapper.input_names[1]: np.concatenate(latents).astype(np.float32)})[0]
+    img_fake = pred.transpose((0, 2, 3, 1))
+    return [np.clip(255 * fake, 0, 255).astype(np.uint8)[:, :, ::-1] for fake in img_fake]
+
+def _paste_back(target_img, bgr_fake, aimg, M):
+    """Soft-mask paste back as in InSwapper.get(paste_back=True), written into ``target_img`` in place.
+
+    Only the region the aligned crop maps onto (padded by the blur radius) is
+    warped, masked and blended, instead of the whole frame once per face.
+    """
+    IM = cv2.invertAffineTransform(M)
+    h, w = aimg.shape[:2]
+    corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]], dtype=np.float64) @ IM.T
+    (x0, y0), (x1, y1) = np.floor(corners.min(axis=0)), np.ceil(corners.max(axis=0))
+    # The blur kernel below never exceeds this, so the padded ROI sees the same borders as the full frame
+    pad = int(max(x1 - x0, y1 - y0)) // 20 + 7
+    x0, y0 = max(int(x0) - pad, 0), max(int(y0) - pad, 0)
+    x1, y1 = min(int(x1) + pad, target_img.shape[1]), min(int(y1) + pad, target_img.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return target_img
+    IM[:, 2] -= (x0, y0)
+    roi_size = (x1 - x0, y1 - y0)
+    img_white = np.full((h, w), 255, dtype=np.float32)
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, roi_size, borderValue=0.0)
+    img_white = cv2.warpAffine(img_white, IM, roi_size, borderValue=0.0)
+    img_white[img_white > 20] = 255
+    img_mask = img_white
+    mask_h_inds, mask_w_inds = np.where(img_mask == 255)
+    if not len(mask_h_inds):
+        return target_img
+    mask_h = np.max(mask_h_inds) - np.min(mask_h_inds)
+    mask_w = np.max(mask_w_inds) - np.min(mask_w_inds)
+    mask_size = int(np.sqrt(mask_h * mask_w))
+    k = max(mask_size // 10, 10)
+    img_mask = cv2.erode(img_mask, np.ones((k, k), np.uint8), iterations=1)
+    k = max(mask_size // 20, 5)
+    blur_size = (2 * k + 1, 2 * k + 1)
+    img_mask = cv2.GaussianBlur(img_mask, blur_size, 0)
+    img_mask /= 255
+    img_mask = np.reshape(img_mask, [img_mask.shape[0], img_mask.shape[1], 1])
+    roi = target_img[y0:y1, x0:x1]
+    roi[:] = (img_mask * bgr_fake + (1 - img_mask) * roi.astype(np.float32)).astype(np.uint8)
+    return target_img
+
+def select_faces(faces, face_select=None):
+    """Target faces to swap according to ``face_select`` (see routes/faceswap.parse_face_select).
+
+    ``order`` is "size" (largest bbox first) or "index" (left to right);
+    ``indices`` picks faces by their position in that order and ``max_faces``
+    caps how many are kept.
+    """
+    if not face_select:
+        return faces
+    if face_select.get("order", "size") == "size":
+        ordered = sorted(faces, key=lambda f: -(f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]))
+    else:
+        ordered = sorted(faces, key=lambda f: f.bbox[0])
+    if face_select.get("indices") is not None:
+        ordered = [ordered[i] for i in face_select["indices"] if -len(ordered) <= i < len(ordered)]
+    if face_select.get("max_faces"):
+        ordered = ordered[:face_select["max_faces"]]
+    return ordered
+
+def process_face_swap_batch(jobs, face_swapper, face_analyzer, face_selects=None):
+    """Swap several ``(source_faces, target_img, target_faces)`` jobs with a single InSwapper session run.
+
+    ``target_faces`` may be ``None`` to detect them here; ``face_selects``
+    optionally holds one ``select_faces`` spec per job. All crops of all jobs
+    go through the session together, then each job's faces are pasted into a
+    single copy of its target. Returns one result image per job, or the
+    exception that job failed with.
+    """
+    results = [None] * len(jobs)
+    crops = []  # (job index, target face, aimg, M)
+    blobs, latents = [], []
+    for idx, (source_faces, target_img, target_faces) in enumerate(jobs):
+        try:
+            if not source_faces:
+                raise ValueError("No faces detected in source image")
+            if target_faces is None:
+                with span("detection"):
+                    target_faces = detect_faces(face_analyzer, target_img)
+            if not target_faces:
+                logger.error("No faces detected in target image")
+                raise ValueError("No faces detected in target image")
+            if face_selects is not None:
+                target_faces = select_faces(target_faces, face_selects[idx])
+                if not target_faces:
+                    raise ValueError("No target faces match the face selection")
+            for face in target_faces:
+                aimg, M, blob, latent = _inswapper_inputs(face_swapper, target_img, face, source_faces[0])
+                crops.append((idx, face, aimg, M))
+                blobs.append(blob)
+                latents.append(latent)
+        except Exception as e:
+            results[idx] = e
+    if not crops:
+        return results
+
+    logger.debug("Running InSwapper on %d face crops from %d images", len(crops), len(jobs))
+    try:
+        with span("inswapper"):
+            fakes = _inswapper_run(face_swapper, blobs, latents)
+    except Exception as e:
+        logger.exception("InSwapper batch failed: %s", e)
+        return [result if result is not None else e for result in results]
+
+    for (idx, face, aimg, M), bgr_fake in zip(crops, fakes):
+        if isinstance(results[idx], Exception):
+            continue
+        if results[idx] is None:
+            results[idx] = jobs[idx][1].copy()
+        logger.debug("Pasting swapped face with target face bbox: %s", getattr(face, "bbox", "unknown"))
+        with span("paste"):
+            _paste_back(results[idx], bgr_fake, aimg, M)
+    return results
+
+def process_face_swap(source_img: np.ndarray, target_img: np.ndarray, face_swapper, face_analyzer,
+                      source_faces=None, target_faces=None, face_select=None) -> np.ndarray:
     logger.info("Starting face swap process with InSwapper")
-    source_faces = face_analyzer.get(source_img)
+    if source_faces is None:
+        source_faces = detect_source_faces(face_analyzer, source_img)
     if not source_faces:
         logger.error("No faces detected in source image")
         raise ValueError("No faces detected in source image")
-    target_faces = face_analyzer.get(target_img)
-    if not target_faces:
-        logger.error("No faces detected in target image")
-        raise ValueError("No faces detected in target image")
-    result = target_img.copy()
-    for face in target_faces:
-        logger.info("Swapping face with target face bbox: %s", getattr(face, "bbox", "unknown"))
-        result = face_swapper.get(result, face, source_faces[0], paste_back=True)
-    
+    result = process_face_swap_batch([(source_faces, target_img, target_faces)], face_swapper, face_analyzer,
+                                     [face_select])[0]
+    if isinstance(result, Exception):
+        raise result
     
     logger.info("Face swap process completed successfully")
     return result
 
-def process_head_swap(src_bytes, tgt_bytes, headswap_model):
+def process_head_swap(src_img, tgt_img, headswap_model, src_inp=None, tgt_prep=None):
     logger.info("Processing source and target images for HeadSwap")
-    src_array = np.frombuffer(src_bytes, np.uint8)
-    tgt_array = np.frombuffer(tgt_bytes, np.uint8)
-    src_img = cv2.imdecode(src_array, cv2.IMREAD_COLOR)
-    tgt_img = cv2.imdecode(tgt_array, cv2.IMREAD_COLOR)
-    if src_img is None or tgt_img is None:
-        logger.error("One or both images could not be decoded")
-        raise HTTPException(status_code=400, detail="One or both images could not be decoded")
-    
-    src_temp = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
-    tgt_temp = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
-    src_temp_name = src_temp.name
-    tgt_temp_name = tgt_temp.name
-    src_temp.close()
-    tgt_temp.close()
-    
     try:
-        if not cv2.imwrite(src_temp_name, src_img):
-            logger.error("Failed to write source image")
-            raise HTTPException(status_code=500, detail="Failed to write source image")
-        if not cv2.imwrite(tgt_temp_name, tgt_img):
-            logger.error("Failed to write target image")
-            raise HTTPException(status_code=500, detail="Failed to write target image")
-        
         logger.info("Running HeadSwap model")
-        result_img = headswap_model.run_single(src_temp_name, tgt_temp_name, crop_align=True, cat=True)
+        result_img = headswap_model.run_arrays(src_img, tgt_img, crop_align=True, cat=True,
+                                             src_inp=src_inp, tgt_prep=tgt_prep)
         
         logger.info("HeadSwap processing completed successfully")
         return result_img
@@ -65,14 +206,83 @@ def process_head_swap(src_bytes, tgt_bytes, headswap_model):
         logger.exception(f"Error processing images: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        try:
-            os.remove(src_temp_name)
-            os.remove(tgt_temp_name)
-        except Exception as e:
-            logger.warning(f"Error removing temporary files: {str(e)}")
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
 
+def process_head_swap_batch(jobs, headswap_model):
+    """Swap several ``(src_img, tgt_img, src_inp, tgt_prep)`` jobs in one batched HeadSwap pass.
+
+    Writable target images are blended in place; shared read-only ones
+    (memory-mapped templates) are copied first.
+
+    Returns one result image per job, or the exception that job failed with.
+    """
+    try:
+        logger.info("Running HeadSwap model on a batch of %d", len(jobs))
+        results = headswap_model.run_batch([job[0] for job in jobs], [job[1] for job in jobs],
+                                           crop_align=True, cat=True,
+                                           src_inps=[job[2] for job in jobs], tgt_preps=[job[3] for job in jobs],
+                                           inplace=True)
+        return [result if error is None else HTTPException(status_code=500, detail=error)
+                for result, error in results]
+    finally:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def run_swap_batch(state, model, jobs):
+    """Blocking swap pipeline for ``(source_entry, target_img, template, mode, face_select)`` jobs of one model.
+
+    Uses the models on ``state`` (the app state) and returns one result image
+    per job, or the exception that job failed with.
+    """
+    results = [None] * len(jobs)
+    batch_idx, batch_jobs, face_selects = [], [], []
+    if model == "inswapper":
+        face_swapper = state.face_swapper
+        face_analyzer = state.face_analyzer
+        if face_swapper is None or face_analyzer is None:
+            logger.error("InSwapper model or analyzer not available.")
+            raise HTTPException(status_code=501, detail="InSwapper model not available")
+        for idx, (source_entry, target_img, template, _, face_select) in enumerate(jobs):
+            try:
+                source_faces = get_source_faces(source_entry, face_analyzer)
+            except Exception as e:
+                results[idx] = e
+                continue
+            batch_idx.append(idx)
+            batch_jobs.append((source_faces, target_img, template["faces"] if template else None))
+            face_selects.append(face_select)
+        batch_results = (process_face_swap_batch(batch_jobs, face_swapper, face_analyzer, face_selects)
+                         if batch_jobs else [])
+    elif model == "headswap":
+        headswap_model = state.headswap_model
+        if headswap_model is None:
+            logger.error("HeadSwap model not available.")
+            raise HTTPException(status_code=501, detail="HeadSwap model not available")
+        for idx, (source_entry, target_img, template, _, _) in enumerate(jobs):
+            try:
+                src_inp = get_headswap_source(source_entry, headswap_model)
+            except Exception as e:
+                results[idx] = e
+                continue
+            batch_idx.append(idx)
+            batch_jobs.append((source_entry["image"], target_img, src_inp, template["tgt_prep"] if template else None))
+        batch_results = process_head_swap_batch(batch_jobs, headswap_model) if batch_jobs else []
+    else:
+        raise HTTPException(status_code=400, detail="Invalid model selection")
+
+    for idx, result in zip(batch_idx, batch_results):
+        if not isinstance(result, Exception) and jobs[idx][3] == "landscape":
+            result = convert_to_landscape(result)
+        results[idx] = result
+    return results
+
+def run_swap(state, model, source_entry, target_img, template, mode, face_select=None):
+    result = run_swap_batch(state, model, [(source_entry, target_img, template, mode, face_select)])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
 def convert_to_landscape(img, target_size=(1920, 1080)):
     logger.info("Converting image to landscape with target_size: %s", target_size)
     return cv2.resize(img, target_size)
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""Append-only login log written by a single background thread.
+
+Each login is one JSON line in ``login.jsonl``. The file is rotated to
+``login.1.jsonl`` ... ``login.<LOGIN_LOG_BACKUPS>.jsonl`` once it grows past
+``LOGIN_LOG_MAX_BYTES``. ``latest.json`` holds the newest entry overall and
+per email, so readers (e.g. testGUI) never have to scan the history:
+
+    {"latest": {...}, "by_email": {"user@example.com": {...}}}
+
+With ``--workers`` every process has its own writer thread. Each batch is
+written while holding an exclusive lock on ``login.lock``, and ``latest.json``
+is re-read under that lock before it is updated, so appends, rotation and
+the index never race between processes.
+"""
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no --workers mode, so a single process writes
+    fcntl = None
+
+from config import configure_logging, LOGIN_LOG_DIR, LOGIN_LOG_MAX_BYTES, LOGIN_LOG_BACKUPS, LOGIN_LOG_QUEUE_SIZE
+
+logger = configure_logging(__name__)
+
+LOG_NAME = "login.jsonl"
+LATEST_NAME = "latest.json"
+LEGACY_NAME = "login.json"
+LOCK_NAME = "login.lock"
+
+_STOP = object()
+
+
+class LoginLog:
+    def __init__(self, directory=LOGIN_LOG_DIR, max_bytes=LOGIN_LOG_MAX_BYTES, backups=LOGIN_LOG_BACKUPS,
+                 queue_size=LOGIN_LOG_QUEUE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.path = os.path.join(directory, LOG_NAME)
+        self.latest_path = os.path.join(directory, LATEST_NAME)
+        self.lock_path = os.path.join(directory, LOCK_NAME)
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def record(self, entry):
+        """Queue ``entry`` for writing; never blocks the caller on disk I/O.
+
+        If the writer has fallen a whole queue behind, the entry is dropped
+        with an error rather than growing memory without bound.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            logger.error("Login log queue full, dropping entry for %s", entry.get("email"))
+
+    def close(self):
+        """Write everything queued so far and stop the writer thread."""
+        with self._start_lock:
+            if self._thread is None:
+                return
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="login-log", daemon=True)
+                    self._thread.start()
+
+    def _load_latest(self):
+        try:
+            with open(self.latest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        latest = {"latest": None, "by_email": {}}
+        # Seed the index once from the old read-modify-write login.json
+        try:
+            with open(os.path.join(self.directory, LEGACY_NAME)) as f:
+                legacy = json.load(f)
+            for entry in legacy if isinstance(legacy, list) else [legacy]:
+                self._index(latest, entry)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        return latest
+
+    @staticmethod
+    def _index(latest, entry):
+        stamp = entry.get("loginTimestamp", "")
+        if latest["latest"] is None or stamp >= latest["latest"].get("loginTimestamp", ""):
+            latest["latest"] = entry
+        email = entry.get("email")
+        if email:
+            latest["by_email"][email] = entry
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stopping = False
+        while not stopping:
+            entries = [self._queue.get()]
+            # Drain whatever else is waiting so a burst of logins costs one sidecar rewrite
+            while True:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in entries:
+                stopping = True
+                entries = [entry for entry in entries if entry is not _STOP]
+            if not entries:
+                continue
+            try:
+                self._write(entries)
+            except Exception as e:
+                # Keep the writer alive: a bad batch must not stop every later login from being logged
+                logger.exception("Failed to write login log: %s", e)
+
+    def _write(self, entries):
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with self._locked():
+            # Other processes may have updated the index since our last batch
+            latest = self._load_latest()
+            with open(self.path, "a") as f:
+                f.write(lines)
+            for entry in entries:
+                self._index(latest, entry)
+            if os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+            tmp_path = f"{self.latest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(latest, f)
+            os.replace(tmp_path, self.latest_path)
+
+    def _rotate(self):
+        base = os.path.join(self.directory, "login")
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{base}.{i}.jsonl"):
+                os.replace(f"{base}.{i}.jsonl", f"{base}.{i + 1}.jsonl")
+        if self.backups > 0:
+            os.replace(self.path, f"{base}.1.jsonl")
+        else:
+            os.remove(self.path)
+        logger.info("Rotated login log %s", self.path)
+
+
+login_log = LoginLog()
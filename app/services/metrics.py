@@ -0,0 +1,136 @@
+"""Per-stage latency histograms and gauges, exported in Prometheus text format.
+
+Code times a pipeline stage with ``with span("detection"): ...``; every
+observation lands in the ``faceswap_stage_seconds`` histogram under its stage
+label. Queue depths, in-flight counts and cache counters are read from their
+owners at scrape time through ``register_gauge``. Each histogram also keeps
+its most recent raw samples for percentile reports. With ``--workers`` every
+process keeps its own metrics.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS, max_samples=2048):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+            self.samples.append(value)
+
+    def percentile(self, q):
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Metrics:
+    def __init__(self):
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._help = {}
+        self._gauges = []  # (name, help, type, fn returning {labels: value})
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text="", buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(buckets))
+                self._help.setdefault(name, help_text)
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.histogram("faceswap_stage_seconds", "Time spent per swap pipeline stage", stage=stage).observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def register_gauge(self, name, help_text, fn, metric_type="gauge"):
+        """``fn`` returns a number, or ``{labels: value}`` with labels as ``((name, value), ...)`` tuples."""
+        self._gauges.append((name, help_text, metric_type, fn))
+
+    def reset(self):
+        """Drop every recorded observation (benchmarks reset between cases)."""
+        with self._lock:
+            self._histograms.clear()
+
+    def _series(self):
+        """Snapshot of ``((name, labels), histogram)`` pairs; request threads add series concurrently."""
+        with self._lock:
+            return list(self._histograms.items())
+
+    def stage_percentiles(self, quantiles=(0.5, 0.95)):
+        report = {}
+        for (name, labels), histogram in self._series():
+            if name == "faceswap_stage_seconds" and histogram.count:
+                report[dict(labels)["stage"]] = {f"p{int(q * 100)}": histogram.percentile(q) for q in quantiles}
+        return report
+
+    def render(self):
+        lines = []
+        by_name = {}
+        for (name, labels), histogram in sorted(self._series(), key=lambda item: item[0]):
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name, series in by_name.items():
+            lines.append(f"# HELP {name} {self._help.get(name, '')}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                counts, total, count = histogram.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip(list(histogram.buckets) + ["+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {total}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+        for name, help_text, metric_type, fn in self._gauges:
+            try:
+                values = fn()
+            except Exception:
+                continue  # the owner is not initialised yet (e.g. during startup)
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in values.items():
+                if value is not None:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = Metrics()
+span = metrics.span
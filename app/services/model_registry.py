@@ -0,0 +1,114 @@
+"""Background model loading with per-model readiness.
+
+Every model is loaded on its own thread as soon as the lifespan starts, so the
+server accepts connections immediately. Each model moves from ``loading`` to
+``ready`` or ``failed``; completion callbacks run on the event loop, so they
+may start asyncio work such as the model's micro-batcher. Routes call
+``require_model`` to wait (up to ``MODEL_WAIT_TIMEOUT_SECONDS``) for a model
+that is still loading.
+"""
+import asyncio
+import threading
+import time
+
+from fastapi import HTTPException
+from config import configure_logging, MODEL_WAIT_TIMEOUT_SECONDS, INFERENCE_RETRY_AFTER_SECONDS
+
+logger = configure_logging(__name__)
+
+LOADING, READY, FAILED = "loading", "ready", "failed"
+
+
+class ModelRegistry:
+    """``loaders`` maps a model name to ``(load, on_ready)``: a blocking loader and a loop-side callback."""
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.states = {name: {"state": LOADING, "load_seconds": None, "error": None} for name in loaders}
+        self._events = {}
+        self._loop = None
+        self._started_at = None
+        self.all_done = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._started_at = time.perf_counter()
+        self._events = {name: asyncio.Event() for name in self.loaders}
+        self.all_done = asyncio.Event()
+        for name, (load, _) in self.loaders.items():
+            threading.Thread(target=self._load, args=(name, load), name=f"load-{name}", daemon=True).start()
+
+    def _load(self, name, load):
+        started = time.perf_counter()
+        logger.info("Starting initialization of %s model...", name)
+        try:
+            value, error = load(), None
+        except Exception as e:
+            logger.exception("%s model initialization failed: %s", name, e)
+            value, error = None, e
+        try:
+            self._loop.call_soon_threadsafe(self._finish, name, value, error, time.perf_counter() - started)
+        except RuntimeError:
+            logger.info("%s finished loading after shutdown", name)  # event loop already closed
+
+    def _finish(self, name, value, error, seconds):
+        state = self.states[name]
+        state["load_seconds"] = round(seconds, 2)
+        if error is None:
+            try:
+                self.loaders[name][1](value)
+            except Exception as e:
+                logger.exception("%s model setup failed: %s", name, e)
+                error = e
+        if error is None:
+            state["state"] = READY
+            logger.info("%s model ready after %.1fs", name, seconds)
+        else:
+            state["state"] = FAILED
+            state["error"] = str(error)
+            logger.warning("%s functionality will be disabled.", name)
+        self._events[name].set()
+        if all(event.is_set() for event in self._events.values()):
+            self.all_done.set()
+            logger.info("Model loading finished in %.1fs: %s", time.perf_counter() - self._started_at,
+                        {name: s["state"] for name, s in self.states.items()})
+            if not self.any_ready():
+                logger.error("Failed to initialize any model. Application cannot function.")
+
+    def state(self, name):
+        return self.states[name]["state"]
+
+    def any_ready(self):
+        return any(s["state"] == READY for s in self.states.values())
+
+    def is_ready(self):
+        """True once every model has settled and at least one of them is usable."""
+        return self.all_done is not None and self.all_done.is_set() and self.any_ready()
+
+    def all_failed(self):
+        """True once every model has settled and none of them loaded: the app cannot serve swaps."""
+        return self.all_done is not None and self.all_done.is_set() and not self.any_ready()
+
+    async def wait(self, name, timeout=MODEL_WAIT_TIMEOUT_SECONDS):
+        """Wait until ``name`` settles; returns its state (still ``loading`` on timeout)."""
+        if self.state(name) == LOADING:
+            try:
+                await asyncio.wait_for(self._events[name].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.state(name)
+
+    def stats(self):
+        return {name: dict(s) for name, s in self.states.items()}
+
+
+async def require_model(app, name, label=None):
+    """Wait for a model to finish loading: 503 if it is still loading, 501 if it failed."""
+    label = label or name
+    state = await app.state.models.wait(name)
+    if state == LOADING:
+        raise HTTPException(status_code=503, detail=f"{label} model is still loading, please retry shortly",
+                            headers={"Retry-After": str(INFERENCE_RETRY_AFTER_SECONDS)})
+    if state == FAILED:
+        logger.error("%s model not available.", label)
+        raise HTTPException(status_code=501, detail=f"{label} model not available")
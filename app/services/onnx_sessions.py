@@ -0,0 +1,165 @@
+import os
+import threading
+
+from config import (configure_logging, ORT_INTRA_OP_THREADS, ORT_INTER_OP_THREADS, ORT_GRAPH_OPTIMIZATION,
+                    ORT_OPTIMIZED_MODEL_DIR, ORT_ENABLE_CPU_MEM_ARENA, ORT_ENABLE_MEM_PATTERN)
+
+logger = configure_logging(__name__)
+
+_report = []
+_report_lock = threading.Lock()
+_intra_op_threads = ORT_INTRA_OP_THREADS
+
+
+def set_intra_op_threads(threads):
+    """Override the per-session intra-op thread count, e.g. with a worker process's share of the cores."""
+    global _intra_op_threads
+    _intra_op_threads = threads
+
+
+def get_providers():
+    import onnxruntime as ort
+    providers = ['CPUExecutionProvider']
+    if 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    return providers
+
+
+def make_session_options(optimization=ORT_GRAPH_OPTIMIZATION):
+    import onnxruntime as ort
+    levels = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = _intra_op_threads
+    so.inter_op_num_threads = ORT_INTER_OP_THREADS
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.graph_optimization_level = levels[optimization]
+    so.enable_cpu_mem_arena = ORT_ENABLE_CPU_MEM_ARENA
+    so.enable_mem_pattern = ORT_ENABLE_MEM_PATTERN
+    return so
+
+
+def _optimized_model_path(model_path, providers):
+    # Optimised graphs can contain provider-specific fused nodes, so cache them per provider set
+    tag = "cuda" if "CUDAExecutionProvider" in providers else "cpu"
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(ORT_OPTIMIZED_MODEL_DIR, f"{name}.{ORT_GRAPH_OPTIMIZATION}.{tag}.onnx")
+
+
+def create_session(model_path, providers=None):
+    """Create an ONNX Runtime session with the app-wide threading/optimisation settings.
+
+    When ORT_OPTIMIZED_MODEL_DIR is set the optimised graph is serialised on
+    first use and loaded directly (with optimisation disabled) afterwards. It
+    is written to a per-process temporary file and renamed into place, so
+    ``--workers`` processes starting cold together never load a partial file.
+    """
+    import onnxruntime as ort
+    providers = providers or get_providers()
+    load_path = model_path
+    so = make_session_options()
+    cached = False
+    tmp_path = None
+    if ORT_OPTIMIZED_MODEL_DIR and ORT_GRAPH_OPTIMIZATION != "disable":
+        optimized_path = _optimized_model_path(model_path, providers)
+        if os.path.exists(optimized_path) and os.path.getmtime(optimized_path) >= os.path.getmtime(model_path):
+            load_path = optimized_path
+            so = make_session_options("disable")
+            cached = True
+        else:
+            os.makedirs(ORT_OPTIMIZED_MODEL_DIR, exist_ok=True)
+            tmp_path = f"{optimized_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            so.optimized_model_filepath = tmp_path
+    try:
+        session = ort.InferenceSession(load_path, sess_options=so, providers=providers)
+        if tmp_path is not None:
+            os.replace(tmp_path, optimized_path)
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with _report_lock:
+        _report.append({
+            "model": os.path.basename(model_path),
+            "loaded_from": load_path,
+            "optimized_cache_hit": cached,
+            "providers": session.get_providers(),
+            "intra_op_threads": so.intra_op_num_threads,
+            "inter_op_threads": so.inter_op_num_threads,
+            "graph_optimization": "disable (pre-optimised)" if cached else ORT_GRAPH_OPTIMIZATION,
+            "cpu_mem_arena": so.enable_cpu_mem_arena,
+            "mem_pattern": so.enable_mem_pattern,
+        })
+    return session
+
+
+def _insightface_task(model_path):
+    """Task of an insightface model file, routed like ``model_zoo.get_model`` but without building a session."""
+    import onnx
+    graph = onnx.load(model_path, load_external_data=False).graph
+    initializers = {init.name for init in graph.initializer}
+    inputs = [i for i in graph.input if i.name not in initializers]
+    shape = [d.dim_value if d.HasField("dim_value") else d.dim_param for d in inputs[0].type.tensor_type.shape.dim]
+    if len(graph.output) >= 5:
+        return "detection"
+    if shape[2] == 192 and shape[3] == 192:
+        return "landmark"  # 2d_106 or 3d_68, only known once the model is built
+    if shape[2] == 96 and shape[3] == 96:
+        return "genderage"
+    if len(inputs) == 2 and shape[2] == 128 and shape[3] == 128:
+        return "inswapper"
+    if isinstance(shape[2], int) and shape[2] == shape[3] and shape[2] >= 112 and shape[2] % 16 == 0:
+        return "recognition"
+    return None
+
+
+def build_face_analyzer(allowed_modules, providers=None, name="buffalo_l", root="~/.insightface"):
+    """``FaceAnalysis`` over the ``allowed_modules`` models of pack ``name``, built on factory-made sessions.
+
+    ``FaceAnalysis()`` itself opens a default session for every file of the
+    pack just to find out what it is; here files are classified from their
+    graph and only the allowed models get a session, created once.
+    """
+    import glob
+    from insightface.app import FaceAnalysis
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+    from insightface.model_zoo.attribute import Attribute
+    from insightface.model_zoo.landmark import Landmark
+    from insightface.model_zoo.retinaface import RetinaFace
+    from insightface.utils.storage import ensure_available
+    classes = {"detection": RetinaFace, "recognition": ArcFaceONNX, "genderage": Attribute, "landmark": Landmark}
+    models = {}
+    for model_file in sorted(glob.glob(os.path.join(ensure_available("models", name, root=root), "*.onnx"))):
+        task = _insightface_task(model_file)
+        if task not in classes:
+            continue
+        if task == "landmark":
+            if not any(module.startswith("landmark") for module in allowed_modules):
+                continue
+        elif task not in allowed_modules or task in models:
+            continue
+        model = classes[task](model_file=model_file, session=create_session(model_file, providers))
+        if model.taskname in allowed_modules and model.taskname not in models:
+            models[model.taskname] = model
+    if "detection" not in models:
+        raise FileNotFoundError(f"No face detection model found in insightface pack {name}")
+    analyzer = FaceAnalysis.__new__(FaceAnalysis)
+    analyzer.models = models
+    analyzer.det_model = models["detection"]
+    return analyzer
+
+
+def session_report():
+    with _report_lock:
+        return list(_report)
+
+
+def log_session_report():
+    for entry in session_report():
+        logger.info("ONNX session %(model)s: providers=%(providers)s intra=%(intra_op_threads)d "
+                    "inter=%(inter_op_threads)d optimisation=%(graph_optimization)s "
+                    "arena=%(cpu_mem_arena)s mem_pattern=%(mem_pattern)s from %(loaded_from)s", entry)
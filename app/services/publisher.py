@@ -0,0 +1,277 @@
+"""Disk-backed background queue for publishing QR results.
+
+A job is the encoded result image plus a JSON state file in ``PUBLISH_DIR``.
+The request returns as soon as both are written; a worker thread then uploads
+the image to Cloudinary and stores the ``face_swaps`` Firestore record,
+retrying with exponential backoff. Every pending job records the pid of the
+process working on it; a process adopts pending jobs whose owner is gone
+(at startup and then every ``PUBLISH_PRUNE_INTERVAL_SECONDS``), so results
+survive a restart of the app or of one ``--workers`` process without two
+processes uploading the same job. Until the upload finishes the image is
+served locally (see routes/results.py); afterwards the local URL redirects to
+the CDN link.
+
+Only pending jobs are kept in memory; the status of finished and failed jobs
+is read back from their state file, which is deleted after
+``PUBLISH_RETENTION_SECONDS``.
+"""
+import heapq
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single process only, nothing to coordinate
+    fcntl = None
+
+from firebase_admin import firestore
+from config import (configure_logging, db, PUBLISH_DIR, PUBLISH_MAX_ATTEMPTS, PUBLISH_BACKOFF_SECONDS,
+                    PUBLISH_MAX_BACKOFF_SECONDS, PUBLISH_RETENTION_SECONDS, PUBLISH_PRUNE_INTERVAL_SECONDS)
+from services.cloudinary import upload_to_cloudinary
+from services.metrics import span
+
+logger = configure_logging(__name__)
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Publisher:
+    def __init__(self, directory=PUBLISH_DIR, max_attempts=PUBLISH_MAX_ATTEMPTS, backoff=PUBLISH_BACKOFF_SECONDS,
+                 max_backoff=PUBLISH_MAX_BACKOFF_SECONDS, retention=PUBLISH_RETENTION_SECONDS,
+                 prune_interval=PUBLISH_PRUNE_INTERVAL_SECONDS):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._jobs = {}  # pending jobs only
+        self._finished = {DONE: 0, FAILED: 0}
+        self._due = []  # heap of (due_at, job_id)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._next_scan = None
+        self._prunes = False
+        self.lock_path = os.path.join(directory, "publish.lock")
+
+    def start(self, prune=True):
+        """Start the worker thread, adopting pending jobs on disk whose owner process is gone.
+
+        Only a process started with ``prune`` deletes expired jobs, so
+        ``--workers`` processes do not all prune the shared directory.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._prunes = prune
+        resumed = self._adopt_orphans()
+        self._next_scan = time.time() if prune else time.time() + self.prune_interval
+        self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+        self._thread.start()
+        logger.info("Result publisher started, %d pending job(s) resumed", resumed)
+
+    def stop(self, timeout=5.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            # An upload in flight is simply retried after the next start
+            self._thread.join(timeout)
+
+    def submit(self, img_bytes, folder, record=None):
+        """Persist a result for publishing and return its job id."""
+        job_id = uuid.uuid4().hex
+        image_path = self.image_path(job_id)
+        with open(image_path + ".tmp", "wb") as f:
+            f.write(img_bytes)
+        os.replace(image_path + ".tmp", image_path)
+        job = {"id": job_id, "status": PENDING, "folder": folder, "record": record, "attempts": 0,
+               "url": None, "error": None, "created_at": time.time(), "next_attempt_at": 0,
+               "owner": os.getpid()}
+        self._save(job)
+        with self._cond:
+            self._jobs[job_id] = job
+            heapq.heappush(self._due, (0, job_id))
+            self._cond.notify()
+        return job_id
+
+    def status(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        # Finished jobs, and jobs submitted by another worker process, are only known through their state file
+        try:
+            with open(os.path.join(self.directory, f"{os.path.basename(job_id)}.json")) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def image_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.jpg")
+
+    def stats(self):
+        with self._cond:
+            return {PENDING: len(self._jobs), **self._finished}
+
+    def _save(self, job):
+        path = os.path.join(self.directory, f"{job['id']}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(job, f)
+        os.replace(path + ".tmp", path)
+
+    def _scan(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    yield json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning("Skipping unreadable publish job %s: %s", name, e)
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock across processes sharing the directory, held while jobs change owner."""
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _is_orphan(self, job):
+        owner = job.get("owner")
+        if owner == os.getpid():
+            # Our pid but not our job: left behind by an earlier process that had the same pid
+            with self._cond:
+                return job["id"] not in self._jobs
+        return owner is None or not _pid_alive(owner)
+
+    def _adopt_orphans(self):
+        """Claim pending jobs whose owner process has exited and queue them here."""
+        adopted = []
+        with self._locked():
+            # Owners are read and rewritten under the lock, so two processes never adopt the same job
+            for job in self._scan():
+                if job["status"] == PENDING and self._is_orphan(job):
+                    job["owner"] = os.getpid()
+                    self._save(job)
+                    adopted.append(job)
+        with self._cond:
+            for job in adopted:
+                self._jobs[job["id"]] = job
+                heapq.heappush(self._due, (job.get("next_attempt_at", 0), job["id"]))
+            if adopted:
+                self._cond.notify()
+        return len(adopted)
+
+    def _prune(self):
+        """Delete finished and failed jobs older than the retention period."""
+        cutoff = time.time() - self.retention
+        removed = 0
+        for job in self._scan():
+            if job["status"] == PENDING or job.get("finished_at", job["created_at"]) > cutoff:
+                continue
+            for path in (os.path.join(self.directory, f"{job['id']}.json"), self.image_path(job["id"])):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning("Could not remove %s: %s", path, e)
+            removed += 1
+        if removed:
+            logger.info("Pruned %d expired publish job(s)", removed)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.time()
+                    if self._next_scan is not None and self._next_scan <= now:
+                        break
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    wake_at = min([t for t in (self._next_scan, self._due[0][0] if self._due else None)
+                                   if t is not None], default=None)
+                    self._cond.wait(wake_at - now if wake_at is not None else None)
+                if self._stopping:
+                    return
+                scan = self._next_scan is not None and self._next_scan <= time.time()
+                if scan:
+                    self._next_scan = time.time() + self.prune_interval
+                    job = None
+                else:
+                    _, job_id = heapq.heappop(self._due)
+                    # Work on a copy; the shared dict is only replaced under the lock
+                    job = dict(self._jobs[job_id])
+            if scan:
+                try:
+                    adopted = self._adopt_orphans()
+                    if adopted:
+                        logger.info("Adopted %d pending publish job(s) from exited processes", adopted)
+                    if self._prunes:
+                        self._prune()
+                except Exception as e:
+                    logger.exception("Scanning publish jobs failed: %s", e)
+            else:
+                self._attempt(job)
+
+    def _attempt(self, job):
+        try:
+            if not job["url"]:
+                with open(self.image_path(job["id"]), "rb") as f, span("upload"):
+                    upload_result = upload_to_cloudinary(f.read(), job["folder"])
+                # Keep the CDN link even if the record write below fails, so a retry does not upload twice
+                job["url"] = upload_result.get("secure_url", "").replace("/upload/", "/upload/fl_attachment/")
+            if job["record"] is not None:
+                with span("firestore"):
+                    db.collection('face_swaps').document(job["id"]).set(
+                        dict(job["record"], image_url=job["url"], created_at=firestore.SERVER_TIMESTAMP))
+                logger.info("Face swap result stored in Firestore for user: %s", job["record"].get("user"))
+        except Exception as e:
+            job["attempts"] += 1
+            job["error"] = str(e)
+            if job["attempts"] >= self.max_attempts:
+                job["status"] = FAILED
+                logger.error("Publishing %s failed after %d attempts: %s", job["id"], job["attempts"], e)
+            else:
+                delay = min(self.max_backoff, self.backoff * 2 ** (job["attempts"] - 1))
+                job["next_attempt_at"] = time.time() + delay
+                logger.warning("Publishing %s failed (attempt %d), retrying in %.0fs: %s",
+                               job["id"], job["attempts"], delay, e)
+        else:
+            job["status"] = DONE
+            job["error"] = None
+        if job["status"] != PENDING:
+            job["finished_at"] = time.time()
+        with self._cond:
+            self._save(job)
+            if job["status"] == PENDING:
+                self._jobs[job["id"]] = job
+                heapq.heappush(self._due, (job["next_attempt_at"], job["id"]))
+            else:
+                self._jobs.pop(job["id"], None)
+                self._finished[job["status"]] += 1
+        if job["status"] == DONE:
+            try:
+                os.remove(self.image_path(job["id"]))
+            except OSError:
+                pass
+            logger.info("Published %s to %s", job["id"], job["url"])
@@ -0,0 +1,131 @@
+"""Local cache of gallery template images, so clients can send a URL instead of the image.
+
+Encoded images are kept on disk in ``TEMPLATE_CACHE_DIR`` as ``<sha1(url)>.img``
+and evicted least-recently-used once the directory grows past
+``TEMPLATE_CACHE_MAX_BYTES``. Only decoded arrays are kept in memory; they
+are marked read-only because the same array is shared by concurrent swaps.
+At startup the cache is prefilled with every image of the /api/images
+catalogue.
+"""
+import hashlib
+import os
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+
+from config import (configure_logging, TEMPLATE_CACHE_DIR, TEMPLATE_CACHE_MAX_BYTES, TEMPLATE_CACHE_MEMORY_ITEMS,
+                    TEMPLATE_CACHE_PREFILL_WORKERS, TEMPLATE_URL_HOSTS)
+from services.cache import TTLCache
+from services.metrics import span
+
+logger = configure_logging(__name__)
+
+
+class TemplateCache:
+    def __init__(self, directory=TEMPLATE_CACHE_DIR, max_bytes=TEMPLATE_CACHE_MAX_BYTES,
+                 memory_items=TEMPLATE_CACHE_MEMORY_ITEMS, allowed_hosts=TEMPLATE_URL_HOSTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.allowed_hosts = set(allowed_hosts)
+        self._decoded = TTLCache(memory_items, ttl=24 * 60 * 60)
+        self._evict_lock = threading.Lock()
+        self.downloads = 0
+        self.disk_hits = 0
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + ".img")
+
+    def check_url(self, url):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or parsed.hostname not in self.allowed_hosts:
+            raise ValueError(f"Template URL host not allowed: {parsed.hostname}")
+
+    def fetch(self, url):
+        """Encoded bytes of ``url``, from disk when cached, else downloaded and stored."""
+        path = self._path(url)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime is the LRU clock
+            self.disk_hits += 1
+            return data
+        except FileNotFoundError:
+            pass
+        with urllib.request.urlopen(url, timeout=30) as response:
+            data = response.read()
+        self.downloads += 1
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+        return data
+
+    def get_image(self, url):
+        """Decoded, read-only BGR array of the template at ``url``."""
+        image = self._decoded.get(url)
+        if image is not None:
+            return image
+        self.check_url(url)
+        data = self.fetch(url)
+        with span("decode"):
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Failed to decode template {url}")
+        image.setflags(write=False)
+        self._decoded.put(url, image)
+        return image
+
+    def _evict(self):
+        with self._evict_lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".img"):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
+
+    def prefill(self, urls, workers=TEMPLATE_CACHE_PREFILL_WORKERS):
+        """Download every ``url`` not yet on disk; failures are logged and skipped."""
+        missing = [url for url in urls if not os.path.exists(self._path(url))]
+
+        def download(url):
+            try:
+                self.check_url(url)
+                self.fetch(url)
+                return True
+            except Exception as e:
+                logger.warning("Could not prefill template %s: %s", url, e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="template-prefill") as pool:
+            fetched = sum(pool.map(download, missing))
+        logger.info("Template cache prefilled: %d of %d missing templates downloaded (%d already cached)",
+                    fetched, len(missing), len(urls) - len(missing))
+
+    def stats(self):
+        return {"downloads": self.downloads, "disk_hits": self.disk_hits, "decoded": self._decoded.stats()}
+
+
+template_cache = TemplateCache()
+
+
+def prefill_from_catalogue():
+    from services.catalogue import catalogue, all_urls
+    try:
+        template_cache.prefill(all_urls(catalogue.get()["structure"]))
+    except Exception as e:
+        logger.exception("Template cache prefill failed: %s", e)
@@ -0,0 +1,247 @@
+"""On-disk index of precomputed gallery template artifacts.
+
+Every gallery template is stored as a directory of ``.npy`` files that are
+opened with ``mmap_mode='r'``, so loading a template costs a few page faults
+instead of detection, alignment, 3DMM fitting and a BiSeNet pass:
+
+    <TEMPLATE_INDEX_DIR>/<template dir>/
+        meta.json              template id, source URL and version, non-array info fields
+        image.npy              decoded BGR target image
+        faces_*.npy            InsightFace bbox / kps / det_score
+        tgt_inp.npy            HeadSwap preprocessed target tensor
+        tgt_params.npy         3DMM params tensor
+        M_t.npy                target parsing map
+        info_<key>.npy         array fields of the affine ``info`` (im, mask, rotated_lmk...)
+
+Build it offline with ``python -m services.template_index`` from the ``app``
+directory (see ``--help``).
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import urllib.request
+import warnings
+
+import cv2
+import numpy as np
+import torch
+
+from config import (configure_logging, TEMPLATE_INDEX_DIR, TEMPLATE_INDEX_CACHE_ITEMS,
+                    TEMPLATE_INDEX_DEVICE_CACHE_ITEMS)
+from services.cache import TTLCache
+from services.detection import detect_faces
+
+logger = configure_logging(__name__)
+
+FACE_FIELDS = ("bbox", "kps", "det_score", "embedding")
+HEADSWAP_TENSORS = ("tgt_inp", "tgt_params", "M_t")
+
+# CPU templates wrap the memory-mapped files without copying, so they only cost page cache
+_loaded_templates = TTLCache(max_items=TEMPLATE_INDEX_CACHE_ITEMS, ttl=24 * 60 * 60)
+# (template_id, device) -> template whose HeadSwap tensors were copied onto that device
+_device_templates = TTLCache(max_items=TEMPLATE_INDEX_DEVICE_CACHE_ITEMS, ttl=24 * 60 * 60)
+
+
+def template_id_from_url(url):
+    """Cloudinary public_id of a gallery URL (or the file stem of a local path)."""
+    match = re.search(r"/upload/(?:[^/]+/)*?v\d+/(.+)\.\w+$", url)
+    if match:
+        return match.group(1)
+    return os.path.splitext(os.path.basename(url))[0]
+
+
+def template_version(url):
+    """Cloudinary version (``v1712345678``) of a gallery URL, or ``None`` if it has none."""
+    match = re.search(r"/upload/(?:[^/]+/)*?(v\d+)/", url or "")
+    return match.group(1) if match else None
+
+
+def is_current(meta, location):
+    """Whether indexed artifacts described by ``meta`` were built from the image at ``location``.
+
+    Cloudinary keeps the public_id when an image is replaced but bumps its
+    version, so versioned URLs are compared by version and anything else by
+    the full location.
+    """
+    version = template_version(location)
+    if version is not None:
+        return meta.get("version") == version
+    return meta.get("location") == location
+
+
+def _template_dir(template_id, index_dir=TEMPLATE_INDEX_DIR):
+    if not template_id or ".." in template_id or template_id.startswith(("/", "\\")):
+        raise ValueError(f"Invalid template id: {template_id}")
+    return os.path.join(index_dir, template_id.replace("/", "__"))
+
+
+def read_image(location):
+    if location.startswith(("http://", "https://")):
+        with urllib.request.urlopen(location, timeout=30) as response:
+            data = response.read()
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(location)
+
+
+def index_template(template_id, image, face_analyzer=None, headswap_model=None,
+                   location=None, index_dir=TEMPLATE_INDEX_DIR):
+    """Compute and store the artifacts of one template; returns its directory."""
+    target_dir = _template_dir(template_id, index_dir)
+    tmp_dir = target_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    meta = {"template_id": template_id, "location": location, "version": template_version(location),
+            "shape": list(image.shape),
+            "inswapper": False, "faces": 0, "headswap": False, "info": {}}
+    np.save(os.path.join(tmp_dir, "image.npy"), np.ascontiguousarray(image))
+
+    if face_analyzer is not None:
+        faces = detect_faces(face_analyzer, image)
+        meta["inswapper"] = True
+        meta["faces"] = len(faces)
+        for field in FACE_FIELDS:
+            values = [getattr(face, field, None) for face in faces]
+            if faces and all(value is not None for value in values):
+                np.save(os.path.join(tmp_dir, f"faces_{field}.npy"), np.stack(values))
+
+    if headswap_model is not None:
+        try:
+            tgt_prep = headswap_model.prepare_target(image, with_parsing=True)
+        except ValueError as e:
+            logger.warning("HeadSwap preparation failed for template %s: %s", template_id, e)
+        else:
+            for name in HEADSWAP_TENSORS:
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), tgt_prep[name].cpu().numpy())
+            for key, value in tgt_prep["info"].items():
+                if isinstance(value, np.ndarray):
+                    np.save(os.path.join(tmp_dir, f"info_{key}.npy"), value)
+                else:
+                    meta["info"][key] = value
+            meta["headswap"] = True
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2, default=str)
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.replace(tmp_dir, target_dir)
+    _loaded_templates.pop(template_id)
+    _device_templates.clear()
+    return target_dir
+
+
+def load_template(template_id, device="cpu", index_dir=TEMPLATE_INDEX_DIR, location=None):
+    """Return the indexed artifacts of a template, or ``None`` if it was never indexed.
+
+    The result is a dict with the target ``image``, InsightFace ``faces`` (or
+    ``None`` when not indexed) and the HeadSwap ``tgt_prep`` dict accepted by
+    ``Infer.run_arrays`` (or ``None``). When ``location`` is given, an index
+    built from a different version of the image also counts as a miss.
+    """
+    template = _loaded_templates.get(template_id)
+    if template is None:
+        template = _load_template(template_id, index_dir)
+        if template is None:
+            return None
+        _loaded_templates.put(template_id, template)
+    if location is not None and not is_current(template["meta"], location):
+        logger.info("Indexed template %s is stale for %s", template_id, location)
+        return None
+    if str(device) == "cpu" or template["tgt_prep"] is None:
+        return template
+
+    key = (template_id, str(device))
+    device_template = _device_templates.get(key)
+    if device_template is None or device_template["meta"] is not template["meta"]:
+        tgt_prep = {name: template["tgt_prep"][name].to(device) for name in HEADSWAP_TENSORS}
+        tgt_prep["info"] = template["tgt_prep"]["info"]
+        device_template = dict(template, tgt_prep=tgt_prep)
+        _device_templates.put(key, device_template)
+    return device_template
+
+
+def _mapped_tensor(array):
+    """Read-only CPU tensor over a memory-mapped array; the pipeline only reads it (torch.cat copies)."""
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        return torch.from_numpy(array)
+
+
+def _load_template(template_id, index_dir):
+    template_dir = _template_dir(template_id, index_dir)
+    meta_path = os.path.join(template_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(template_dir, f"{name}.npy"), mmap_mode="r")
+
+    template = {"template_id": template_id, "meta": meta, "image": load("image"), "faces": None, "tgt_prep": None}
+
+    if meta.get("inswapper"):
+        from insightface.app.common import Face
+        fields = {field: load(f"faces_{field}") for field in FACE_FIELDS
+                  if os.path.exists(os.path.join(template_dir, f"faces_{field}.npy"))}
+        template["faces"] = [Face({field: np.asarray(values[i]) for field, values in fields.items()})
+                             for i in range(meta["faces"])]
+
+    if meta.get("headswap"):
+        tgt_prep = {name: _mapped_tensor(load(name)) for name in HEADSWAP_TENSORS}
+        info = dict(meta.get("info", {}))
+        for filename in os.listdir(template_dir):
+            if filename.startswith("info_") and filename.endswith(".npy"):
+                info[filename[len("info_"):-len(".npy")]] = load(filename[:-len(".npy")])
+        tgt_prep["info"] = info
+        template["tgt_prep"] = tgt_prep
+    return template
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute gallery template artifacts")
+    parser.add_argument("locations", nargs="*", help="Template image URLs or local paths")
+    parser.add_argument("--from-gallery", action="store_true",
+                        help="Index every image listed by the /api/images gallery")
+    parser.add_argument("--index-dir", default=TEMPLATE_INDEX_DIR, help="Output directory")
+    parser.add_argument("--skip-inswapper", action="store_true", help="Do not store InsightFace faces")
+    parser.add_argument("--skip-headswap", action="store_true", help="Do not store HeadSwap artifacts")
+    parser.add_argument("--force", action="store_true", help="Re-index templates that already exist")
+    args = parser.parse_args()
+
+    from config import load_inswapper, load_headswap
+    locations = list(args.locations)
+    if args.from_gallery:
+        from services.catalogue import catalogue, all_urls
+        locations.extend(all_urls(catalogue.get()["structure"]))
+    if not locations:
+        parser.error("no templates given")
+
+    face_analyzer = None if args.skip_inswapper else load_inswapper()[1]
+    headswap_model = None if args.skip_headswap else load_headswap()
+
+    failed = 0
+    for i, location in enumerate(locations):
+        template_id = template_id_from_url(location)
+        meta_path = os.path.join(_template_dir(template_id, args.index_dir), "meta.json")
+        if not args.force and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                current = is_current(json.load(f), location)
+            if current:
+                logger.info("[%d/%d] %s already indexed, skipping", i + 1, len(locations), template_id)
+                continue
+        try:
+            image = read_image(location)
+            if image is None:
+                raise ValueError("could not decode image")
+            index_template(template_id, image, face_analyzer, headswap_model,
+                           location=location, index_dir=args.index_dir)
+            logger.info("[%d/%d] Indexed %s", i + 1, len(locations), template_id)
+        except Exception as e:
+            failed += 1
+            logger.exception("[%d/%d] Failed to index %s: %s", i + 1, len(locations), location, e)
+    logger.info("Template indexing finished: %d templates, %d failed", len(locations), failed)
+
+
+if __name__ == "__main__":
+    main()
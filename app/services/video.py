@@ -0,0 +1,242 @@
+"""Short-clip (video / GIF) swapping with frame-to-frame reuse.
+
+The source is prepared once (InSwapper embedding or HeadSwap aligned source).
+Per frame, the face region is compared with the frame of the last full pass.
+While it has barely changed, the previous work is reused: InSwapper keeps the
+tracked faces instead of running detection, and HeadSwap re-blends the
+previous generated head instead of running the networks. InSwapper keypoints
+are smoothed across detections to avoid jitter.
+
+CLI, from the ``app`` directory:
+
+    python -m services.video --source selfie.jpg --clip boomerang.mp4 --out swapped.mp4
+"""
+import argparse
+import os
+import tempfile
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from config import (configure_logging, VIDEO_MAX_FRAMES, VIDEO_MOTION_THRESHOLD, VIDEO_MAX_REUSE_FRAMES,
+                    VIDEO_LANDMARK_SMOOTHING)
+from services.detection import detect_faces
+from services.faceswap import get_source_faces, get_headswap_source, process_face_swap_batch
+
+logger = configure_logging(__name__)
+
+MOTION_SCALE = 0.25  # motion is measured on a quarter-resolution grey copy
+
+
+def iter_frames(path, max_frames=VIDEO_MAX_FRAMES):
+    """Yield up to ``max_frames`` BGR frames of a video or GIF file."""
+    capture = cv2.VideoCapture(path)
+    try:
+        count = 0
+        while count < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            count += 1
+            yield frame
+    finally:
+        capture.release()
+
+
+def clip_fps(path, default=15.0):
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps if fps and fps > 0 else default
+
+
+def _bbox_iou(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x1 - x0) * max(0.0, y1 - y0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+class MotionGate:
+    """Decides whether the region(s) of interest changed enough since the last full pass."""
+
+    def __init__(self, threshold=VIDEO_MOTION_THRESHOLD, max_reuse=VIDEO_MAX_REUSE_FRAMES):
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self._reference = None
+        self._boxes = None
+        self._reused = 0
+
+    def _small(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, None, fx=MOTION_SCALE, fy=MOTION_SCALE, interpolation=cv2.INTER_AREA)
+
+    def can_reuse(self, frame):
+        if self._reference is None or self._reused >= self.max_reuse:
+            return False
+        small = self._small(frame)
+        if small.shape != self._reference.shape:
+            return False
+        for box in self._boxes:
+            x0, y0, x1, y1 = (int(round(v * MOTION_SCALE)) for v in box)
+            x0, y0 = max(x0, 0), max(y0, 0)
+            region = small[y0:y1, x0:x1]
+            if region.size == 0:
+                return False
+            diff = cv2.absdiff(region, self._reference[y0:y1, x0:x1])
+            if float(diff.mean()) > self.threshold:
+                return False
+        self._reused += 1
+        return True
+
+    def reset(self, frame, boxes):
+        self._reference = self._small(frame)
+        self._boxes = [np.asarray(box, dtype=np.float64) for box in boxes]
+        self._reused = 0
+
+
+class FaceTrack:
+    """Tracked InSwapper target faces with keypoint smoothing between detections."""
+
+    def __init__(self, face_analyzer, smoothing=VIDEO_LANDMARK_SMOOTHING):
+        self.face_analyzer = face_analyzer
+        self.smoothing = smoothing
+        self.gate = MotionGate()
+        self.faces = None
+        self.detections = 0
+
+    def faces_for(self, frame):
+        if self.faces is not None and self.gate.can_reuse(frame):
+            return self.faces
+        from insightface.app.common import Face
+        detected = detect_faces(self.face_analyzer, frame)
+        self.detections += 1
+        smoothed = []
+        for face in detected:
+            previous = None
+            if self.faces:
+                previous = max(self.faces, key=lambda prev: _bbox_iou(prev.bbox, face.bbox))
+                if _bbox_iou(previous.bbox, face.bbox) < 0.3:
+                    previous = None
+            face = Face(dict(face))
+            if previous is not None:
+                a = self.smoothing
+                face.kps = a * previous.kps + (1 - a) * face.kps
+                face.bbox = a * previous.bbox + (1 - a) * face.bbox
+            smoothed.append(face)
+        self.faces = smoothed
+        self.gate.reset(frame, [face.bbox for face in smoothed])
+        return self.faces
+
+
+def _head_box(info, crop_shape):
+    """Target-frame bounding box of the aligned HeadSwap crop."""
+    h, w = crop_shape[:2]
+    corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]], dtype=np.float64)
+    corners = corners @ np.asarray(info['im'][:2], dtype=np.float64).T
+    return [corners[:, 0].min(), corners[:, 1].min(), corners[:, 0].max(), corners[:, 1].max()]
+
+
+def swap_frames(frames, state, model, source_entry):
+    """Yield swapped frames for an iterable of BGR frames."""
+    if model == "inswapper":
+        source_faces = get_source_faces(source_entry, state.face_analyzer)
+        track = FaceTrack(state.face_analyzer)
+        for frame in frames:
+            faces = track.faces_for(frame)
+            if not faces:
+                yield frame
+                continue
+            result = process_face_swap_batch([(source_faces, frame, faces)], state.face_swapper,
+                                             state.face_analyzer)[0]
+            yield frame if isinstance(result, Exception) else result
+        logger.info("InSwapper clip done, face detection ran on %d frames", track.detections)
+    elif model == "headswap":
+        headswap_model = state.headswap_model
+        src_inp = get_headswap_source(source_entry, headswap_model)
+        gate = MotionGate()
+        previous = None  # (generated head, info) of the last full pass
+        full_passes = 0
+        for frame in frames:
+            if previous is None or not gate.can_reuse(frame):
+                try:
+                    pair = headswap_model.prepare_pair(None, frame, src_inp=src_inp)
+                except ValueError as e:
+                    logger.warning("Skipping frame without a usable head: %s", e)
+                    previous = None
+                    yield frame
+                    continue
+                previous = (headswap_model.generate([pair])[0], pair['info'])
+                gate.reset(frame, [_head_box(pair['info'], pair['info']['mask'].shape)])
+                full_passes += 1
+            yield headswap_model.blend(previous[0], previous[1], frame, inplace=True)
+        logger.info("HeadSwap clip done, networks ran on %d frames", full_passes)
+    else:
+        raise ValueError(f"Unknown model: {model}")
+
+
+def mjpeg_chunks(frames, quality=85):
+    """Encode frames as parts of a ``multipart/x-mixed-replace; boundary=frame`` stream."""
+    for frame in frames:
+        ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if ok:
+            yield b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + encoded.tobytes() + b"\r\n"
+
+
+def mjpeg_error_part(message):
+    """Final text part of an MJPEG stream, so a client can tell a cut-off clip from a finished one."""
+    return b"--frame\r\nContent-Type: text/plain\r\nX-Stream-Error: 1\r\n\r\n" + message.encode() + b"\r\n"
+
+
+def write_mp4(frames, path, fps):
+    writer = None
+    count = 0
+    try:
+        for frame in frames:
+            if writer is None:
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps,
+                                         (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+            count += 1
+    finally:
+        if writer is not None:
+            writer.release()
+    return count
+
+
+def save_upload(data, suffix):
+    """Write uploaded clip bytes to a temp file, since cv2.VideoCapture only reads from paths."""
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(handle, "wb") as f:
+        f.write(data)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Swap a face/head into every frame of a short clip")
+    parser.add_argument("--source", required=True, help="Source face image")
+    parser.add_argument("--clip", required=True, help="Input video or GIF")
+    parser.add_argument("--out", required=True, help="Output .mp4 path")
+    parser.add_argument("--model", default="inswapper", choices=["inswapper", "headswap"])
+    parser.add_argument("--max-frames", type=int, default=VIDEO_MAX_FRAMES)
+    args = parser.parse_args()
+
+    from config import load_inswapper, load_headswap
+    state = SimpleNamespace(face_swapper=None, face_analyzer=None, headswap_model=None)
+    if args.model == "inswapper":
+        state.face_swapper, state.face_analyzer = load_inswapper()
+    else:
+        state.headswap_model = load_headswap()
+    source_img = cv2.imread(args.source)
+    if source_img is None:
+        parser.error(f"could not read {args.source}")
+
+    frames = swap_frames(iter_frames(args.clip, args.max_frames), state, args.model, {"image": source_img})
+    count = write_mp4(frames, args.out, clip_fps(args.clip))
+    logger.info("Wrote %d frames to %s", count, args.out)
+
+
+if __name__ == "__main__":
+    main()
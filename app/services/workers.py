@@ -0,0 +1,204 @@
+"""Pre-fork multi-process serving (``python main.py --workers N``).
+
+The parent binds the listening socket and loads the HeadSwap torch networks
+once (CPU only; CUDA cannot be initialised before fork). It then forks N
+workers that share the weight pages copy-on-write. ONNX Runtime sessions are
+created inside each worker, because ORT thread pools do not survive
+``fork()``. Each worker gets its share of the cores for torch and ORT
+intra-op threads, and writes its stats to a shared directory that any worker
+can report through /api/workers. Workers that die are restarted.
+
+The same directory carries token revocations: each worker has its own auth
+token cache, so a token rotated by /login in one worker is appended to
+``revoked_tokens`` and dropped from the other workers' caches on their next
+lookup.
+"""
+import asyncio
+import gc
+import json
+import os
+import signal
+import socket
+import tempfile
+import time
+
+import psutil
+import torch
+
+from config import (configure_logging, INFERENCE_WORKERS, WORKER_STATS_DIR, WORKER_STATS_INTERVAL_SECONDS,
+                    WORKER_PRELOAD_HEADSWAP)
+
+logger = configure_logging(__name__)
+
+REVOKED_TOKENS_NAME = "revoked_tokens"
+
+preloaded_headswap = None
+worker_id = None
+stats_dir = None
+_revoked_offset = 0
+
+
+def _bind(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _preload_headswap():
+    global preloaded_headswap
+    if torch.cuda.is_available():
+        logger.info("CUDA is available, so each worker loads HeadSwap itself")
+        return
+    from config import load_headswap
+    torch.set_num_threads(1)  # no OpenMP pool in the parent that the forked workers would inherit
+    try:
+        preloaded_headswap = load_headswap(defer_sessions=True)
+        logger.info("HeadSwap weights loaded in the parent, shared with the workers")
+    except Exception as e:
+        logger.exception("HeadSwap preload failed, workers will load it themselves: %s", e)
+
+
+def _apply_thread_budget(workers):
+    from services.onnx_sessions import set_intra_op_threads
+    cores = os.cpu_count() or 1
+    torch.set_num_threads(max(1, cores // workers))
+    if "ORT_INTRA_OP_THREADS" not in os.environ:
+        set_intra_op_threads(max(1, cores // (workers * INFERENCE_WORKERS)))
+
+
+def _run_worker(index, workers, app, sock, log_level):
+    global worker_id
+    import uvicorn
+    worker_id = index
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _apply_thread_budget(workers)
+    logger.info("Worker %d started (pid %d, %d torch threads)", index, os.getpid(), torch.get_num_threads())
+    uvicorn.Server(uvicorn.Config(app, log_level=log_level)).run(sockets=[sock])
+
+
+def serve(app, host, port, workers, log_level="info"):
+    """Run ``app`` in ``workers`` forked processes sharing one listening socket."""
+    global stats_dir
+    stats_dir = WORKER_STATS_DIR or tempfile.mkdtemp(prefix=f"faceheadswap-workers-{os.getpid()}-")
+    os.makedirs(stats_dir, exist_ok=True)
+    sock = _bind(host, port)
+    if WORKER_PRELOAD_HEADSWAP:
+        _preload_headswap()
+    gc.freeze()  # keep the collector from writing to (and so un-sharing) pages inherited by the workers
+
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(index, workers, app, sock, log_level)
+            except BaseException:
+                logger.exception("Worker %d crashed", index)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info("Starting %d workers on %s:%d, stats in %s", workers, host, port, stats_dir)
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            logger.warning("Worker %d (pid %d) exited with status %d, restarting", index, pid, status)
+            time.sleep(1)  # avoid a tight restart loop when a worker dies at startup
+            spawn(index)
+    sock.close()
+    logger.info("All workers stopped")
+
+
+def worker_stats(app):
+    process = psutil.Process()
+    return {
+        "worker": worker_id,
+        "pid": process.pid,
+        "rss_mb": round(process.memory_info().rss / 2 ** 20, 1),
+        "cpu_percent": process.cpu_percent(),
+        "threads": process.num_threads(),
+        "torch_threads": torch.get_num_threads(),
+        "inference_pool": app.state.inference_executor.stats(),
+        "models": app.state.models.stats(),
+        "updated_at": time.time()
+    }
+
+
+async def publish_stats(app, interval=WORKER_STATS_INTERVAL_SECONDS):
+    """Periodically write this worker's stats to the shared stats directory."""
+    path = os.path.join(stats_dir, f"worker-{worker_id}.json")
+    while True:
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(worker_stats(app), f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning("Could not write worker stats: %s", e)
+        await asyncio.sleep(interval)
+
+
+def publish_revoked_token(token):
+    """Tell the other workers that ``token`` no longer authenticates; no-op outside ``--workers`` mode."""
+    if worker_id is None:
+        return
+    # One short O_APPEND write per token, so concurrent writers never interleave within a line
+    with open(os.path.join(stats_dir, REVOKED_TOKENS_NAME), "a") as f:
+        f.write(token + "\n")
+
+
+def apply_revoked_tokens(cache):
+    """Drop tokens revoked by any worker from ``cache``; a single stat() when nothing changed."""
+    global _revoked_offset
+    if worker_id is None:
+        return
+    path = os.path.join(stats_dir, REVOKED_TOKENS_NAME)
+    try:
+        if os.stat(path).st_size <= _revoked_offset:
+            return
+        with open(path, "rb") as f:
+            f.seek(_revoked_offset)
+            data = f.read()
+    except FileNotFoundError:
+        return
+    complete = data[:data.rfind(b"\n") + 1]  # a line still being written is read next time
+    _revoked_offset += len(complete)
+    for token in complete.decode().split():
+        cache.pop(token)
+
+
+def read_worker_stats():
+    stats = []
+    for name in sorted(os.listdir(stats_dir)):
+        if name.startswith("worker-") and name.endswith(".json"):
+            try:
+                with open(os.path.join(stats_dir, name)) as f:
+                    stats.append(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                continue
+    return stats
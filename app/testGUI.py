@@ -1,11 +1,13 @@
 from PyQt5.QtWidgets import QApplication, QMainWindow
 from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEnginePage
-from PyQt5.QtCore import QUrl
+from PyQt5.QtCore import QUrl, QTimer
+from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest
 import sys
 import subprocess
 import time
 import os
 import json
+import html
 from datetime import datetime
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -29,10 +31,10 @@ class WebApp(QMainWindow):
         self.browser.page().featurePermissionRequested.connect(self.handle_permission)
         self.browser.loadFinished.connect(self.on_load_finished)
 
-        # Determine the initial URL based on last login time
-        url = self.get_initial_url()
-        print(f"Initial URL set to: {url}")
-        self.browser.setUrl(QUrl(url))
+        # Determine the initial URL based on last login time; it is opened once the server is ready
+        self.initial_url = self.get_initial_url()
+        print(f"Initial URL set to: {self.initial_url}")
+        self.browser.setHtml("<h3>Starting the server and loading models...</h3>")
         self.setCentralWidget(self.browser)
 
         self.start_server()
@@ -57,30 +59,32 @@ class WebApp(QMainWindow):
             return 0  # Default to 0 seconds on error
 
     def get_initial_url(self):
-        """Determine the initial URL based on the last login timestamp from the JSON file."""
+        """Determine the initial URL based on the last login timestamp from the login log index."""
         LOGIN_FILES_DIR = "login_logs"
-        filename = f"login.json"
-        file_path = os.path.join(LOGIN_FILES_DIR, filename)
+        latest_path = os.path.join(LOGIN_FILES_DIR, "latest.json")
+        legacy_path = os.path.join(LOGIN_FILES_DIR, "login.json")
 
         # Fetch login duration from Firestore
         login_duration_seconds = self.get_login_duration()
 
-        # If the file or directory doesn't exist, go to login page
-        if not os.path.exists(file_path):
-            print(f"No login file found at {file_path}")
+        # If neither the index nor the old login file exists, go to login page
+        if not os.path.exists(latest_path) and not os.path.exists(legacy_path):
+            print(f"No login file found at {latest_path}")
             return f"http://localhost:8000/static/login.html?t={int(time.time())}"
 
         try:
-            with open(file_path, 'r') as f:
-                login_data = json.load(f)
-
-            # Validate that login_data is a list and not empty
-            if not login_data or not isinstance(login_data, list):
-                print("Login data is empty or not a list")
-                return f"http://localhost:8000/static/login.html?t={int(time.time())}"
+            if os.path.exists(latest_path):
+                # latest.json is a small sidecar kept by the server: {"latest": entry, "by_email": {...}}
+                with open(latest_path, 'r') as f:
+                    latest_login = json.load(f).get("latest") or {}
+            else:
+                with open(legacy_path, 'r') as f:
+                    login_data = json.load(f)
+                if not login_data or not isinstance(login_data, list):
+                    print("Login data is empty or not a list")
+                    return f"http://localhost:8000/static/login.html?t={int(time.time())}"
+                latest_login = max(login_data, key=lambda x: x.get("loginTimestamp", ""))
 
-            # Get the most recent login entry based on loginTimestamp
-            latest_login = max(login_data, key=lambda x: x.get("loginTimestamp", ""))
             last_login_str = latest_login.get("loginTimestamp")
             if not last_login_str:
                 print("No valid loginTimestamp found in latest login entry")
@@ -111,10 +115,60 @@ class WebApp(QMainWindow):
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
-            time.sleep(2)  # Give the server a moment to start
-            print("FastAPI server started successfully")
         except Exception as e:
             print(f"Failed to start server: {e}")
+            self.show_error(f"Failed to start the server: {e}")
+            return
+        self.wait_until_ready()
+
+    def show_error(self, message, detail=None):
+        """Replace the page with an error, since the app pages cannot load without a working server."""
+        body = f"<h3>{html.escape(message)}</h3>"
+        if detail:
+            body += f"<pre>{html.escape(detail)}</pre>"
+        self.browser.setHtml(body)
+
+    def wait_until_ready(self, timeout=120, interval=250):
+        """Poll /api/ready from a QTimer so the window stays responsive while the models load."""
+        self.ready_deadline = time.time() + timeout
+        self.ready_request_pending = False
+        self.network = QNetworkAccessManager(self)
+        self.network.finished.connect(self.on_ready_reply)
+        self.ready_timer = QTimer(self)
+        self.ready_timer.timeout.connect(self.poll_ready)
+        self.ready_timer.start(interval)
+
+    def poll_ready(self):
+        if self.server_process.poll() is not None:
+            self.ready_timer.stop()
+            print("FastAPI server exited before it was ready")
+            self.show_error("The server exited before it was ready")
+        elif time.time() > self.ready_deadline:
+            self.ready_timer.stop()
+            print("FastAPI server did not report ready in time")
+            self.show_error("The server did not become ready in time")
+        elif not self.ready_request_pending:
+            self.ready_request_pending = True
+            self.network.get(QNetworkRequest(QUrl("http://localhost:8000/api/ready")))
+
+    def on_ready_reply(self, reply):
+        # No status while the server is not listening yet; 503 while models load
+        self.ready_request_pending = False
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        body = bytes(reply.readAll()).decode("utf-8", "replace")
+        reply.deleteLater()
+        if status == 200:
+            self.ready_timer.stop()
+            print("FastAPI server started successfully")
+            self.browser.setUrl(QUrl(self.initial_url))
+        elif status == 500:
+            self.ready_timer.stop()
+            print("FastAPI server failed to load any model")
+            try:
+                detail = json.dumps(json.loads(body).get("models"), indent=2)
+            except (ValueError, AttributeError):
+                detail = body
+            self.show_error("The server could not load any model", detail)
 
     def handle_permission(self, securityOrigin, feature):
         """Handle feature permission requests (e.g., camera access)."""
@@ -0,0 +1,107 @@
+"""End-to-end timings of POST /api/swap-face through an in-process ASGI client.
+
+The whole app runs, lifespan included, with Firestore and Cloudinary faked
+(see fakes.py), so the numbers cover upload parsing, auth, decode, the swap,
+encoding and the publish queue but no network. Needs the model weights and
+``httpx``:
+
+    python benchmarks/bench_api.py --face me.jpg --model inswapper headswap --return-type direct qr --json api.json
+
+Under pytest-benchmark:
+
+    BENCH_FACE=me.jpg pytest benchmarks/bench_api.py -o python_files='bench_*.py' -o python_functions='bench_*'
+"""
+import argparse
+import asyncio
+import os
+
+import cv2
+import httpx
+
+from common import import_app, load_face, parse_size, run_case, synthetic_image, tiled_faces, write_report
+from fakes import BENCH_TOKEN
+
+import_app()
+from main import app  # noqa: E402
+
+
+class ApiClient:
+    """Keeps the app's lifespan open on a private event loop for the duration of the run."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._lifespan = app.router.lifespan_context(app)
+        self.loop.run_until_complete(self._lifespan.__aenter__())
+        self.loop.run_until_complete(app.state.models.all_done.wait())
+        print(f"Models: {app.state.models.stats()}")
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+    def swap(self, source_png, target_png, model, return_type):
+        async def post():
+            response = await self.client.post(
+                "/api/swap-face",
+                params={"token": BENCH_TOKEN, "model": model, "return_type": return_type},
+                files={"source": ("source.png", source_png, "image/png"),
+                       "target": ("target.png", target_png, "image/png")},
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+
+        return lambda: self.loop.run_until_complete(post())
+
+    def close(self):
+        self.loop.run_until_complete(self.client.aclose())
+        self.loop.run_until_complete(self._lifespan.__aexit__(None, None, None))
+        self.loop.close()
+
+
+def encode(img):
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def bench_api_swap_face_1080p(benchmark):
+    face_img = load_face(os.environ.get("BENCH_FACE"))
+    if face_img is None:
+        import pytest
+        pytest.skip("set BENCH_FACE to a portrait image")
+    api = ApiClient()
+    try:
+        benchmark(api.swap(encode(face_img), encode(tiled_faces(face_img, 1080, 1920, 1)), "inswapper", "direct"))
+    finally:
+        api.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--face", help="Portrait used as source and tiled into the targets")
+    parser.add_argument("--sizes", nargs="+", default=["1080x1920"], help="Target sizes as HxW")
+    parser.add_argument("--faces", nargs="+", type=int, default=[1], help="Face counts per target")
+    parser.add_argument("--model", nargs="+", default=["inswapper"], choices=["inswapper", "headswap"])
+    parser.add_argument("--return-type", nargs="+", default=["direct"], choices=["direct", "qr"])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    face_img = load_face(args.face)
+    source_png = encode(face_img if face_img is not None else synthetic_image(512, 512))
+    api = ApiClient()
+    results = []
+    try:
+        for size in args.sizes:
+            h, w = parse_size(size)
+            for count in args.faces:
+                target = tiled_faces(face_img, h, w, count) if face_img is not None else synthetic_image(h, w)
+                target_png = encode(target)
+                for model in args.model:
+                    for return_type in args.return_type:
+                        results.append(run_case("POST /api/swap-face", api.swap(source_png, target_png, model, return_type),
+                                                args.repeat, args.warmup, size=size, faces=count, model=model,
+                                                return_type=return_type))
+    finally:
+        api.close()
+    write_report(args.json, "api", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Offline timings of the HeadSwap pipeline: ``Infer.run_single`` and ``process_head_swap``.
+
+``run_single`` is timed from files on disk (imread included), ``process_head_swap``
+from decoded arrays as the API calls it, and once more with the source
+preprocessed up front as the source cache does. Needs the HeadSwap weights:
+
+    python benchmarks/bench_headswap.py --face me.jpg --sizes 1080x1920 2160x3840 --json headswap.json
+
+Per-stage p50/p95 come from the spans in inference.py. Under pytest-benchmark:
+
+    BENCH_FACE=me.jpg pytest benchmarks/bench_headswap.py -o python_files='bench_*.py' -o python_functions='bench_*'
+"""
+import argparse
+import os
+import tempfile
+
+import cv2
+
+from common import import_app, load_face, parse_size, run_case, synthetic_image, tiled_faces, write_report
+
+import_app()
+import config  # noqa: E402
+from services.faceswap import process_head_swap  # noqa: E402
+
+_model = None
+
+
+def model():
+    global _model
+    if _model is None:
+        _model = config.load_headswap()
+    return _model
+
+
+def cases(source_img, target, workdir):
+    headswap = model()
+    src_path = os.path.join(workdir, "source.png")
+    tgt_path = os.path.join(workdir, f"target_{target.shape[0]}x{target.shape[1]}.png")
+    cv2.imwrite(src_path, source_img)
+    cv2.imwrite(tgt_path, target)
+
+    def run_single():
+        if headswap.run_single(src_path, tgt_path, crop_align=True, cat=True) is None:
+            raise RuntimeError("run_single returned no result")
+
+    src_inp = headswap.prepare_source(source_img, crop_align=True)
+    return {
+        "run_single": run_single,
+        "process_head_swap": lambda: process_head_swap(source_img, target, headswap),
+        "process_head_swap (source cached)": lambda: process_head_swap(source_img, target, headswap, src_inp=src_inp),
+    }
+
+
+def bench_headswap_1080p(benchmark):
+    face_img = load_face(os.environ.get("BENCH_FACE"))
+    if face_img is None:
+        import pytest
+        pytest.skip("set BENCH_FACE to a portrait image")
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmark(cases(face_img, tiled_faces(face_img, 1080, 1920, 1), workdir)["process_head_swap"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--face", help="Portrait used as source and placed into the targets")
+    parser.add_argument("--sizes", nargs="+", default=["1080x1920", "2160x3840"], help="Target sizes as HxW")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    face_img = load_face(args.face)
+    source_img = face_img if face_img is not None else synthetic_image(512, 512)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            h, w = parse_size(size)
+            # HeadSwap replaces a single head, so every target holds one face
+            target = tiled_faces(face_img, h, w, 1) if face_img is not None else synthetic_image(h, w)
+            for name, fn in cases(source_img, target, workdir).items():
+                results.append(run_case(name, fn, args.repeat, args.warmup, size=size))
+    write_report(args.json, "headswap", results)
+
+
+if __name__ == "__main__":
+    main()
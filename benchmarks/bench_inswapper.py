@@ -0,0 +1,78 @@
+"""Offline timings of the InSwapper pipeline (``process_face_swap``).
+
+Targets are built by tiling ``--face`` over a synthetic frame at every
+``--sizes`` x ``--faces`` combination; Firestore and Cloudinary are faked, so
+only the model weights are needed:
+
+    python benchmarks/bench_inswapper.py --face me.jpg --sizes 1080x1920 2160x3840 --faces 1 4 --json inswapper.json
+
+Without ``--face`` the frames contain no face and only detection is timed.
+The ``bench_*`` functions also run under pytest-benchmark:
+
+    pytest benchmarks/bench_inswapper.py -o python_files='bench_*.py' -o python_functions='bench_*'
+"""
+import argparse
+import os
+
+from common import import_app, load_face, parse_size, run_case, synthetic_image, tiled_faces, write_report
+
+import_app()
+import config  # noqa: E402
+from services.detection import detect_faces, detect_source_faces  # noqa: E402
+from services.faceswap import process_face_swap  # noqa: E402
+
+_models = None
+
+
+def models():
+    global _models
+    if _models is None:
+        _models = config.load_inswapper()
+    return _models
+
+
+def swap_case(source_img, h, w, face_count, face_img, face_select=None):
+    swapper, analyzer = models()
+    target = tiled_faces(face_img, h, w, face_count) if face_img is not None else synthetic_image(h, w)
+    source_faces = detect_source_faces(analyzer, source_img)
+    target_faces = detect_faces(analyzer, target)
+    return (lambda: process_face_swap(source_img, target, swapper, analyzer, face_select=face_select)), \
+        (lambda: process_face_swap(source_img, target, swapper, analyzer, source_faces, target_faces, face_select))
+
+
+def bench_inswapper_1080p(benchmark):
+    face_img = load_face(os.environ.get("BENCH_FACE"))
+    if face_img is None:
+        import pytest
+        pytest.skip("set BENCH_FACE to a portrait image")
+    full, _ = swap_case(face_img, 1080, 1920, 1, face_img)
+    benchmark(full)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--face", help="Portrait used as source and tiled into the targets")
+    parser.add_argument("--sizes", nargs="+", default=["1080x1920", "2160x3840"], help="Target sizes as HxW")
+    parser.add_argument("--faces", nargs="+", type=int, default=[1, 4], help="Face counts per target")
+    parser.add_argument("--max-faces", type=int, help="Swap only the largest N faces of each target")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    face_img = load_face(args.face)
+    source_img = face_img if face_img is not None else synthetic_image(512, 512)
+    results = []
+    for size in args.sizes:
+        h, w = parse_size(size)
+        for count in args.faces:
+            face_select = {"max_faces": args.max_faces, "order": "size"} if args.max_faces else None
+            full, swap_only = swap_case(source_img, h, w, count, face_img, face_select)
+            results.append(run_case("inswapper", full, args.repeat, args.warmup, size=size, faces=count))
+            results.append(run_case("inswapper (faces precomputed)", swap_only, args.repeat, args.warmup,
+                                    size=size, faces=count))
+    write_report(args.json, "inswapper", results)
+
+
+if __name__ == "__main__":
+    main()
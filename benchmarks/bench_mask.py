@@ -0,0 +1,78 @@
+"""Before/after timings for the HeadSwap blend stage.
+
+Uses synthetic frames and masks, so no model weights are needed. Also checks
+that blend ROIs clipped to a few pixels at the frame edge still composite:
+
+    python benchmarks/bench_mask.py --sizes 1080x1920 2160x3840 --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app", "HeadSwap"))
+from inference import soft_blend  # noqa: E402
+
+
+def legacy_blend(rotate_gen, mask, tgt_img):
+    kernel2 = cv2.getStructuringElement(cv2.MORPH_RECT, (17, 17))
+    mask = cv2.erode(mask * 1.0, kernel2)
+    mask = cv2.blur(mask * 1.0, (15, 15), 0) / 255.0
+    mask = np.clip(mask, 0, 1.0)[:, :, np.newaxis]
+    return rotate_gen * mask + tgt_img * (1 - mask)
+
+
+def timeit(fn, repeat):
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        samples.append(time.perf_counter() - start)
+    return np.median(samples) * 1000
+
+
+def check_clipped_rois(device, rng):
+    """Heads partly outside the target leave ROIs only a few pixels wide or tall."""
+    for h, w in [(5, 40), (40, 3), (7, 7), (1, 1)]:
+        tgt_img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        rotate_gen = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        mask = np.full((h, w), 255, np.float32)
+        out = soft_blend(rotate_gen, mask, tgt_img, device=device)
+        assert out.shape == tgt_img.shape and out.dtype == np.uint8, (h, w, out.shape, out.dtype)
+        diff = np.abs(legacy_blend(rotate_gen, mask, tgt_img) - out).max()
+        print(f"clipped ROI {h}x{w} ({device}): ok, max abs diff vs cv2 {diff:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["1080x1920", "2160x3840"], help="Frame sizes as HxW")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    check_clipped_rois(args.device, rng)
+
+    for size in args.sizes:
+        h, w = (int(v) for v in size.split("x"))
+        tgt_img = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        rotate_gen = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        mask = np.zeros((h, w), np.float32)
+        cv2.circle(mask, (w // 2, h // 2), min(h, w) // 6, 255, -1)
+        before = timeit(lambda: legacy_blend(rotate_gen, mask, tgt_img), args.repeat)
+        after = timeit(lambda: soft_blend(rotate_gen, mask, tgt_img, device=args.device), args.repeat)
+        diff = np.abs(legacy_blend(rotate_gen, mask, tgt_img) - soft_blend(rotate_gen, mask, tgt_img, device=args.device)).max()
+        print(f"erode/blur/compose {h}x{w} ({args.device}): before {before:.2f} ms, after {after:.2f} ms, max abs diff {diff:.2f}")
+
+
+if __name__ == "__main__":
+    main()
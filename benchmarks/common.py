@@ -0,0 +1,145 @@
+"""Shared pieces of the benchmark scripts: app import, test images, timing and JSON reports."""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT, "app")
+
+
+def import_app(fake_services=True):
+    """Make the ``app`` package importable (``config``, ``services``...) with fakes installed first."""
+    if fake_services:
+        from fakes import install
+        install()
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    os.chdir(ROOT)  # config resolves a few paths relative to the repository root
+
+
+def parse_size(size):
+    h, w = (int(v) for v in size.lower().split("x"))
+    return h, w
+
+
+def synthetic_image(h, w, seed=0):
+    """Smooth noise background; contains no face, so detection-dependent stages report errors."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(h // 32, 2), max(w // 32, 2), 3), dtype=np.uint8)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+
+
+def tiled_faces(face_img, h, w, count, seed=0):
+    """A ``h``x``w`` frame with ``count`` copies of ``face_img`` laid out on a grid."""
+    frame = synthetic_image(h, w, seed)
+    if count <= 0:
+        return frame
+    cols = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / cols))
+    cell_h, cell_w = h // rows, w // cols
+    scale = min(cell_h / face_img.shape[0], cell_w / face_img.shape[1])
+    face = cv2.resize(face_img, (max(int(face_img.shape[1] * scale), 1), max(int(face_img.shape[0] * scale), 1)))
+    for i in range(count):
+        r, c = divmod(i, cols)
+        y = r * cell_h + (cell_h - face.shape[0]) // 2
+        x = c * cell_w + (cell_w - face.shape[1]) // 2
+        frame[y:y + face.shape[0], x:x + face.shape[1]] = face
+    return frame
+
+
+def load_face(path):
+    if path is None:
+        return None
+    img = cv2.imread(path)
+    if img is None:
+        raise SystemExit(f"could not read {path}")
+    return img
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def sync_device():
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    except ImportError:
+        pass
+
+
+def run_case(name, fn, repeat, warmup=1, **params):
+    """Time ``fn`` ``repeat`` times; returns a result dict with latency, throughput and stage percentiles."""
+    from services.metrics import metrics
+    errors = []
+    for _ in range(warmup):
+        try:
+            fn()
+        except Exception as e:
+            errors.append(repr(e))
+    metrics.reset()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            errors.append(repr(e))
+        sync_device()
+        samples.append(time.perf_counter() - start)
+    wall = time.perf_counter() - started
+    samples.sort()
+    result = {
+        "case": name,
+        "params": params,
+        "repeat": repeat,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "latency_ms": {
+            "p50": samples[len(samples) // 2] * 1000,
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+            "mean": sum(samples) / len(samples) * 1000,
+        },
+        "throughput_per_s": repeat / wall if wall > 0 else None,
+        "stages_ms": {stage: {q: v * 1000 for q, v in values.items()}
+                      for stage, values in metrics.stage_percentiles().items()},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    print(f"{name:<40} {params} p50 {result['latency_ms']['p50']:.1f} ms, "
+          f"p95 {result['latency_ms']['p95']:.1f} ms, errors {len(errors)}")
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(path, benchmark, results):
+    report = {
+        "benchmark": benchmark,
+        "commit": git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if path:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {path}")
+    return report
@@ -0,0 +1,145 @@
+"""In-process stand-ins for firebase_admin and cloudinary.
+
+``install()`` must run before anything imports ``config``: it puts fake
+modules into ``sys.modules`` and points every on-disk location the app
+writes to at a temporary directory. Firestore keeps documents in a dict and
+Cloudinary "uploads" return a fake CDN URL, so benchmarks measure only our
+own code, not network round trips.
+"""
+import os
+import sys
+import tempfile
+import types
+import uuid
+
+BENCH_TOKEN = "bench-token"
+BENCH_EMAIL = "bench@example.com"
+# /api/login rotates the user's token, so logins use their own account
+LOGIN_EMAIL = "login@example.com"
+LOGIN_PASSWORD = "bench-password"
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, store, doc_id):
+        self._store = store
+        self.id = doc_id
+
+    def get(self):
+        return FakeSnapshot(self.id, self._store.get(self.id))
+
+    def set(self, data, merge=False):
+        if merge and self.id in self._store:
+            self._store[self.id].update(data)
+        else:
+            self._store[self.id] = dict(data)
+
+    def update(self, data):
+        self._store.setdefault(self.id, {}).update(data)
+
+
+class FakeQuery:
+    def __init__(self, store, filters=(), limit=None):
+        self._store = store
+        self._filters = filters
+        self._limit = limit
+
+    def where(self, field, op, value):
+        return FakeQuery(self._store, self._filters + ((field, value),), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._store, self._filters, count)
+
+    def stream(self):
+        matches = [FakeSnapshot(doc_id, data) for doc_id, data in list(self._store.items())
+                   if all(data.get(field) == value for field, value in self._filters)]
+        return iter(matches[:self._limit] if self._limit else matches)
+
+
+class FakeCollection(FakeQuery):
+    def document(self, doc_id=None):
+        return FakeDocument(self._store, doc_id or uuid.uuid4().hex)
+
+    def on_snapshot(self, callback):
+        return types.SimpleNamespace(unsubscribe=lambda: None)
+
+
+class FakeBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, data, merge))
+
+    def commit(self):
+        for ref, data, merge in self._writes:
+            ref.set(data, merge=merge)
+        self._writes = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.collections = {}
+
+    def collection(self, name):
+        return FakeCollection(self.collections.setdefault(name, {}))
+
+    def batch(self):
+        return FakeBatch()
+
+
+def _fake_upload(file=None, folder="", resource_type="image", **kwargs):
+    return {"secure_url": f"https://res.cloudinary.com/bench/image/upload/v1/{folder}/{uuid.uuid4().hex}.jpg"}
+
+
+def install(workdir=None):
+    """Replace firebase_admin/cloudinary and redirect app state to ``workdir``; returns the fake Firestore."""
+    workdir = workdir or tempfile.mkdtemp(prefix="faceheadswap-bench-")
+    for name, sub in (("PUBLISH_DIR", "publish_queue"), ("LOGIN_LOG_DIR", "login_logs"),
+                      ("TEMPLATE_CACHE_DIR", "template_cache"), ("TEMPLATE_INDEX_DIR", "template_index")):
+        os.environ.setdefault(name, os.path.join(workdir, sub))
+    os.environ.setdefault("AUTH_USE_ASYNC_FIRESTORE", "0")
+    os.environ.setdefault("TEMPLATE_CACHE_PREFILL", "0")
+
+    db = FakeFirestore()
+    db.collection("users").document(BENCH_EMAIL).set({"email": BENCH_EMAIL, "token": BENCH_TOKEN,
+                                                      "access": True, "name": "bench"})
+    # Stored unhashed; the first login migrates it to bcrypt like a legacy account
+    db.collection("users").document(LOGIN_EMAIL).set({"email": LOGIN_EMAIL, "password": LOGIN_PASSWORD,
+                                                       "access": True, "name": "login bench"})
+
+    firebase_admin = types.ModuleType("firebase_admin")
+    firebase_admin._apps = {}
+    firebase_admin.initialize_app = lambda *args, **kwargs: firebase_admin._apps.setdefault("[DEFAULT]", object())
+    credentials = types.ModuleType("firebase_admin.credentials")
+    credentials.Certificate = lambda path: types.SimpleNamespace(project_id="bench", get_credential=lambda: None)
+    firestore = types.ModuleType("firebase_admin.firestore")
+    firestore.client = lambda: db
+    firestore.SERVER_TIMESTAMP = "SERVER_TIMESTAMP"
+    firebase_admin.credentials = credentials
+    firebase_admin.firestore = firestore
+
+    cloudinary = types.ModuleType("cloudinary")
+    cloudinary.config = lambda **kwargs: None
+    uploader = types.ModuleType("cloudinary.uploader")
+    uploader.upload = _fake_upload
+    api = types.ModuleType("cloudinary.api")
+    api.resources = lambda **kwargs: {"resources": []}
+    cloudinary.uploader = uploader
+    cloudinary.api = api
+
+    sys.modules.update({
+        "firebase_admin": firebase_admin, "firebase_admin.credentials": credentials,
+        "firebase_admin.firestore": firestore, "cloudinary": cloudinary,
+        "cloudinary.uploader": uploader, "cloudinary.api": api,
+    })
+    return db
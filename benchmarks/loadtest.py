@@ -0,0 +1,262 @@
+"""Concurrency soak test: drive the running app over HTTP with a weighted request mix.
+
+The app is served in-process by uvicorn on a loopback port, with Firestore
+and Cloudinary faked (see fakes.py), and hammered by ``--concurrency``
+clients for ``--duration`` seconds per level:
+
+    python benchmarks/loadtest.py --face me.jpg --concurrency 1 8 32 --duration 120 \\
+        --mix swap-face=6 headswap-qr=1 images=2 login=1 --json soak.json
+
+Reports per-endpoint latency histograms and error rates, plus a timeline of
+event-loop lag (a probe task on the server's loop that should wake every
+10 ms), requests per second and resident memory, so a blocked loop or a
+leak shows up as a rising line rather than hiding in an average. The load
+generator shares the process (and the GIL) with the server, so absolute
+latencies are pessimistic; compare runs, not numbers.
+"""
+import argparse
+import asyncio
+import random
+import resource
+import socket
+import threading
+import time
+
+import cv2
+import httpx
+import uvicorn
+
+from common import import_app, load_face, peak_rss_mb, synthetic_image, tiled_faces, write_report
+from fakes import BENCH_TOKEN, LOGIN_EMAIL, LOGIN_PASSWORD
+
+import_app()
+from main import app  # noqa: E402
+from services.metrics import Histogram  # noqa: E402
+
+PROBE_INTERVAL = 0.01
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return peak_rss_mb()  # no procfs: fall back to the high-water mark
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class InProcessServer:
+    """uvicorn on its own thread and event loop, with a lag probe scheduled on that loop."""
+
+    def __init__(self, port):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.loop = asyncio.new_event_loop()
+        self.lag = []  # seconds the probe woke up late since the last sample
+        self._lag_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="loadtest-server", daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve())
+
+    async def _probe(self):
+        while not self.server.should_exit:
+            start = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            with self._lag_lock:
+                self.lag.append(max(0.0, time.perf_counter() - start - PROBE_INTERVAL))
+
+    def take_lag(self):
+        with self._lag_lock:
+            lag, self.lag = self.lag, []
+        return lag
+
+    def start(self):
+        self._thread.start()
+        while not self.server.started:
+            if not self._thread.is_alive():
+                raise SystemExit("server failed to start")
+            time.sleep(0.05)
+        asyncio.run_coroutine_threadsafe(self._probe(), self.loop)
+
+    def stop(self):
+        self.server.should_exit = True
+        self._thread.join(30)
+
+
+class LoadGenerator:
+    def __init__(self, base_url, mix, source_png, target_png):
+        self.base_url = base_url
+        self.mix = mix
+        self.source_png = source_png
+        self.target_png = target_png
+        self.reset()
+
+    def reset(self):
+        self.latency = {name: Histogram(max_samples=100_000) for name in self.mix}
+        self.statuses = {name: {} for name in self.mix}
+        self.completed = 0
+
+    async def request(self, client, name):
+        token = {"token": BENCH_TOKEN}
+        files = {"source": ("source.png", self.source_png, "image/png"),
+                 "target": ("target.png", self.target_png, "image/png")}
+        if name == "swap-face":
+            return await client.post("/api/swap-face", params=token, files=files)
+        if name == "headswap-qr":
+            return await client.post("/api/headswap-qr", params=token, files=files)
+        if name == "images":
+            return await client.get("/api/images")
+        if name == "login":
+            return await client.post("/api/login", json={"email": LOGIN_EMAIL, "password": LOGIN_PASSWORD})
+        raise ValueError(f"unknown endpoint {name}")
+
+    async def client_loop(self, client, deadline, rng):
+        names, weights = list(self.mix), list(self.mix.values())
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = (await self.request(client, name)).status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            self.latency[name].observe(time.perf_counter() - start)
+            self.statuses[name][status] = self.statuses[name].get(status, 0) + 1
+            self.completed += 1
+
+    async def run(self, concurrency, duration, server, sample_interval, seed):
+        deadline = time.monotonic() + duration
+        limits = httpx.Limits(max_connections=concurrency)
+        timeline = []
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=300, limits=limits) as client:
+            clients = [asyncio.create_task(self.client_loop(client, deadline, random.Random(seed + i)))
+                       for i in range(concurrency)]
+            started = last = time.monotonic()
+            last_completed = 0
+            server.take_lag()
+            while not all(task.done() for task in clients):
+                await asyncio.wait(clients, timeout=sample_interval)
+                now = time.monotonic()
+                lag = sorted(server.take_lag())
+                timeline.append({
+                    "t": round(now - started, 2),
+                    "rps": (self.completed - last_completed) / (now - last) if now > last else None,
+                    "loop_lag_ms_p95": lag[min(len(lag) - 1, int(len(lag) * 0.95))] * 1000 if lag else None,
+                    "loop_lag_ms_max": lag[-1] * 1000 if lag else None,
+                    "rss_mb": round(current_rss_mb(), 1),
+                })
+                last, last_completed = now, self.completed
+                print(f"  t={timeline[-1]['t']:>7.1f}s  rps {timeline[-1]['rps'] or 0:6.2f}  "
+                      f"lag max {timeline[-1]['loop_lag_ms_max'] or 0:7.1f} ms  rss {timeline[-1]['rss_mb']:.0f} MB")
+            for task in clients:
+                task.result()
+        return timeline
+
+
+def summarize(generator, concurrency, duration, timeline):
+    endpoints = {}
+    for name, histogram in generator.latency.items():
+        statuses = generator.statuses[name]
+        total = sum(statuses.values())
+        if not total:
+            continue
+        counts, _, _ = histogram.snapshot()
+        errors = sum(count for status, count in statuses.items() if not (isinstance(status, int) and status < 400))
+        endpoints[name] = {
+            "requests": total,
+            "error_rate": errors / total,
+            "statuses": {str(status): count for status, count in statuses.items()},
+            "latency_ms": {f"p{int(q * 100)}": histogram.percentile(q) * 1000 for q in (0.5, 0.95, 0.99)},
+            "histogram": {"le": [str(b) for b in histogram.buckets] + ["+Inf"], "counts": counts},
+        }
+    rss = [point["rss_mb"] for point in timeline]
+    lags = [point["loop_lag_ms_max"] for point in timeline if point["loop_lag_ms_max"] is not None]
+    return {
+        "concurrency": concurrency,
+        "duration_s": duration,
+        "throughput_per_s": generator.completed / duration,
+        "endpoints": endpoints,
+        "loop_lag_ms_max": max(lags) if lags else None,
+        # Growth after the first sample, which absorbs allocator warm-up and lazy caches
+        "rss_growth_mb": round(rss[-1] - rss[0], 1) if rss else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "timeline": timeline,
+    }
+
+
+def parse_mix(entries):
+    mix = {}
+    for entry in entries:
+        name, _, weight = entry.partition("=")
+        if name not in ("swap-face", "headswap-qr", "images", "login"):
+            raise SystemExit(f"unknown endpoint in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def wait_until_ready(base_url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(f"{base_url}/api/ready", timeout=5)
+            if response.status_code == 200:
+                print(f"Models: {response.json()['models']}")
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(1)
+    raise SystemExit("models did not become ready in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--face", help="Portrait used as source and tiled into the target")
+    parser.add_argument("--size", default="1080x1920", help="Target size as HxW")
+    parser.add_argument("--faces", type=int, default=1, help="Faces in the target")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16], help="Concurrent clients per level")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds per concurrency level")
+    parser.add_argument("--mix", nargs="+", default=["swap-face=6", "headswap-qr=1", "images=2", "login=1"],
+                        help="Weighted endpoints as name=weight")
+    parser.add_argument("--sample-interval", type=float, default=5.0, help="Seconds between timeline samples")
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the report to this file")
+    args = parser.parse_args()
+
+    h, w = (int(v) for v in args.size.lower().split("x"))
+    face_img = load_face(args.face)
+    source = face_img if face_img is not None else synthetic_image(512, 512)
+    target = tiled_faces(face_img, h, w, args.faces) if face_img is not None else synthetic_image(h, w)
+    source_png = cv2.imencode(".png", source)[1].tobytes()
+    target_png = cv2.imencode(".png", target)[1].tobytes()
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = InProcessServer(port)
+    server.start()
+    results = []
+    try:
+        wait_until_ready(base_url, args.ready_timeout)
+        generator = LoadGenerator(base_url, parse_mix(args.mix), source_png, target_png)
+        for concurrency in args.concurrency:
+            print(f"Concurrency {concurrency} for {args.duration:.0f}s")
+            generator.reset()
+            timeline = asyncio.run(generator.run(concurrency, args.duration, server, args.sample_interval,
+                                                 args.seed))
+            results.append(summarize(generator, concurrency, args.duration, timeline))
+            for name, endpoint in results[-1]["endpoints"].items():
+                print(f"  {name:<12} {endpoint['requests']:>6} req  p50 {endpoint['latency_ms']['p50']:8.1f} ms  "
+                      f"p95 {endpoint['latency_ms']['p95']:8.1f} ms  errors {endpoint['error_rate']:.1%}")
+    finally:
+        server.stop()
+    write_report(args.json, "loadtest", {"size": args.size, "faces": args.faces, "mix": parse_mix(args.mix),
+                                         "levels": results})
+
+
+if __name__ == "__main__":
+    main()
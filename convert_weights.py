@@ -0,0 +1,97 @@
+"""Convert the HeadSwap checkpoints into memory-mappable safetensors files.
+
+Only the weights used at inference time are kept: ``net_G_ema`` from the
+alignment checkpoint, the decoder keys of the Blender checkpoint that the
+model actually has, and the BiSeNet parsing weights. Each file is written next
+to its checkpoint (``<name>.safetensors``), where ``Infer.loadModel`` picks it
+up automatically. This makes loading faster, but it does not make workers share
+weights: ``load_state_dict`` still copies them into each process's modules
+(see ``inference.load_weights``).
+
+    python convert_weights.py --dir pretrained_models
+    python convert_weights.py --dir pretrained_models --compare
+"""
+import argparse
+import gc
+import logging
+import os
+import time
+
+import psutil
+import torch
+
+from inference import safetensors_path
+from model.BlendModule.generator import Generator as Decoder
+from model.BlendModule.config import Params as BlendParams
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+# (checkpoint file, key holding the inference weights)
+CHECKPOINTS = [
+    ("epoch_00190_iteration_000400000_checkpoint.pt", "net_G_ema"),
+    ("Blender-401-00012900.pth", "G"),
+    ("parsing.pth", None),
+]
+
+
+def extract(checkpoint_path, key):
+    ckpt = torch.load(checkpoint_path, map_location="cpu")
+    state_dict = ckpt[key] if key else ckpt
+    if key == "G":
+        # The decoder is loaded with strict=False: drop training-only keys it would ignore anyway
+        wanted = {name: t.shape for name, t in Decoder(BlendParams()).state_dict().items()}
+        state_dict = {name: t for name, t in state_dict.items() if wanted.get(name) == t.shape}
+    # safetensors refuses tensors that share storage, so give each its own contiguous buffer
+    return {name: t.detach().contiguous().clone() for name, t in state_dict.items()}
+
+
+def convert(checkpoint_path, key):
+    from safetensors.torch import save_file
+    out_path = safetensors_path(checkpoint_path)
+    state_dict = extract(checkpoint_path, key)
+    save_file(state_dict, out_path)
+    logging.info("Wrote %s (%d tensors, %.1f MB -> %.1f MB)", out_path, len(state_dict),
+                 os.path.getsize(checkpoint_path) / 2 ** 20, os.path.getsize(out_path) / 2 ** 20)
+
+
+def _timed(load):
+    rss = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    result = load()
+    seconds = time.perf_counter() - start
+    return result, seconds, (psutil.Process().memory_info().rss - rss) / 2 ** 20
+
+
+def compare(checkpoint_path, key, device):
+    from safetensors.torch import load_file
+    result, pickle_s, pickle_mb = _timed(lambda: torch.load(checkpoint_path, map_location="cpu"))
+    # Free the pickled checkpoint first so its pages do not count against the safetensors load
+    del result
+    gc.collect()
+    result, fast_s, fast_mb = _timed(lambda: load_file(safetensors_path(checkpoint_path), device=device))
+    del result
+    print(f"{os.path.basename(checkpoint_path):<48} pickle {pickle_s:6.2f}s {pickle_mb:8.1f} MB RSS | "
+          f"safetensors {fast_s:6.2f}s {fast_mb:8.1f} MB RSS")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert HeadSwap checkpoints to safetensors")
+    parser.add_argument("--dir", default="pretrained_models", help="Directory holding the checkpoints")
+    parser.add_argument("--compare", action="store_true",
+                        help="Only time loading each checkpoint against its converted file")
+    parser.add_argument("--device", default="cpu", help="Device for --compare loads")
+    args = parser.parse_args()
+
+    for name, key in CHECKPOINTS:
+        path = os.path.join(args.dir, name)
+        if not os.path.exists(path):
+            logging.warning("Skipping missing checkpoint %s", path)
+            continue
+        if args.compare:
+            compare(path, key, args.device)
+        else:
+            convert(path, key)
+
+
+if __name__ == "__main__":
+    main()
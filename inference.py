@@ -1,5 +1,7 @@
 import logging
 import os
+import time
+from contextlib import nullcontext
 import cv2
 import numpy as np
 import torch
@@ -20,11 +22,71 @@ from utils.utils import color_transfer2
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 
+# Margin around the warped head mask that the 17x17 erode and 15x15 blur can reach
+BLEND_MARGIN = 24
+
+
+def soft_blend(rotate_gen, mask, tgt_img, device='cpu'):
+    """Erode (17x17) and box-blur (15x15) a 0-255 mask, then composite ``rotate_gen`` over ``tgt_img``.
+
+    Runs on ``device`` in float32 and returns a uint8 image; matches the former
+    cv2.erode / cv2.blur (reflect-101 border) / float64 composite. Reflect
+    padding needs more than 7 pixels per side, so slivers left by clipping the
+    blend ROI at the frame edge are padded by replication instead.
+    """
+    with torch.no_grad():
+        m = torch.from_numpy(np.ascontiguousarray(mask, dtype=np.float32)).to(device)[None, None]
+        m = -F.max_pool2d(-m, 17, stride=1, padding=8)
+        pad_mode = 'reflect' if min(m.shape[-2:]) > 7 else 'replicate'
+        m = F.avg_pool2d(F.pad(m, (7, 7, 7, 7), mode=pad_mode), 15, stride=1)
+        m = (m / 255.0).clamp_(0, 1.0)[0, 0, :, :, None]
+        gen = torch.from_numpy(np.ascontiguousarray(rotate_gen)).to(device, torch.float32)
+        tgt = torch.from_numpy(np.array(tgt_img, copy=True)).to(device, torch.float32)
+        final = tgt.add_(m * (gen - tgt))
+        return final.round_().clamp_(0, 255).to(torch.uint8).cpu().numpy()
+
+
+def _no_span(stage):
+    return nullcontext()
+
+
+def safetensors_path(checkpoint_path):
+    """Sibling ``.safetensors`` file written by convert_weights.py for a pickled checkpoint."""
+    return os.path.splitext(checkpoint_path)[0] + ".safetensors"
+
+
+def load_weights(checkpoint_path, key=None, device='cpu'):
+    """Return ``(state_dict, format)`` for a checkpoint, preferring its converted safetensors file.
+
+    The safetensors file is memory-mapped and holds only the inference weights,
+    so nothing else in the training checkpoint is unpickled. It is ignored when
+    older than the checkpoint it was converted from.
+
+    The mapping only speeds up loading: ``load_state_dict`` on the pinned torch
+    1.13 copies every tensor into the module's own parameters, so the mapped
+    dict is dropped afterwards and each worker process still holds a private
+    copy of the weights. Sharing them would need ``load_state_dict(assign=True)``
+    (torch >= 2.1).
+    """
+    fast_path = safetensors_path(checkpoint_path)
+    if os.path.exists(fast_path) and (not os.path.exists(checkpoint_path)
+                                      or os.path.getmtime(fast_path) >= os.path.getmtime(checkpoint_path)):
+        from safetensors.torch import load_file
+        return load_file(fast_path, device=str(device)), "safetensors"
+    ckpt = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    return (ckpt[key] if key else ckpt), "pickle"
+
 
 class Infer(Process):
-    def __init__(self, align_path, blend_path, parsing_path, params_path, bfm_folder):
+    def __init__(self, align_path, blend_path, parsing_path, params_path, bfm_folder,
+                 sr_path='app/HeadSwap/pretrained_models/sr_cf.onnx', session_factory=None, defer_sessions=False,
+                 span=None):
+        # span: optional ``span(stage)`` context manager factory used to time each pipeline stage
+        # defer_sessions: build only the torch networks now and call init_sessions() later, e.g. in a
+        # forked worker, since ONNX Runtime sessions and their thread pools do not survive fork()
         logging.info("Initializing the Infer pipeline")
         Process.__init__(self, params_path, bfm_folder)
+        self.span = span or _no_span
         
         align_params = AlignParams()
         blend_params = BlendParams()
@@ -44,142 +106,305 @@ class Infer(Process):
         self.loadModel(align_path, blend_path, parsing_path)
         self.eval_model(self.netG, self.decoder, self.parsing)
 
+        self.sr_path = sr_path
+        self.ort_session_sr = None
+        if not defer_sessions:
+            self.init_sessions(session_factory)
+
+    def init_sessions(self, session_factory=None):
+        sr_path = self.sr_path
         logging.info("Creating ONNX session for super resolution")
-        self.ort_session_sr = ort.InferenceSession('app/HeadSwap/pretrained_models/sr_cf.onnx', providers=['CPUExecutionProvider'])
+        if session_factory is not None:
+            self.ort_session_sr = session_factory(sr_path)
+        else:
+            self.ort_session_sr = ort.InferenceSession(sr_path, providers=['CPUExecutionProvider'])
+        # The exported SR graph may pin its batch dimension to 1; only stack inputs when it is dynamic
+        sr_batch_dim = self.ort_session_sr.get_inputs()[0].shape[0]
+        self.sr_batched = not (isinstance(sr_batch_dim, int) and sr_batch_dim == 1)
 
-    def run(self, src_img_path_list, tgt_img_path_list, save_base, crop_align=False, cat=False):
+    def run(self, src_img_path_list, tgt_img_path_list, save_base, crop_align=False, cat=False, batch_size=8):
         logging.info("Starting batch processing")
         os.makedirs(save_base, exist_ok=True)
+        pairs = list(zip(src_img_path_list, tgt_img_path_list))
+        failures = []
         i = 0
-        for src_img_path, tgt_img_path in zip(src_img_path_list, tgt_img_path_list):
-            logging.info(f"Processing pair: {src_img_path} and {tgt_img_path}")
-            gen = self.run_single(src_img_path, tgt_img_path, crop_align=crop_align, cat=cat)
-            img_name = os.path.splitext(os.path.basename(src_img_path))[0] + '-' + \
-                       os.path.splitext(os.path.basename(tgt_img_path))[0] + '.png'
-            cv2.imwrite(os.path.join(save_base, img_name), gen)
-            logging.info(f"Saved output: {os.path.join(save_base, img_name)}")
-            print(f'\rProcessed {i:04d}', end='', flush=True)
-            i += 1
-        logging.info("Batch processing complete")
+        for start in range(0, len(pairs), batch_size):
+            chunk = pairs[start:start + batch_size]
+            logging.info(f"Processing pairs {start} to {start + len(chunk) - 1} as one batch")
+            src_imgs = [cv2.imread(src_img_path) for src_img_path, _ in chunk]
+            tgt_imgs = [cv2.imread(tgt_img_path) for _, tgt_img_path in chunk]
+            results = self.run_batch(src_imgs, tgt_imgs, crop_align=crop_align, cat=cat)
+            for (src_img_path, tgt_img_path), (gen, error) in zip(chunk, results):
+                if error is not None:
+                    logging.error(f"Failed pair {src_img_path} and {tgt_img_path}: {error}")
+                    failures.append((src_img_path, tgt_img_path, error))
+                else:
+                    img_name = os.path.splitext(os.path.basename(src_img_path))[0] + '-' + \
+                               os.path.splitext(os.path.basename(tgt_img_path))[0] + '.png'
+                    cv2.imwrite(os.path.join(save_base, img_name), gen)
+                    logging.info(f"Saved output: {os.path.join(save_base, img_name)}")
+                print(f'\rProcessed {i:04d}', end='', flush=True)
+                i += 1
+        logging.info(f"Batch processing complete, {len(failures)} of {len(pairs)} pairs failed")
+        return failures
+
+    def run_batch(self, src_imgs, tgt_imgs, crop_align=False, cat=False, src_inps=None, tgt_preps=None,
+                  inplace=False):
+        """Swap N source/target pairs with one batched pass per network stage.
+
+        ``src_inps`` and ``tgt_preps`` optionally hold already prepared source
+        tensors / target artifacts (see ``prepare_source`` and ``prepare_target``);
+        entries left as ``None`` are prepared here. With ``inplace`` results are
+        blended directly into writable target buffers (see ``blend``).
+        Returns a list of ``(result, error)`` tuples in input order; a pair that
+        fails carries ``None`` and the error message instead of aborting the batch.
+        """
+        results = [(None, None)] * len(src_imgs)
+        if src_inps is None:
+            src_inps = [None] * len(src_imgs)
+        if tgt_preps is None:
+            tgt_preps = [None] * len(src_imgs)
+        prepared = []
+        for idx, (src_img, tgt_img, src_inp, tgt_prep) in enumerate(zip(src_imgs, tgt_imgs, src_inps, tgt_preps)):
+            try:
+                prepared.append((idx, tgt_img, self.prepare_pair(src_img, tgt_img, crop_align=crop_align,
+                                                                 src_inp=src_inp, tgt_prep=tgt_prep)))
+            except Exception as e:
+                logging.error(f"Preprocessing of pair {idx} failed: {e}")
+                results[idx] = (None, str(e))
+        if not prepared:
+            return results
+
+        try:
+            gens = self.generate([pair for _, _, pair in prepared])
+        except Exception as e:
+            if len(prepared) == 1:
+                logging.exception("Forward pass failed")
+                results[prepared[0][0]] = (None, str(e))
+                return results
+            # Isolate the offending pair(s) instead of failing the whole batch
+            logging.warning(f"Batched forward pass failed ({e}), retrying pairs individually")
+            gens = []
+            for idx, _, pair in prepared:
+                try:
+                    gens.append(self.generate([pair])[0])
+                except Exception as pair_error:
+                    logging.error(f"Forward pass of pair {idx} failed: {pair_error}")
+                    gens.append(pair_error)
+
+        for (idx, tgt_img, pair), gen in zip(prepared, gens):
+            if isinstance(gen, Exception):
+                results[idx] = (None, str(gen))
+                continue
+            try:
+                results[idx] = (self.blend(gen, pair['info'], tgt_img, inplace=inplace), None)
+            except Exception as e:
+                logging.error(f"Blending of pair {idx} failed: {e}")
+                results[idx] = (None, str(e))
+        return results
 
     def run_single(self, src_img_path, tgt_img_path, crop_align=False, cat=False):
-        logging.info("Reading target image")
+        logging.debug("Reading target image")
         tgt_img = cv2.imread(tgt_img_path)
         if tgt_img is None:
             logging.error("Failed to read target image")
             return None
-        tgt_align = tgt_img.copy()
-        
-        logging.info("Preprocessing target image for alignment")
-        tgt_align, info = self.preprocess_align(tgt_img)
-        if tgt_align is None:
-            logging.error("Preprocessing of target image failed")
-            return None
 
-        logging.info("Reading source image")
+        logging.debug("Reading source image")
         src_img = cv2.imread(src_img_path)
         if src_img is None:
             logging.error("Failed to read source image")
             return None
+
+        try:
+            final = self.run_arrays(src_img, tgt_img, crop_align=crop_align, cat=cat)
+        except RuntimeError as e:
+            logging.error(f"run_single failed: {e}")
+            return None
+        logging.debug("run_single completed")
+        return final
+
+    def run_arrays(self, src_img, tgt_img, crop_align=False, cat=False, src_inp=None, tgt_prep=None,
+                   inplace=False):
+        """Swap one pair of already decoded BGR images without touching the disk."""
+        final, error = self.run_batch([src_img], [tgt_img], crop_align=crop_align, cat=cat,
+                                      src_inps=[src_inp], tgt_preps=[tgt_prep], inplace=inplace)[0]
+        if error is not None:
+            raise RuntimeError(error)
+        return final
+
+    def prepare_source(self, src_img, crop_align=False):
+        """Align and preprocess a source image into the netG input tensor.
+
+        The result only depends on the source, so callers may cache it and pass
+        it back through ``src_inp`` for every further target.
+        """
+        if src_img is None:
+            raise ValueError("Failed to read source image")
         src_align = src_img
         if crop_align:
-            logging.info("Applying cropping and alignment to source image")
-            src_align, _ = self.preprocess_align(src_img, top_scale=0.55)
-        
-        logging.info("Preprocessing images for network input")
-        src_inp = self.preprocess(src_align)
+            logging.debug("Applying cropping and alignment to source image")
+            with self.span("alignment"):
+                src_align, _ = self.preprocess_align(src_img, top_scale=0.55)
+            if src_align is None:
+                raise ValueError("Preprocessing of source image failed")
+        return self.preprocess(src_align)
+
+    def prepare_target(self, tgt_img, with_parsing=False):
+        """Align a target image and compute everything netG/decoder need from it.
+
+        Returns a dict with ``tgt_inp``, ``tgt_params`` and the affine ``info``;
+        ``with_parsing`` adds the target parsing map ``M_t``. None of it depends
+        on the source, so gallery templates can be prepared once offline.
+        """
+        if tgt_img is None:
+            raise ValueError("Failed to read target image")
+
+        logging.debug("Preprocessing target image for alignment")
+        with self.span("alignment"):
+            tgt_align, info = self.preprocess_align(tgt_img)
+        if tgt_align is None:
+            raise ValueError("Preprocessing of target image failed")
+
         tgt_inp = self.preprocess(tgt_align)
 
-        logging.info("Calculating transformation parameters")
-        tgt_params = self.get_params(cv2.resize(tgt_align, (256, 256)),
-                                     info['rotated_lmk'] / 2.0).unsqueeze(0)
-           
-        logging.info("Performing forward pass through the network")
-        gen = self.forward(src_inp, tgt_inp, tgt_params) 
+        logging.debug("Calculating transformation parameters")
+        with self.span("get_params"):
+            tgt_params = self.get_params(cv2.resize(tgt_align, (256, 256)),
+                                         info['rotated_lmk'] / 2.0).unsqueeze(0)
+        tgt_prep = {'tgt_inp': tgt_inp, 'tgt_params': tgt_params, 'info': info}
+        if with_parsing:
+            tgt_prep['M_t'] = self.parse_target(tgt_inp)
+        return tgt_prep
 
-        logging.info("Postprocessing generated image")
-        gen = self.postprocess(gen[0])
-        logging.info("Running super resolution")
-        gen = self.run_sr(gen)
-        mask = self.mask
+    def parse_target(self, xt):
+        with torch.no_grad(), self.span("parsing"):
+            return self.postprocess_parsing(self.parsing(self.preprocess_parsing(xt)))
 
-        logging.info("Blending generated image with target image")
-        RotateMatrix = info['im'][:2]
-        mask = info['mask'][..., 0]
-        rotate_gen = cv2.warpAffine(gen, RotateMatrix, (tgt_img.shape[1], tgt_img.shape[0]))
-        mask = cv2.warpAffine(mask, RotateMatrix, (tgt_img.shape[1], tgt_img.shape[0])) * 1.0
+    def prepare_pair(self, src_img, tgt_img, crop_align=False, src_inp=None, tgt_prep=None):
+        if tgt_prep is None:
+            tgt_prep = self.prepare_target(tgt_img)
 
-        kernel2 = cv2.getStructuringElement(cv2.MORPH_RECT, (17, 17))
-        mask = cv2.erode(mask * 1.0, kernel2)
-        mask = cv2.blur(mask * 1.0, (15, 15), 0) / 255.0
-        mask = np.clip(mask, 0, 1.0)[:, :, np.newaxis]
+        logging.debug("Preprocessing images for network input")
+        if src_inp is None:
+            src_inp = self.prepare_source(src_img, crop_align=crop_align)
+        return dict(tgt_prep, src_inp=src_inp)
 
-        final = rotate_gen * mask + tgt_img * (1 - mask)
+    def generate(self, pairs):
+        """Run netG, parsing, decoder and SR once over a list of prepared pairs."""
+        logging.debug(f"Performing forward pass through the network (batch size {len(pairs)})")
+        src_inp = torch.cat([pair['src_inp'] for pair in pairs], dim=0)
+        tgt_inp = torch.cat([pair['tgt_inp'] for pair in pairs], dim=0)
+        tgt_params = torch.cat([pair['tgt_params'] for pair in pairs], dim=0)
+        M_t = None
+        if all('M_t' in pair for pair in pairs):
+            M_t = torch.cat([pair['M_t'] for pair in pairs], dim=0)
+        gen = self.forward(src_inp, tgt_inp, tgt_params, M_t=M_t)
+
+        logging.debug("Postprocessing generated images")
+        with self.span("postprocess"):
+            gens = [self.postprocess(gen[i]) for i in range(gen.shape[0])]
+        logging.debug("Running super resolution")
+        return self.run_sr_batch(gens)
+
+    def blend(self, gen, info, tgt_img, inplace=False):
+        """Paste the generated head back into the target frame.
+
+        Only the bounding box of the warped head mask (plus the erode/blur
+        margin) is warped and composited, so the cost scales with the face
+        rather than the frame. With ``inplace`` the result is written straight
+        into ``tgt_img`` when that buffer is writable; otherwise into a copy.
+        """
+        logging.debug("Blending generated image with target image")
+        RotateMatrix = np.asarray(info['im'][:2], dtype=np.float64)
+        mask = np.asarray(info['mask'][..., 0], dtype=np.float32)
+        final = tgt_img if inplace and tgt_img.flags.writeable else np.array(tgt_img, copy=True)
+
+        ys, xs = np.nonzero(mask)
+        if len(ys) == 0:
+            return final
+        corners = np.array([[xs.min(), ys.min(), 1], [xs.max() + 1, ys.min(), 1],
+                            [xs.min(), ys.max() + 1, 1], [xs.max() + 1, ys.max() + 1, 1]], dtype=np.float64)
+        corners = corners @ RotateMatrix.T
+        x0 = max(int(np.floor(corners[:, 0].min())) - BLEND_MARGIN, 0)
+        y0 = max(int(np.floor(corners[:, 1].min())) - BLEND_MARGIN, 0)
+        x1 = min(int(np.ceil(corners[:, 0].max())) + BLEND_MARGIN, final.shape[1])
+        y1 = min(int(np.ceil(corners[:, 1].max())) + BLEND_MARGIN, final.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return final
+
+        roi_matrix = RotateMatrix.copy()
+        roi_matrix[:, 2] -= (x0, y0)
+        rotate_gen = cv2.warpAffine(gen, roi_matrix, (x1 - x0, y1 - y0))
+        mask = cv2.warpAffine(mask, roi_matrix, (x1 - x0, y1 - y0))
+
+        roi = final[y0:y1, x0:x1]
+        with self.span("blend"):
+            roi[...] = soft_blend(rotate_gen, mask, roi, device=self.device)
 
         # Removed the concatenation block to ensure the final image contains only the swapped face.
-        logging.info("run_single completed")
         return final
     
-    def forward(self, xs, xt, params):
-        logging.info("Starting forward pass computation")
+    def forward(self, xs, xt, params, M_t=None):
+        logging.debug("Starting forward pass computation")
         with torch.no_grad():
-            xg = self.netG(
-                F.adaptive_avg_pool2d(xs, 256),
-                F.adaptive_avg_pool2d(xt, 256),
-                params
-            )['fake_image']
-            logging.info("Generated initial fake image")
+            with self.span("netG"):
+                xg = self.netG(
+                    F.adaptive_avg_pool2d(xs, 256),
+                    F.adaptive_avg_pool2d(xt, 256),
+                    params
+                )['fake_image']
+            logging.debug("Generated initial fake image")
             xg = F.adaptive_avg_pool2d(xg, 512)
            
-            M_a = self.parsing(self.preprocess_parsing(xg))
-            M_t = self.parsing(self.preprocess_parsing(xt))
-            
-            M_a = self.postprocess_parsing(M_a)
-            M_t = self.postprocess_parsing(M_t)
-            logging.info("Postprocessed segmentation maps")
+            with self.span("parsing"):
+                M_a = self.parsing(self.preprocess_parsing(xg))
+                M_a = self.postprocess_parsing(M_a)
+            if M_t is None:
+                M_t = self.parse_target(xt)
+            logging.debug("Postprocessed segmentation maps")
             
             xg_gray = TF.rgb_to_grayscale(xg, num_output_channels=1)
-            fake = self.decoder(xg, xg_gray, xt, M_a, M_t, xt, train=False)
-            logging.info("Decoded blended image")
-            
-            gen_mask = self.parsing(self.preprocess_parsing(fake))
-            gen_mask = self.postprocess_parsing(gen_mask)
-            gen_mask = gen_mask[0][0].cpu().numpy()
-            mask_t = M_t[0][0].cpu().numpy()
-            mask = np.zeros_like(gen_mask)
-            for i in [1,2,3,4,5,6,7,8,9,10,11,12,13,17,18]:
-                mask[gen_mask == i] = 1.0
-                mask[mask_t == i] = 1.0
-            
-            self.mask = mask
-            logging.info("Forward pass complete")
+            with self.span("decoder"):
+                fake = self.decoder(xg, xg_gray, xt, M_a, M_t, xt, train=False)
+            logging.debug("Decoded blended image")
+            logging.debug("Forward pass complete")
         return fake
     
     def run_sr(self, input_np):
-        logging.info("Converting image for super resolution")
-        input_np = cv2.cvtColor(input_np, cv2.COLOR_BGR2RGB)
-        input_np = input_np.transpose((2, 0, 1))
-        input_np = np.array(input_np[np.newaxis, :])
-        logging.info("Running ONNX super resolution model")
-        outputs_onnx = self.ort_session_sr.run(None, {'input_image': input_np.astype(np.uint8)})
-        out_put_onnx = outputs_onnx[0]
-        outimg = out_put_onnx[0, ...].transpose(1, 2, 0)
-        outimg = cv2.cvtColor(outimg, cv2.COLOR_BGR2RGB)
-        logging.info("Super resolution complete")
-        return outimg
+        return self.run_sr_batch([input_np])[0]
 
-    def loadModel(self, align_path, blend_path, parsing_path):
-        logging.info("Loading alignment generator model from: " + align_path)
-        ckpt = torch.load(align_path, map_location=lambda storage, loc: storage)
-        self.netG.load_state_dict(ckpt['net_G_ema'])
-
-        logging.info("Loading blending decoder model from: " + blend_path)
-        ckpt = torch.load(blend_path, map_location=lambda storage, loc: storage)
-        self.decoder.load_state_dict(ckpt['G'], strict=False)
+    def run_sr_batch(self, input_list):
+        logging.debug("Converting images for super resolution")
+        batch = np.stack([cv2.cvtColor(input_np, cv2.COLOR_BGR2RGB).transpose((2, 0, 1))
+                          for input_np in input_list]).astype(np.uint8)
+        logging.debug("Running ONNX super resolution model")
+        with self.span("sr"):
+            if self.sr_batched:
+                out_put_onnx = self.ort_session_sr.run(None, {'input_image': batch})[0]
+            else:
+                out_put_onnx = np.concatenate([self.ort_session_sr.run(None, {'input_image': batch[i:i + 1]})[0]
+                                               for i in range(batch.shape[0])])
+        outimgs = [cv2.cvtColor(out.transpose(1, 2, 0), cv2.COLOR_BGR2RGB) for out in out_put_onnx]
+        logging.debug("Super resolution complete")
+        return outimgs
 
-        logging.info("Loading face parsing model from: " + parsing_path)
-        self.parsing.load_state_dict(torch.load(parsing_path))
-        logging.info("All models loaded successfully")
+    def loadModel(self, align_path, blend_path, parsing_path):
+        # (name, module, checkpoint, key holding the inference weights, strict)
+        checkpoints = [
+            ("alignment generator", self.netG, align_path, 'net_G_ema', True),
+            ("blending decoder", self.decoder, blend_path, 'G', False),
+            ("face parsing", self.parsing, parsing_path, None, True),
+        ]
+        self.load_report = []
+        for name, module, path, key, strict in checkpoints:
+            start = time.perf_counter()
+            state_dict, fmt = load_weights(path, key, self.device)
+            module.load_state_dict(state_dict, strict=strict)
+            seconds = time.perf_counter() - start
+            self.load_report.append({"model": name, "format": fmt, "seconds": round(seconds, 3)})
+            logging.info(f"Loaded {name} model from {path} ({fmt}) in {seconds:.2f}s")
+        logging.info("All models loaded successfully in %.2fs", sum(r["seconds"] for r in self.load_report))
     
     def eval_model(self, *args):
         logging.info("Setting models to evaluation mode")
@@ -201,6 +426,6 @@ if __name__ == "__main__":
     src_paths = ['../img2.jpg']
     tgt_paths = ['../img1.jpg']
     
-    model.run(src_paths, tgt_paths, save_base='res-1125', crop_align=True, cat=False)
+    model.run(src_paths, tgt_paths, save_base='res-1125', crop_align=True, cat=False, batch_size=8)
     
     logging.info("Inference process complete")
@@ -10,6 +10,7 @@ export const state = {
     capturedImageSrc: null,
     webcamStream: null,
     lastSwappedUrl: null,
-    lastQrCodeUrl: null
+    lastQrCodeUrl: null,
+    qrCodePending: false
   };
   
\ No newline at end of file
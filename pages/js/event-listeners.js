@@ -2,7 +2,7 @@
 import { state } from './constants.js';
 import { showError, createSparkleBurst, showLoading, hideLoading } from './helpers.js';
 import { initializeWebcam, capturePhoto, resetCapture, startCountdown } from './webcam.js';
-import { processFaceSwap, processHeadSwap, showQrCode, hideQrCode } from './face-swap.js';
+import { processFaceSwap, processHeadSwap, showQrCode, hideQrCode, waitForQrCode } from './face-swap.js';
 import { navigateTo, setupPreviewPage, loadFilteredImages } from './ui.js';
 
 export const setupEventListeners = (elements) => {
@@ -121,9 +121,24 @@ export const setupEventListeners = (elements) => {
       } else {
         throw new Error('Invalid operation selected');
       }
-      const { swappedImageUrl, qrCodeUrl } = result;
+      const { swappedImageUrl, qrCodeUrl, statusUrl } = result;
       state.lastSwappedUrl = swappedImageUrl;
       state.lastQrCodeUrl = qrCodeUrl;
+      state.qrCodePending = !qrCodeUrl;
+      if (!qrCodeUrl) {
+        waitForQrCode(statusUrl)
+          .then(url => {
+            if (state.lastSwappedUrl === swappedImageUrl) {
+              state.lastQrCodeUrl = url;
+            }
+          })
+          .catch(error => showError(error.message, elements))
+          .finally(() => {
+            if (state.lastSwappedUrl === swappedImageUrl) {
+              state.qrCodePending = false;
+            }
+          });
+      }
       
       elements.sourcePreview.classList.remove('shake');
       elements.targetPreview.classList.remove('shake');
@@ -6,14 +6,12 @@ import { showError, dataURLtoFile } from './helpers.js';
 export const processFaceSwap = async (elements) => {
   try {
     const formData = new FormData();
-    const selectedImageFile = await fetchSelectedImage(state.selectedImageSrc);
-    formData.append('target', selectedImageFile);
     const capturedImageFile = dataURLtoFile(state.capturedImageSrc, 'capture.jpg');
     formData.append('source', capturedImageFile);
 
     const mode = document.getElementById('imageMode').value;
     const token = localStorage.getItem('token');
-    const response = await fetch(`${state.apiBaseUrl}/api/swap-face-qr/?mode=${mode}&token=${token}`, {
+    const response = await fetch(`${state.apiBaseUrl}/api/swap-face-qr/?mode=${mode}&token=${token}&${templateQuery(state.selectedImageSrc)}`, {
         method: 'POST',
         body: formData
     });
@@ -24,13 +22,7 @@ export const processFaceSwap = async (elements) => {
       const errorText = await response.text();
       throw new Error(`API Error: ${response.status} - ${errorText}`);
     }
-    const resultJson = await response.json();
-    const swappedImageUrl = resultJson.swapped_image_url;
-    const qrCodeUrl = resultJson.qr_code;
-    if (!swappedImageUrl || !qrCodeUrl) {
-      throw new Error('No image URL or QR code received from server');
-    }
-    return { swappedImageUrl, qrCodeUrl };
+    return readSwapResult(await response.json());
   } catch (error) {
     showError(error.message, elements);
     throw error;
@@ -44,8 +36,6 @@ export const processHeadSwap = async (elements) => {
         throw new Error('Please select both a source image and capture a photo');
       }
       const formData = new FormData();
-      const selectedImageFile = await fetchSelectedImage(state.selectedImageSrc);
-      formData.append('target', selectedImageFile);
       const capturedImageFile = dataURLtoFile(state.capturedImageSrc, 'capture.jpg');
       formData.append('source', capturedImageFile);
   
@@ -55,7 +45,7 @@ export const processHeadSwap = async (elements) => {
         throw new Error('No authentication token found. Please register or log in.');
       }
   
-      const response = await fetch(`${state.apiBaseUrl}/api/headswap-qr/?mode=${mode}&token=${token}`, {
+      const response = await fetch(`${state.apiBaseUrl}/api/headswap-qr/?mode=${mode}&token=${token}&${templateQuery(state.selectedImageSrc)}`, {
         method: 'POST',
         body: formData
       });
@@ -63,35 +53,55 @@ export const processHeadSwap = async (elements) => {
         const errorText = await response.text();
         throw new Error(`API Error: ${response.status} - ${errorText}`);
       }
-      const resultJson = await response.json();
-      const swappedImageUrl = resultJson.swapped_image_url;
-      const qrCodeUrl = resultJson.qr_code;
-      if (!swappedImageUrl || !qrCodeUrl) {
-        throw new Error('No image URL or QR code received from server');
-      }
-      return { swappedImageUrl, qrCodeUrl };
+      return readSwapResult(await response.json());
     } catch (error) {
       showError(error.message, elements);
       throw error;
     }
   };
 
-// Helper function to fetch the selected image as a blob and return as a File
-async function fetchSelectedImage(url) {
+// qr_code is null when the server has no public address; the QR code for the CDN link then comes from
+// status_url once the background upload has finished (see waitForQrCode)
+function readSwapResult(resultJson) {
+  const swappedImageUrl = resultJson.swapped_image_url;
+  const qrCodeUrl = resultJson.qr_code;
+  const statusUrl = resultJson.status_url;
+  if (!swappedImageUrl || (!qrCodeUrl && !statusUrl)) {
+    throw new Error('No image URL or QR code received from server');
+  }
+  return { swappedImageUrl, qrCodeUrl, statusUrl };
+}
+
+export const waitForQrCode = async (statusUrl, timeoutMs = 120000) => {
+  const deadline = Date.now() + timeoutMs;
+  while (Date.now() < deadline) {
+    const response = await fetch(`${state.apiBaseUrl}${statusUrl}`);
+    if (response.ok) {
+      const status = await response.json();
+      if (status.status === 'done') {
+        return status.qr_code;
+      }
+      if (status.status === 'failed') {
+        throw new Error(`Uploading the result failed: ${status.error}`);
+      }
+    }
+    await new Promise(resolve => setTimeout(resolve, 1000));
+  }
+  throw new Error('Timed out waiting for the result upload');
+};
+
+// The server resolves gallery templates from its local cache, so only the URL is sent
+function templateQuery(url) {
   if (!url) {
     throw new Error('Selected image URL is undefined');
   }
-  const response = await fetch(url);
-  if (!response.ok) {
-    throw new Error(`Failed to fetch image: ${response.statusText}`);
-  }
-  const blob = await response.blob();
-  return new File([blob], 'selected.jpg', { type: blob.type });
+  return `template_url=${encodeURIComponent(url)}`;
 }
 
 export const showQrCode = (elements) => {
   if (!state.lastQrCodeUrl) {
-    showError('No QR code available', elements);
+    showError(state.qrCodePending ? 'The QR code is still being prepared, please try again in a moment'
+                                  : 'No QR code available', elements);
     return;
   }
   elements.qrCodeImage.src = state.lastQrCodeUrl;